@@ -2,9 +2,15 @@ from logging import Logger, basicConfig, INFO
 from flask import Flask, Blueprint
 from flask_restx import Api, Resource
 from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
 from settings import FLASK_DEBUG, FLASK_ENV, SERVICES, RESTPLUS_MASK_SWAGGER, \
-    RESTX_ERROR_404_HELP, RESTPLUS_SWAGGER_UI_DOC_EXPANSION
+    RESTX_ERROR_404_HELP, RESTPLUS_SWAGGER_UI_DOC_EXPANSION, \
+    RATELIMIT_STORAGE_URI, RATELIMIT_STRATEGY
+from routes.helpers import rate_limit, rate_limit_key
+from metrics import instrument
+from representation import output_json
+# registers the batched+ storage schemes
+import ratelimit_storage  # noqa: F401
+from routes.history import ns as ns_history
 from routes.ratelimits import ns as ns_ratelimits
 from routes.services import ns as ns_services
 from routes.tasks import ns as ns_tasks
@@ -35,13 +41,16 @@ authorizations = {
 # Define a blueprint of how to construct or extend an application
 blueprint = Blueprint('api', __name__, url_prefix='/api')
 
-# set limiter configs
+# set limiter configs, counters are shared by every process
+# when the storage is not memory://
 limiter = Limiter(
-    flask_app,
-    key_func=get_remote_address
+    key_func=rate_limit_key,
+    app=flask_app,
+    storage_uri=RATELIMIT_STORAGE_URI,
+    strategy=RATELIMIT_STRATEGY
 )
 
-limiter.limit("200/day;50/hour;5/minute", error_message='ratelimit exceeded')(blueprint)
+limiter.limit(rate_limit, error_message='ratelimit exceeded')(blueprint)
 
 api_desc = "Look up information from {}".format(SERVICES)
 
@@ -53,10 +62,17 @@ api = Api(blueprint,
           authorizations=authorizations,
           doc='/docs/')
 
+# encode JSON responses with orjson
+api.representation('application/json')(output_json)
+
 # registers resources from namespace for current instance of api
 api.add_namespace(ns_ratelimits)
 api.add_namespace(ns_services)
 api.add_namespace(ns_tasks)
+api.add_namespace(ns_history)
 
 # Register a blueprint on an application
 flask_app.register_blueprint(blueprint)
+
+# time every request and serve /api/metrics
+instrument(flask_app)
@@ -1,14 +1,41 @@
 
 from celery import Celery
-from settings import CELERY_BROKER_URL, CELERY_BACKEND
+from resultstore import backend_url
+from settings import CELERY_BROKER_URL, CELERY_BACKEND, RESULT_EXPIRES, \
+    CELERY_TASK_ROUTES, BATCH, PRIORITY_LANES, PRIORITY_MAX
 
-# Initialize an instance of Celery
+# Initialize an instance of Celery, mongodb results larger than
+# RESULT_COMPRESS_THRESHOLD are stored compressed
 tasks_app = Celery('tasks', broker=CELERY_BROKER_URL,
-                   backend=CELERY_BACKEND)
+                   backend=backend_url(CELERY_BACKEND))
 
 tasks_app.conf.update(
     # enable STARTED status for celery task
     # needed to know if a task exists
     task_track_started=True,
-    # result_expires=3600,
+    # publish each service to its own queue and worker pool
+    task_routes=CELERY_TASK_ROUTES,
+    # the workers remove results through a TTL index per task type
+    result_expires=RESULT_EXPIRES,
+    # queues are declared as priority queues, like the workers do
+    task_queue_max_priority=PRIORITY_MAX,
+    task_default_priority=PRIORITY_LANES[BATCH],
 )
+
+
+def task_priority(lane, key_lane=None):
+    """
+    Priority of the tasks published for a request
+
+    :param lane: priority lane of the endpoint, e.g. INTERACTIVE
+    :param key_lane: highest lane of the API key of the client OR None,
+                     see keystore.py
+
+    Returns:
+        Integer. Priority of the lane, at most the one of the key lane
+    """
+
+    priority = PRIORITY_LANES[lane]
+    if key_lane in PRIORITY_LANES:
+        priority = min(priority, PRIORITY_LANES[key_lane])
+    return priority
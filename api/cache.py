@@ -0,0 +1,303 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from json import dumps, loads
+from logging import getLogger
+from threading import Lock
+from time import time
+from backend import tasks_app
+from metrics import cache_lookups
+from refresh import refresh_lookup
+from settings import CACHE_TTLS, CACHE_STALE, CACHE_MAXSIZE, \
+    CACHE_COLLECTION, CACHE_REFRESH_CLAIM
+
+log = getLogger(__name__)
+
+
+def normalize_host(host):
+    """
+    Normalize a host so equivalent spellings share a cache entry
+
+    :param host: ip or domain name
+
+    Returns:
+        String. Lower case host without surrounding blanks or trailing dot
+    """
+
+    return host.strip().lower().rstrip('.')
+
+
+class LookupCache(object):
+    """
+    Two tier TTL cache of lookup results keyed on (service, host).
+
+    The first tier is a bounded LRU kept in each API process, the second
+    a MongoDB collection shared by every worker and replica. Entries
+    are fresh for the TTL of their service; services without a TTL are
+    never cached. The shared tier then serves them stale for the stale
+    time of their service while a single API process publishes a
+    background lookup refreshing them (stale-while-revalidate).
+    """
+
+    def __init__(self, app, ttls=CACHE_TTLS, maxsize=CACHE_MAXSIZE,
+                 collection=CACHE_COLLECTION, stale=None, refresh=None):
+        """
+        :param stale: seconds each service is served stale
+        :param refresh: callable(key, service, host, ttl, stale)
+            publishing the lookup refreshing a stale entry
+        """
+
+        self.app = app
+        self.ttls = ttls
+        self.maxsize = maxsize
+        self.collection_name = collection
+        self.stale = stale or {}
+        self.refresh = refresh
+        self._lock = Lock()
+        self._local = OrderedDict()
+        self._collection = None
+        self.stats = {'hits': 0, 'local_hits': 0, 'shared_hits': 0,
+                      'stale_hits': 0, 'misses': 0, 'sets': 0,
+                      'refreshes': 0}
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            collection = self.app.backend.database[self.collection_name]
+            # mongo removes expired entries on its own
+            collection.create_index('expires_at', expireAfterSeconds=0)
+            self._collection = collection
+        return self._collection
+
+    def _count(self, *names, service=None):
+        with self._lock:
+            for name in names:
+                self.stats[name] += 1
+        # reads are also exported by service, under their last counter
+        if service is not None:
+            cache_lookups.labels(service.upper(), names[-1]).inc()
+
+    def key(self, service, host):
+        return '{}:{}'.format(service.upper(), normalize_host(host))
+
+    def ttl(self, service):
+        return self.ttls.get(service.upper())
+
+    def stale_for(self, service):
+        return self.stale.get(service.upper(), 0)
+
+    def _shared_hit(self, document, service, host):
+        """
+        Read a document of the shared tier, keeping it in the process tier
+        while it is fresh and refreshing it once it is stale
+
+        Returns:
+            The cached result
+        """
+
+        value = loads(document['value'])
+        # entries written before stale serving are fresh until they expire
+        fresh_until = document.get('fresh_until', document['expires_at'])
+        fresh = (fresh_until - datetime.utcnow()).total_seconds()
+
+        if fresh > 0:
+            self._set_local(document['_id'], value, time() + fresh)
+            self._count('hits', 'shared_hits', service=service)
+        else:
+            self._count('hits', 'stale_hits', service=service)
+            self._revalidate(document['_id'], service, host)
+
+        return value
+
+    def _revalidate(self, key, service, host):
+        """
+        Publish the refresh of a stale entry, unless another process
+        claimed it in the last CACHE_REFRESH_CLAIM seconds
+        """
+
+        if self.refresh is None:
+            return
+
+        now = datetime.utcnow()
+        try:
+            claimed = self.collection.update_one({
+                '_id': key,
+                'fresh_until': {'$lte': now},
+                'refresh_until': {'$not': {'$gt': now}}
+            }, {'$set': {
+                'refresh_until': now + timedelta(seconds=CACHE_REFRESH_CLAIM)
+            }}).modified_count
+            if claimed:
+                self.refresh(key, service.upper(), normalize_host(host),
+                             self.ttl(service), self.stale_for(service))
+                self._count('refreshes')
+        except Exception as e:
+            log.info("Stale {} not refreshed: {}".format(key, e))
+
+    def _set_local(self, key, value, expires):
+        with self._lock:
+            self._local[key] = (expires, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+    def get(self, service, host):
+        """
+        Return the cached result of a service lookup
+
+        :param service: name of the service
+        :param host: ip or domain name
+
+        Returns:
+            The cached result or None on a miss
+        """
+
+        if not self.ttl(service):
+            return None
+
+        key = self.key(service, host)
+
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                if entry[0] > time():
+                    self._local.move_to_end(key)
+                else:
+                    del self._local[key]
+                    entry = None
+
+        if entry is not None:
+            self._count('hits', 'local_hits', service=service)
+            return entry[1]
+
+        try:
+            document = self.collection.find_one({
+                '_id': key, 'expires_at': {'$gt': datetime.utcnow()}})
+        except Exception as e:
+            log.info("Lookup cache unavailable: {}".format(e))
+            document = None
+
+        if document is None:
+            self._count('misses', service=service)
+            return None
+
+        return self._shared_hit(document, service, host)
+
+    def get_many(self, lookups):
+        """
+        Return the cached results of many service lookups, reading the
+        shared tier with a single query
+
+        :param lookups: list of (service, host)
+
+        Returns:
+            Dictionary. Cached result by (service, host), misses are left out
+        """
+
+        found = {}
+        missing = {}
+        now = time()
+
+        with self._lock:
+            for service, host in lookups:
+                if not self.ttl(service):
+                    continue
+                key = self.key(service, host)
+                entry = self._local.get(key)
+                if entry is not None and entry[0] > now:
+                    self._local.move_to_end(key)
+                    found[(service, host)] = entry[1]
+                    self.stats['hits'] += 1
+                    self.stats['local_hits'] += 1
+                    cache_lookups.labels(service.upper(), 'local_hits').inc()
+                else:
+                    missing.setdefault(key, []).append((service, host))
+
+        if not missing:
+            return found
+
+        try:
+            documents = list(self.collection.find({
+                '_id': {'$in': list(missing)},
+                'expires_at': {'$gt': datetime.utcnow()}}))
+        except Exception as e:
+            log.info("Lookup cache unavailable: {}".format(e))
+            documents = []
+
+        for document in documents:
+            lookups = missing.pop(document['_id'])
+            value = self._shared_hit(document, *lookups[0])
+            found[lookups[0]] = value
+            for lookup in lookups[1:]:
+                found[lookup] = value
+                self._count('hits', 'shared_hits', service=lookup[0])
+
+        for lookups in missing.values():
+            for lookup in lookups:
+                self._count('misses', service=lookup[0])
+
+        return found
+
+    def set(self, service, host, value):
+        """
+        Store the result of a service lookup in both tiers, fresh for the
+        TTL of the service then stale for its stale time
+
+        :param service: name of the service
+        :param host: ip or domain name
+        :param value: JSON serializable lookup result
+        """
+
+        ttl = self.ttl(service)
+        if not ttl:
+            return
+
+        key = self.key(service, host)
+        self._set_local(key, value, time() + ttl)
+        self._count('sets')
+
+        fresh_until = datetime.utcnow() + timedelta(seconds=ttl)
+        expires_at = fresh_until + timedelta(seconds=self.stale_for(service))
+        try:
+            self.collection.replace_one({'_id': key}, {
+                '_id': key,
+                'service': service.upper(),
+                'host': normalize_host(host),
+                'value': dumps(value),
+                'fresh_until': fresh_until,
+                'expires_at': expires_at
+            }, upsert=True)
+        except Exception as e:
+            log.info("Lookup cache unavailable: {}".format(e))
+
+    def delete(self, service, host):
+        """
+        Remove a service lookup from both tiers
+
+        :param service: name of the service
+        :param host: ip or domain name
+        """
+
+        key = self.key(service, host)
+
+        with self._lock:
+            self._local.pop(key, None)
+
+        try:
+            self.collection.delete_one({'_id': key})
+        except Exception as e:
+            log.info("Lookup cache unavailable: {}".format(e))
+
+    def info(self):
+        """
+        Returns:
+            Dictionary. Hit/miss counters and size of this process tier
+        """
+
+        with self._lock:
+            info = dict(self.stats, size=len(self._local),
+                        maxsize=self.maxsize)
+        return info
+
+
+lookup_cache = LookupCache(tasks_app, stale=CACHE_STALE,
+                           refresh=refresh_lookup)
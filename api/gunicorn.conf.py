@@ -0,0 +1,11 @@
+# Gunicorn server hooks, loaded from the working directory of the API
+
+
+def post_worker_init(worker):
+    """
+    Warm the broker connection of the producer pool once the worker has
+    loaded the app, so requests publish over an open connection and channel
+    """
+
+    from publisher import task_publisher
+    task_publisher.warm()
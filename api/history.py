@@ -0,0 +1,114 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from json import loads
+from bson import ObjectId
+from bson.errors import InvalidId
+from backend import tasks_app
+from cache import normalize_host
+from settings import HISTORY_COLLECTION
+
+
+def encode_cursor(document):
+    """
+    Opaque position of a history document, the last one of a page
+
+    :param document: history document
+
+    Returns:
+        String. URL safe cursor
+    """
+
+    position = '{}|{}'.format(document['timestamp'].isoformat(),
+                              document['_id'])
+    return urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor: cursor returned by a previous page
+
+    Returns:
+        Tuple - timestamp and id of the last document of that page
+
+    Raises:
+        ValueError: the cursor is not one returned by encode_cursor
+    """
+
+    try:
+        timestamp, id = urlsafe_b64decode(cursor.encode('ascii')) \
+            .decode('utf-8').split('|')
+        return datetime.fromisoformat(timestamp), ObjectId(id)
+    except (UnicodeError, InvalidId, TypeError, ValueError) as e:
+        raise ValueError('invalid cursor') from e
+
+
+class LookupHistory(object):
+    """
+    Results of past lookups, written by the task workers to a MongoDB
+    time-series collection indexed on host, service and time (see
+    tasks/history.py), read newest first by pages.
+    """
+
+    def __init__(self, app, collection=HISTORY_COLLECTION):
+        self.app = app
+        self.collection_name = collection
+
+    @property
+    def collection(self):
+        return self.app.backend.database[self.collection_name]
+
+    def query(self, host, services=None, since=None, until=None,
+              limit=100, cursor=None):
+        """
+        Read a page of the lookup history of a host
+
+        :param host: ip or domain name
+        :param services: service names to return OR None for all of them
+        :param since: oldest time to return, inclusive OR None
+        :param until: newest time to return, exclusive OR None
+        :param limit: largest number of entries of the page
+        :param cursor: cursor of the previous page OR None for the first
+
+        Returns:
+            Tuple - entries newest first and the cursor of the next page
+            OR None on the last page
+        """
+
+        query = {'meta.host': normalize_host(host)}
+        if services:
+            query['meta.service'] = {'$in': [service.upper()
+                                             for service in services]}
+
+        timestamp = {}
+        if since is not None:
+            timestamp['$gte'] = since
+        if until is not None:
+            timestamp['$lt'] = until
+        if timestamp:
+            query['timestamp'] = timestamp
+
+        # resume after the last entry of the previous page, entries of
+        # the same time ordered by id
+        if cursor is not None:
+            last, id = decode_cursor(cursor)
+            query['$or'] = [{'timestamp': {'$lt': last}},
+                            {'timestamp': last, '_id': {'$lt': id}}]
+
+        documents = list(self.collection.find(query)
+                         .sort([('timestamp', -1), ('_id', -1)])
+                         .limit(limit + 1))
+
+        next_cursor = None
+        if len(documents) > limit:
+            documents = documents[:limit]
+            next_cursor = encode_cursor(documents[-1])
+
+        entries = [{'service': document['meta']['service'],
+                    'timestamp': document['timestamp'].isoformat(),
+                    'results': loads(document['result'])}
+                   for document in documents]
+
+        return entries, next_cursor
+
+
+lookup_history = LookupHistory(tasks_app)
@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+from logging import getLogger
+from uuid import uuid4
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from backend import tasks_app
+from cache import normalize_host
+from settings import INFLIGHT_COLLECTION, LOOKUP_TIMEOUT
+
+log = getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+class InFlightLookups(object):
+    """
+    Registry of the lookup tasks currently running, shared by every
+    worker and replica through a MongoDB collection.
+
+    Identical (service, host) lookups published while a task is running
+    attach to its task id instead of publishing another task. An entry is
+    released once its task completes or times out; entries nobody
+    released expire after LOOKUP_TIMEOUT seconds.
+    """
+
+    def __init__(self, app, collection=INFLIGHT_COLLECTION,
+                 ttl=LOOKUP_TIMEOUT):
+        self.app = app
+        self.collection_name = collection
+        self.ttl = ttl
+        self._collection = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            collection = self.app.backend.database[self.collection_name]
+            # mongo removes expired entries on its own
+            collection.create_index('expires_at', expireAfterSeconds=0)
+            self._collection = collection
+        return self._collection
+
+    def key(self, service, host):
+        return '{}:{}'.format(service.upper(), normalize_host(host))
+
+    def claim(self, lookups):
+        """
+        Claim the lookups nobody is running, with a single bulk write
+
+        :param lookups: list of (service, host)
+
+        Returns:
+            Dictionary. (task_id, owner) by (service, host). The caller
+            must publish the task ids it owns, the others are running
+        """
+
+        keys = {}
+        for service, host in lookups:
+            keys.setdefault(self.key(service, host), []).append(
+                (service, host))
+
+        order = list(keys)
+        task_ids = {key: str(uuid4()) for key in order}
+        owners = {}
+
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=self.ttl)
+
+        # an upsert only matches a free or expired entry, a running
+        # entry makes it fail on the unique _id
+        requests = [UpdateOne({'_id': key, 'expires_at': {'$lte': now}},
+                              {'$set': {'task_id': task_ids[key],
+                                        'expires_at': expires}},
+                              upsert=True)
+                    for key in order]
+
+        try:
+            try:
+                self.collection.bulk_write(requests, ordered=False)
+                taken = []
+            except BulkWriteError as e:
+                errors = e.details['writeErrors']
+                if any(error['code'] != DUPLICATE_KEY for error in errors):
+                    raise
+                taken = [order[error['index']] for error in errors]
+
+            if taken:
+                for document in self.collection.find({'_id': {'$in': taken}}):
+                    owners[document['_id']] = document['task_id']
+
+        except Exception as e:
+            log.info("In-flight registry unavailable: {}".format(e))
+            owners = {}
+
+        claims = {}
+        for key, key_lookups in keys.items():
+            claim = (owners[key], False) if key in owners \
+                else (task_ids[key], True)
+            for lookup in key_lookups:
+                claims[lookup] = claim
+
+        return claims
+
+    def release(self, lookups):
+        """
+        Release the entries of finished or timed out lookups
+
+        :param lookups: list of (service, host, task_id)
+        """
+
+        if not lookups:
+            return
+
+        try:
+            self.collection.delete_many({'$or': [
+                {'_id': self.key(service, host), 'task_id': task_id}
+                for service, host, task_id in lookups]})
+        except Exception as e:
+            log.info("In-flight registry unavailable: {}".format(e))
+
+
+inflight_lookups = InFlightLookups(tasks_app)
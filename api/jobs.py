@@ -0,0 +1,83 @@
+from datetime import datetime
+from uuid import uuid4
+from celery import states
+from backend import tasks_app
+from settings import JOB_COLLECTION, JOB_EXPIRES, LOOKUP_DEADLINE
+
+
+class LookupJobs(object):
+    """
+    Records of asynchronous lookups grouping the task ids of a host.
+
+    A job is created as PENDING when its tasks are published and stores
+    the merged payload once every task finished. Jobs are removed by a
+    MongoDB TTL index after JOB_EXPIRES seconds.
+    """
+
+    def __init__(self, app, collection=JOB_COLLECTION, expires=JOB_EXPIRES):
+        self.app = app
+        self.collection_name = collection
+        self.expires = expires
+        self._collection = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            collection = self.app.backend.database[self.collection_name]
+            collection.create_index('created_at',
+                                    expireAfterSeconds=self.expires)
+            self._collection = collection
+        return self._collection
+
+    def create(self, host, services, task_services, deadline=LOOKUP_DEADLINE):
+        """
+        Store a new lookup job
+
+        :param host: ip or domain name
+        :param services: results known at publish time (cached/invalid)
+        :param task_services: service name by published task id
+        :param deadline: seconds after which unfinished tasks time out
+
+        Returns:
+            String. The job id
+        """
+
+        job_id = str(uuid4())
+
+        self.collection.insert_one({
+            '_id': job_id,
+            'host': host,
+            'status': states.PENDING,
+            'services': services,
+            'tasks': [{'task_id': task_id, 'service': service}
+                      for task_id, service in task_services.items()],
+            'created_at': datetime.utcnow(),
+            'deadline': deadline
+        })
+
+        return job_id
+
+    def get(self, job_id):
+        """
+        Returns:
+            Dictionary. The job record OR None for an unknown job
+        """
+
+        return self.collection.find_one({'_id': job_id})
+
+    def finish(self, job_id, services):
+        """
+        Store the merged payload of a job whose tasks all finished
+
+        :param job_id: the job id
+        :param services: merged results of every service
+        """
+
+        self.collection.update_one({'_id': job_id}, {'$set': {
+            'status': states.SUCCESS,
+            'services': services,
+            'tasks': []
+        }})
+
+
+lookup_jobs = LookupJobs(tasks_app)
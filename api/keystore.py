@@ -0,0 +1,309 @@
+from argparse import ArgumentParser
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from hashlib import sha256
+from hmac import compare_digest
+from logging import getLogger
+from secrets import token_urlsafe
+from threading import Lock
+from time import time
+from backend import tasks_app
+from settings import TOKEN, SCOPES, KEY_COLLECTION, KEY_CACHE_SIZE, \
+    KEY_CACHE_TTL, KEY_NEGATIVE_TTL, KEY_REVOCATION_INTERVAL, \
+    KEY_ROTATION_GRACE, RATE_LIMITS_BY_KEY, PRIORITY_LANES_BY_KEY
+
+log = getLogger(__name__)
+
+
+def hash_key(apikey):
+    """
+    Hash an API key for storage. Keys are random 256 bit tokens, so a
+    plain SHA-256 cannot be reversed by brute force
+
+    :param apikey: API key
+
+    Returns:
+        String. Hex SHA-256 of the key
+    """
+
+    return sha256(apikey.encode('utf-8')).hexdigest()
+
+
+def key_digest(apikey):
+    """
+    Identify an API key without storing it
+
+    :param apikey: API key
+
+    Returns:
+        String. First 16 hex digits of the SHA-256 of the key
+    """
+
+    return hash_key(apikey)[:16]
+
+
+class ApiKeyStore(object):
+    """
+    API keys of the clients, stored hashed in a MongoDB collection with
+    their name, scopes, rate limit and priority lane.
+
+    Each API process keeps the keys it verified in a bounded LRU for
+    KEY_CACHE_TTL seconds, and unknown keys for KEY_NEGATIVE_TTL, so
+    requests are verified without a read. Every KEY_REVOCATION_INTERVAL
+    seconds a process reads the keys revoked since its last read and
+    drops them, so a revoked key stops working everywhere within that
+    interval.
+    """
+
+    def __init__(self, app, collection=KEY_COLLECTION,
+                 maxsize=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL,
+                 negative_ttl=KEY_NEGATIVE_TTL,
+                 revocation_interval=KEY_REVOCATION_INTERVAL, token=TOKEN):
+        """
+        :param token: key with every scope, not stored OR None
+        """
+
+        self.app = app
+        self.collection_name = collection
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.revocation_interval = revocation_interval
+        self._token = hash_key(token) if token else None
+        self._lock = Lock()
+        # hashed key: (trusted until, record OR None)
+        self._local = OrderedDict()
+        self._polled = time()
+        self._polled_at = datetime.utcnow()
+        self._collection = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            collection = self.app.backend.database[self.collection_name]
+            collection.create_index('name')
+            collection.create_index('revoked_at', sparse=True)
+            self._collection = collection
+        return self._collection
+
+    @staticmethod
+    def record(digest, document):
+        """
+        Verified key, as seen by the routes
+
+        :param digest: hashed key
+        :param document: stored key
+
+        Returns:
+            Dictionary. Name, scopes, rate limit and priority lane of the
+            key, the limit and lane of RATE_LIMITS_BY_KEY and
+            PRIORITY_LANES_BY_KEY when the key has none
+        """
+
+        return {'name': document.get('name', digest[:16]),
+                'key_digest': digest[:16],
+                'scopes': frozenset(document.get('scopes', [])),
+                'rate_limit': document.get('rate_limit') or
+                RATE_LIMITS_BY_KEY.get(digest[:16]),
+                'lane': document.get('lane') or
+                PRIORITY_LANES_BY_KEY.get(digest[:16])}
+
+    def verify(self, apikey):
+        """
+        Verify an API key, reading the collection only for keys not seen
+        recently
+
+        :param apikey: API key of a request
+
+        Returns:
+            Dictionary. The verified key (see record) OR None for an
+            unknown, revoked or expired key
+        """
+
+        digest = hash_key(apikey)
+        if self._token and compare_digest(digest, self._token):
+            return self.record(digest, {'name': 'token', 'scopes': SCOPES})
+
+        now = time()
+        self._poll_revocations(now)
+
+        with self._lock:
+            cached = self._local.get(digest)
+            if cached is not None and cached[0] > now:
+                self._local.move_to_end(digest)
+                return cached[1]
+
+        try:
+            document = self.collection.find_one({'_id': digest,
+                                                 'revoked_at': None})
+        except Exception as e:
+            # unverified keys are rejected, and checked again next time
+            log.info("API key not verified: {}".format(e))
+            return None
+
+        record = None
+        ttl = self.negative_ttl
+        if document is not None and compare_digest(document['_id'], digest):
+            ttl = self.ttl
+            expires_at = document.get('expires_at')
+            if expires_at is not None:
+                ttl = min(ttl, (expires_at - datetime.utcnow())
+                          .total_seconds())
+            if ttl > 0:
+                record = self.record(digest, document)
+            else:
+                ttl = self.negative_ttl
+
+        with self._lock:
+            self._local[digest] = (now + ttl, record)
+            self._local.move_to_end(digest)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+        return record
+
+    def _poll_revocations(self, now):
+        """
+        Drop the keys revoked by any process since the last poll
+        """
+
+        with self._lock:
+            if now - self._polled < self.revocation_interval:
+                return
+            # revocations of hosts with a late clock are not missed
+            since = self._polled_at - \
+                timedelta(seconds=self.revocation_interval)
+            self._polled = now
+            self._polled_at = datetime.utcnow()
+
+        try:
+            revoked = [document['_id'] for document in self.collection.find(
+                {'revoked_at': {'$gte': since}}, {'_id': 1})]
+        except Exception as e:
+            log.info("Revoked API keys not read: {}".format(e))
+            return
+
+        self.evict(revoked)
+
+    def evict(self, digests):
+        with self._lock:
+            for digest in digests:
+                self._local.pop(digest, None)
+
+    def create(self, name, scopes=SCOPES, rate_limit=None, lane=None,
+               expires_at=None):
+        """
+        Store a new API key
+
+        :param name: name of the client, e.g. scanner
+        :param scopes: scopes of the key, see SCOPES
+        :param rate_limit: rate limits of the key, e.g. '100/minute'
+                           OR None for RATE_LIMIT
+        :param lane: highest priority lane of the key OR None
+        :param expires_at: UTC time the key stops working OR None
+
+        Returns:
+            String. The API key, only known to its client from now on
+        """
+
+        unknown = set(scopes) - set(SCOPES)
+        if unknown:
+            raise ValueError('unknown scopes: {}'.format(sorted(unknown)))
+
+        apikey = token_urlsafe(32)
+        self.collection.insert_one({
+            '_id': hash_key(apikey),
+            'name': name,
+            'scopes': list(scopes),
+            'rate_limit': rate_limit,
+            'lane': lane,
+            'created_at': datetime.utcnow(),
+            'expires_at': expires_at,
+            'revoked_at': None
+        })
+        return apikey
+
+    def revoke(self, name):
+        """
+        Revoke the keys of a client, in every API process within
+        KEY_REVOCATION_INTERVAL seconds
+
+        :param name: name of the client OR hashed key
+
+        Returns:
+            Integer. Number of keys revoked
+        """
+
+        query = {'$or': [{'name': name}, {'_id': name}], 'revoked_at': None}
+        digests = [document['_id'] for document
+                   in self.collection.find(query, {'_id': 1})]
+        revoked = self.collection.update_many(
+            {'_id': {'$in': digests}, 'revoked_at': None},
+            {'$set': {'revoked_at': datetime.utcnow()}}).modified_count
+        self.evict(digests)
+        return revoked
+
+    def rotate(self, name, grace=KEY_ROTATION_GRACE):
+        """
+        Replace the keys of a client with a new key of the same scopes,
+        rate limit and lane. The old keys keep working for grace seconds
+
+        :param name: name of the client
+        :param grace: seconds the old keys keep working
+
+        Returns:
+            String. The new API key OR None for an unknown client
+        """
+
+        current = list(self.collection.find({'name': name,
+                                             'revoked_at': None})
+                       .sort('created_at', -1).limit(1))
+        if not current:
+            return None
+
+        expires_at = datetime.utcnow() + timedelta(seconds=grace)
+        self.collection.update_many(
+            {'name': name, 'revoked_at': None,
+             '$or': [{'expires_at': None},
+                     {'expires_at': {'$gt': expires_at}}]},
+            {'$set': {'expires_at': expires_at}})
+        return self.create(name, current[0].get('scopes', SCOPES),
+                           current[0].get('rate_limit'),
+                           current[0].get('lane'))
+
+
+api_keys = ApiKeyStore(tasks_app)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Manage the API keys of the '
+                                        'clients')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    create = commands.add_parser('create', help='print a new key')
+    create.add_argument('name', help='name of the client')
+    create.add_argument('--scopes', default=','.join(SCOPES),
+                        help='comma separated scopes among {}'
+                        .format(', '.join(SCOPES)))
+    create.add_argument('--rate-limit', help="e.g. '1000/hour;50/minute'")
+    create.add_argument('--lane', help='highest priority lane, e.g. batch')
+
+    rotate = commands.add_parser('rotate', help='print a new key, the old '
+                                                'ones expiring')
+    rotate.add_argument('name', help='name of the client')
+    rotate.add_argument('--grace', type=int, default=KEY_ROTATION_GRACE,
+                        help='seconds the old keys keep working')
+
+    revoke = commands.add_parser('revoke', help='revoke the keys of a '
+                                                'client')
+    revoke.add_argument('name', help='name of the client OR hashed key')
+
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        print(api_keys.create(args.name, args.scopes.split(','),
+                              args.rate_limit, args.lane))
+    elif args.command == 'rotate':
+        print(api_keys.rotate(args.name, args.grace))
+    else:
+        print(api_keys.revoke(args.name))
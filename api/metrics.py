@@ -0,0 +1,117 @@
+from os import environ
+from time import perf_counter, time
+from celery.signals import before_task_publish
+from flask import Response, g, request
+from prometheus_client import CollectorRegistry, Counter, Histogram, \
+    REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+from settings import METRICS_BUCKETS
+
+request_seconds = Histogram(
+    'api_request_duration_seconds',
+    'Time to answer an API request, up to the first byte of a stream',
+    ['endpoint', 'method', 'status'], buckets=METRICS_BUCKETS)
+
+rate_limited = Counter(
+    'api_rate_limited_total',
+    'Requests rejected by the rate limits', ['endpoint'])
+
+lookup_seconds = Histogram(
+    'api_lookup_duration_seconds',
+    'Time from publishing a service lookup to its result',
+    ['service'], buckets=METRICS_BUCKETS)
+
+lookup_errors = Counter(
+    'api_lookup_errors_total',
+    'Service lookups finished with an error', ['service'])
+
+lookup_timeouts = Counter(
+    'api_lookup_timeouts_total',
+    'Service lookups without a result in time', ['service'])
+
+cache_lookups = Counter(
+    'api_lookup_cache_total',
+    'Lookup cache reads by result: local_hits, shared_hits or misses',
+    ['service', 'result'])
+
+key_requests = Counter(
+    'api_key_requests_total',
+    'Authenticated requests by API key name', ['key'])
+
+
+@before_task_publish.connect
+def mark_sent(headers=None, **kwargs):
+    """
+    Stamp each published task message with its send time, so the
+    workers can tell the time it waited in the broker queue
+    """
+
+    if headers is not None:
+        headers['sent_at'] = time()
+
+
+def metrics_registry():
+    """
+    Returns:
+        The registry of this process OR a registry collecting the
+        metrics of every gunicorn worker in PROMETHEUS_MULTIPROC_DIR
+    """
+
+    if 'PROMETHEUS_MULTIPROC_DIR' not in environ:
+        return REGISTRY
+
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_response():
+    """
+    Returns:
+        The metrics in the Prometheus text format
+    """
+
+    return Response(generate_latest(metrics_registry()),
+                    content_type=CONTENT_TYPE_LATEST)
+
+
+def start_timer():
+    g.metrics_started = perf_counter()
+
+
+def observe_request(response):
+    """
+    Record the latency and status of the current request
+
+    :param response: response of the request
+
+    Returns:
+        The response unchanged
+    """
+
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+
+    # rejected requests never reach start_timer
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        request_seconds.labels(endpoint, request.method,
+                               response.status_code).observe(
+            perf_counter() - started)
+
+    if response.status_code == 429:
+        rate_limited.labels(endpoint).inc()
+
+    return response
+
+
+def instrument(app):
+    """
+    Time every request of a Flask app and serve the metrics at
+    /api/metrics, outside of the rate limited blueprint
+
+    :param app: Flask app
+    """
+
+    app.before_request(start_timer)
+    app.after_request(observe_request)
+    app.add_url_rule('/api/metrics', 'metrics', metrics_response)
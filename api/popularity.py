@@ -0,0 +1,190 @@
+from array import array
+from datetime import datetime
+from hashlib import blake2b
+from logging import getLogger
+from threading import Lock
+from time import time
+from pymongo import UpdateOne
+from backend import tasks_app
+from cache import normalize_host
+from registry import service_registry
+from settings import POPULARITY_WIDTH, POPULARITY_DEPTH, POPULARITY_TOP_K, \
+    POPULARITY_FLUSH_INTERVAL, POPULARITY_DECAY_INTERVAL, \
+    POPULARITY_COLLECTION, CACHE_TTLS, CACHE_STALE
+
+log = getLogger(__name__)
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of many keys in a fixed amount of memory.
+
+    Each key increments one counter in each of depth rows; its count is
+    the smallest of them, never below the true count. Halving every
+    counter (decay) lets recent lookups outweigh old ones.
+    """
+
+    def __init__(self, width=POPULARITY_WIDTH, depth=POPULARITY_DEPTH):
+        self.width = width
+        self.depth = depth
+        self._rows = [array('f', bytes(4 * width)) for _ in range(depth)]
+
+    def _columns(self, key):
+        digest = blake2b(key.encode('utf-8'), digest_size=4 * self.depth) \
+            .digest()
+        return [int.from_bytes(digest[4 * row:4 * row + 4], 'little') %
+                self.width for row in range(self.depth)]
+
+    def add(self, key, count=1):
+        """
+        :param key: counted key
+        :param count: occurrences to add
+
+        Returns:
+            Float. The estimated count of the key
+        """
+
+        estimate = None
+        for row, column in zip(self._rows, self._columns(key)):
+            row[column] += count
+            estimate = row[column] if estimate is None \
+                else min(estimate, row[column])
+        return estimate
+
+    def estimate(self, key):
+        return min(row[column] for row, column
+                   in zip(self._rows, self._columns(key)))
+
+    def decay(self, factor=0.5):
+        self._rows = [array('f', (count * factor for count in row))
+                      for row in self._rows]
+
+
+class HostPopularity(object):
+    """
+    Most looked up (service, host) pairs of an API process.
+
+    Lookups are counted in a Count-Min sketch; the POPULARITY_TOP_K keys
+    with the highest counts are tracked with the lookups made since the
+    last flush, added every POPULARITY_FLUSH_INTERVAL seconds to the
+    scores of a MongoDB collection shared by every process. Celery beat
+    refreshes the results of the top scores before they expire, see
+    refresh_hot_hosts of the task workers.
+    """
+
+    def __init__(self, app, collection=POPULARITY_COLLECTION,
+                 top_k=POPULARITY_TOP_K,
+                 flush_interval=POPULARITY_FLUSH_INTERVAL,
+                 decay_interval=POPULARITY_DECAY_INTERVAL):
+        self.app = app
+        self.collection_name = collection
+        self.top_k = top_k
+        self.flush_interval = flush_interval
+        self.decay_interval = decay_interval
+        self.sketch = CountMinSketch()
+        self._lock = Lock()
+        # key: [estimate, lookups since the last flush, service, host,
+        # host_type]
+        self._top = {}
+        self._flushed = time()
+        self._decayed = time()
+        self._collection = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            collection = self.app.backend.database[self.collection_name]
+            collection.create_index('score')
+            self._collection = collection
+        return self._collection
+
+    def _admit(self, estimate):
+        """
+        Make room for a key of the given count among the top keys
+
+        Returns:
+            Boolean. The key is tracked, in place of the coldest one
+            when the top keys are full
+        """
+
+        if len(self._top) < self.top_k:
+            return True
+
+        coldest = min(self._top, key=lambda key: self._top[key][0])
+        if self._top[coldest][0] >= estimate:
+            return False
+        del self._top[coldest]
+        return True
+
+    def record(self, service, host, host_type):
+        """
+        Count a lookup, flushing the top keys when the interval passed
+
+        :param service: name of the service
+        :param host: ip or domain name
+        :param host_type: 'IP' or 'DOMAIN'
+        """
+
+        host = normalize_host(host)
+        key = '{}:{}'.format(service.upper(), host)
+        now = time()
+
+        with self._lock:
+            estimate = self.sketch.add(key)
+            entry = self._top.get(key)
+            if entry is None and self._admit(estimate):
+                entry = self._top[key] = [0, 0, service.upper(), host,
+                                          host_type]
+            if entry is not None:
+                entry[0] = estimate
+                entry[1] += 1
+
+            if now - self._decayed >= self.decay_interval:
+                self.sketch.decay()
+                for tracked in self._top.values():
+                    tracked[0] /= 2
+                self._decayed = now
+
+            if now - self._flushed < self.flush_interval:
+                return
+            pending = [(key, entry[1:]) for key, entry in self._top.items()
+                       if entry[1]]
+            for tracked in self._top.values():
+                tracked[1] = 0
+            self._flushed = now
+
+        self.flush(pending)
+
+    def flush(self, pending):
+        """
+        Add the lookups of the top keys to their shared scores, with what
+        the task workers need to refresh them
+
+        :param pending: list of (key, [lookups, service, host, host_type])
+        """
+
+        if not pending:
+            return
+
+        requests = []
+        for key, (lookups, service, host, host_type) in pending:
+            signature = service_registry.signature(service, host, host_type)
+            requests.append(UpdateOne({'_id': key}, {
+                '$inc': {'score': lookups},
+                '$set': {'service': service,
+                         'host': host,
+                         'task': signature.task,
+                         'args': list(signature.args),
+                         'queue': signature.options['queue'],
+                         'ttl': CACHE_TTLS.get(service, 0),
+                         'stale': CACHE_STALE.get(service, 0),
+                         'updated_at': datetime.utcnow()}
+            }, upsert=True))
+
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except Exception as e:
+            log.info("Host popularity not flushed: {}".format(e))
+
+
+host_popularity = HostPopularity(tasks_app)
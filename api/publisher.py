@@ -0,0 +1,170 @@
+from logging import getLogger
+from os import getpid
+from socket import timeout
+from threading import Lock
+from time import monotonic
+from weakref import WeakKeyDictionary
+
+from backend import tasks_app
+from settings import PUBLISH_CONFIRM, PUBLISH_CONFIRM_TIMEOUT
+
+log = getLogger(__name__)
+
+
+class PublishError(Exception):
+    """
+    The broker rejected or did not confirm a batch of task messages
+    """
+
+
+class Confirms(object):
+    """
+    Delivery tags of a channel in confirm mode, not yet acknowledged
+    """
+
+    def __init__(self, channel):
+        self.tag = 0
+        self.unconfirmed = set()
+        self.nacked = 0
+        channel.events['basic_ack'].add(self.on_ack)
+        channel.events['basic_nack'].add(self.on_nack)
+
+    def published(self):
+        self.tag += 1
+        self.unconfirmed.add(self.tag)
+
+    def _settle(self, delivery_tag, multiple):
+        tags = {tag for tag in self.unconfirmed if tag <= delivery_tag} \
+            if multiple else {delivery_tag} & self.unconfirmed
+        self.unconfirmed -= tags
+        return len(tags)
+
+    def on_ack(self, delivery_tag, multiple):
+        self._settle(delivery_tag, multiple)
+
+    def on_nack(self, delivery_tag, multiple):
+        self.nacked += self._settle(delivery_tag, multiple)
+
+
+class TaskPublisher(object):
+    """
+    Publish the tasks of a request as a single batch.
+
+    Each gunicorn worker keeps a pool of producers on open broker
+    connections (warmed when the worker starts, see gunicorn.conf.py).
+    A batch holds one producer, publishes every message without waiting,
+    then awaits the publisher confirms of the whole batch at once. Nothing
+    is read from the result backend.
+    """
+
+    def __init__(self, app, confirm=PUBLISH_CONFIRM,
+                 timeout=PUBLISH_CONFIRM_TIMEOUT):
+        self.app = app
+        self.confirm = confirm
+        self.timeout = timeout
+        self._lock = Lock()
+        self._pid = None
+        self._confirms = WeakKeyDictionary()
+
+    def _channel_confirms(self, channel):
+        """
+        Put a channel in confirm mode once, on brokers supporting it
+
+        :param channel: channel of a producer
+
+        Returns:
+            Confirms of the channel OR None without publisher confirms
+        """
+
+        if not self.confirm or not hasattr(channel, 'confirm_select'):
+            return None
+
+        with self._lock:
+            if self._pid != getpid():
+                # connections of the parent process are not shared
+                self._pid = getpid()
+                self._confirms = WeakKeyDictionary()
+
+        confirms = self._confirms.get(channel)
+        if confirms is None:
+            channel.confirm_select()
+            confirms = self._confirms[channel] = Confirms(channel)
+        return confirms
+
+    def warm(self):
+        """
+        Open a broker connection and channel of the producer pool, so the
+        first request of the worker does not pay for them
+        """
+
+        try:
+            with self.app.producer_or_acquire() as producer:
+                producer.connection.ensure_connection(max_retries=1)
+                self._channel_confirms(producer.channel)
+            log.info("Producer pool of {} ready".format(getpid()))
+        except Exception as e:
+            log.info("Producer pool not warmed: {}".format(e))
+
+    def _wait(self, producer, confirms):
+        deadline = monotonic() + self.timeout
+        while confirms.unconfirmed:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                missing = len(confirms.unconfirmed)
+                confirms.unconfirmed.clear()
+                raise PublishError('{} task messages not confirmed after {}s'
+                                   .format(missing, self.timeout))
+            try:
+                producer.connection.drain_events(timeout=remaining)
+            except timeout:
+                pass
+
+    def publish(self, signatures):
+        """
+        Publish task signatures over a single pooled producer and await
+        their publisher confirms once
+
+        :param signatures: Celery signatures, with their task_id and queue
+
+        Returns:
+            List - the task id of each signature
+
+        Raises:
+            PublishError when the broker rejects a message or does not
+            confirm the batch in time
+        """
+
+        task_ids = []
+        if not signatures:
+            return task_ids
+
+        with self.app.producer_or_acquire() as producer:
+            confirms = self._channel_confirms(producer.channel)
+            if confirms is not None:
+                confirms.nacked = 0
+            for signature in signatures:
+                channel = producer.channel
+                result = self.app.send_task(signature.task,
+                                            args=signature.args,
+                                            kwargs=signature.kwargs,
+                                            producer=producer,
+                                            **signature.options)
+                task_ids.append(result.id)
+
+                if producer.channel is not channel:
+                    # reconnected while publishing: the message went out
+                    # before the new channel was in confirm mode
+                    confirms = self._channel_confirms(producer.channel)
+                elif confirms is not None:
+                    confirms.published()
+
+            if confirms is not None:
+                self._wait(producer, confirms)
+                if confirms.nacked:
+                    raise PublishError('{} task messages rejected'.format(
+                        confirms.nacked))
+
+        return task_ids
+
+
+task_publisher = TaskPublisher(tasks_app)
@@ -0,0 +1,89 @@
+from threading import Lock
+from time import time
+from limits.storage import Storage, storage_from_string
+from settings import RATELIMIT_BATCH, RATELIMIT_FLUSH_INTERVAL
+
+
+class BatchedStorage(Storage):
+    """
+    Fixed window rate limit counters batched in each process in front of
+    a shared limits storage, e.g. batched+mongodb://mongo:27017.
+
+    Hits are counted locally and added to the shared counter once
+    RATELIMIT_BATCH of them accumulated or RATELIMIT_FLUSH_INTERVAL
+    seconds passed, so the shared store sees a fraction of the requests.
+    The first hit of a window is always flushed; a process can let at
+    most RATELIMIT_BATCH - 1 requests through unseen by the others.
+    """
+
+    STORAGE_SCHEME = ['batched+memory', 'batched+mongodb',
+                      'batched+mongodb+srv', 'batched+redis']
+
+    def __init__(self, uri, batch=RATELIMIT_BATCH,
+                 flush_interval=RATELIMIT_FLUSH_INTERVAL, **options):
+        super().__init__(uri)
+        self.shared = storage_from_string(uri.split('+', 1)[1], **options)
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        # key: [shared count, window reset, unflushed hits, last flush]
+        self._windows = {}
+
+    @property
+    def base_exceptions(self):
+        return self.shared.base_exceptions
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        now = time()
+
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or window[1] <= now:
+                window = self._windows[key] = [0, now + expiry, 0, None]
+            window[2] += amount
+
+            flush = window[3] is None or window[2] >= self.batch or \
+                now - window[3] >= self.flush_interval
+            if not flush:
+                return window[0] + window[2]
+
+            pending, window[2], window[3] = window[2], 0, now
+
+        try:
+            count = self.shared.incr(key, expiry, amount=pending)
+            reset = self.shared.get_expiry(key)
+        except Exception:
+            with self._lock:
+                window[2] += pending
+            raise
+
+        with self._lock:
+            window[0], window[1] = count, reset
+            return count + window[2]
+
+    def get(self, key):
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None and window[1] > time():
+                return window[0] + window[2]
+        return self.shared.get(key)
+
+    def get_expiry(self, key):
+        with self._lock:
+            window = self._windows.get(key)
+            if window is not None and window[1] > time():
+                return window[1]
+        return self.shared.get_expiry(key)
+
+    def check(self):
+        return self.shared.check()
+
+    def reset(self):
+        with self._lock:
+            self._windows.clear()
+        return self.shared.reset()
+
+    def clear(self, key):
+        with self._lock:
+            self._windows.pop(key, None)
+        self.shared.clear(key)
@@ -0,0 +1,44 @@
+from backend import tasks_app
+from publisher import task_publisher
+from registry import service_registry
+from validators import ipv4
+from settings import IP, DOMAIN, BACKGROUND, PRIORITY_LANES
+
+
+def store_signature(key, service, host, ttl, stale):
+    """
+    Celery signature of the task storing the result of a refresh in the
+    lookup cache, linked to the lookup task (see tasks.store_lookup)
+
+    :param key: cache key of the lookup
+    :param service: name of the service
+    :param host: normalized ip or domain name
+    :param ttl: seconds the result is fresh
+    :param stale: seconds the result is served stale after that
+
+    Returns:
+        Celery signature, called with the result of the lookup
+    """
+
+    return tasks_app.signature('tasks.store_lookup',
+                               args=(key, service, host, ttl, stale),
+                               priority=PRIORITY_LANES[BACKGROUND])
+
+
+def refresh_lookup(key, service, host, ttl, stale):
+    """
+    Publish a background lookup of a stale cache entry. Its result is
+    written to the cache by the workers, nobody waits for it.
+
+    :param key: cache key of the lookup
+    :param service: name of the service
+    :param host: normalized ip or domain name
+    :param ttl: seconds the result is fresh
+    :param stale: seconds the result is served stale after that
+    """
+
+    host_type = IP if ipv4(host) else DOMAIN
+    signature = service_registry.signature(
+        service, host, host_type, priority=PRIORITY_LANES[BACKGROUND])
+    signature.link(store_signature(key, service, host, ttl, stale))
+    task_publisher.publish([signature])
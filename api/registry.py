@@ -0,0 +1,92 @@
+from collections import namedtuple
+from backend import tasks_app
+from settings import SERVICE_REGISTRY
+
+Service = namedtuple('Service', ['name', 'task', 'queue', 'timeout',
+                                 'host_types', 'args', 'cache_ttl',
+                                 'cache_stale'])
+
+
+class ServiceRegistry(object):
+    """
+    Lookup services by name, declared in SERVICE_REGISTRY.
+
+    Validation and dispatch of a lookup are a dictionary access, and a
+    new service only needs its entry and its task.
+    """
+
+    def __init__(self, app, services=SERVICE_REGISTRY):
+        self.app = app
+        self._services = {name.upper(): Service(name.upper(), **spec)
+                          for name, spec in services.items()}
+
+    def names(self, host_type=None):
+        """
+        :param host_type: 'IP' or 'DOMAIN' OR None for every service
+
+        Returns:
+            List. Names of the services applying to the host type
+        """
+
+        return [name for name, service in self._services.items()
+                if host_type is None or host_type in service.host_types]
+
+    def get(self, name):
+        """
+        :param name: name of a service, in any case
+
+        Returns:
+            Service OR None for an unknown service
+        """
+
+        if not isinstance(name, str):
+            return None
+        return self._services.get(name.upper())
+
+    def timeout(self, name):
+        return self._services[name.upper()].timeout
+
+    def budget(self, name, deadline=None):
+        """
+        :param name: name of the service
+        :param deadline: seconds left to the caller OR None
+
+        Returns:
+            Float. Seconds the lookup is waited for, at most its timeout
+        """
+
+        timeout = self.timeout(name)
+        return timeout if deadline is None else min(deadline, timeout)
+
+    def signature(self, name, host, host_type, deadline=None,
+                  priority=None):
+        """
+        Build the Celery task signature of a service lookup. Its message
+        expires and its run is stopped (soft time limit) once the caller
+        stopped waiting, so workers do not spend time on stale lookups.
+
+        :param name: name of the service
+        :param host: ip or domain name
+        :param host_type: 'IP' or 'DOMAIN'
+        :param deadline: seconds left to the caller OR None for the
+            timeout of the service
+        :param priority: message priority OR None for the default one
+
+        Returns:
+            Celery signature of the lookup task, sent to its queue
+        """
+
+        service = self._services[name.upper()]
+        values = {'host': host, 'host_type': host_type}
+        budget = self.budget(name, deadline)
+        return self.app.signature(service.task,
+                                  args=tuple(values[arg]
+                                             for arg in service.args),
+                                  queue=service.queue,
+                                  expires=budget,
+                                  soft_time_limit=budget,
+                                  priority=self.app.conf.task_default_priority
+                                  if priority is None else priority)
+
+
+service_registry = ServiceRegistry(tasks_app)
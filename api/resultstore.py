@@ -0,0 +1,52 @@
+from zlib import compress, decompress
+from bson.binary import Binary
+from celery.backends.mongodb import MongoBackend, BINARY_CODECS
+from settings import RESULT_COMPRESS_THRESHOLD, RESULT_COMPRESS_LEVEL
+
+# BSON binary subtype of compressed results (128-255 are user defined)
+COMPRESSED_SUBTYPE = 0x80
+
+
+class CompressedMongoBackend(MongoBackend):
+    """
+    MongoDB result backend storing results larger than
+    RESULT_COMPRESS_THRESHOLD bytes zlib compressed.
+
+    Same format as the backend of the task workers (tasks/resultstore.py):
+    compressed results are BSON binaries of subtype COMPRESSED_SUBTYPE,
+    smaller results are stored as before.
+    """
+
+    def encode(self, data):
+        payload = super().encode(data)
+
+        raw = payload.encode('utf-8') if isinstance(payload, str) \
+            else payload
+        if isinstance(raw, bytes) and len(raw) > RESULT_COMPRESS_THRESHOLD:
+            return Binary(compress(raw, RESULT_COMPRESS_LEVEL),
+                          COMPRESSED_SUBTYPE)
+
+        return payload
+
+    def decode(self, data):
+        if isinstance(data, Binary) and data.subtype == COMPRESSED_SUBTYPE:
+            data = decompress(data)
+            if self.serializer not in BINARY_CODECS:
+                data = data.decode('utf-8')
+
+        return super().decode(data)
+
+
+def backend_url(url):
+    """
+    Select the compressed backend for a mongodb result backend URL
+
+    :param url: result backend URL
+
+    Returns:
+        String. Backend URL understood by Celery
+    """
+
+    if url and url.startswith('mongodb'):
+        return 'resultstore:CompressedMongoBackend+' + url
+    return url
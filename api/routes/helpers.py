@@ -1,6 +1,24 @@
-from flask import request
+from flask import g, request
+from flask_limiter.util import get_remote_address
 from functools import wraps
-from settings import TOKEN
+from keystore import api_keys
+from metrics import key_requests
+from settings import RATE_LIMIT
+
+
+def current_api_key():
+    """
+    Verify the API key of the current request, once per request
+
+    Returns:
+        Dictionary. The verified key (see ApiKeyStore.record) OR None
+    """
+
+    if 'api_key' not in g:
+        token = request.headers.get('X-API-KEY')
+        g.api_key = api_keys.verify(token) if token else None
+
+    return g.api_key
 
 
 def token_required(f):
@@ -8,29 +26,79 @@ def token_required(f):
     def decorated(*args, **kwargs):
         """
         Test user provided api token in the X-API-KEY key of the request.headers 
-        with the stored env variable token value
+        with the keys of the key store, counting the requests of each key
 
         :param token: api token
 
         Returns:
             The function is token is correct otherwise a JSON message containing the error
         """
-        token = None
 
-        if 'X-API-KEY' in request.headers:
-            token = request.headers['X-API-KEY']
-
-        if not token:
+        if not request.headers.get('X-API-KEY'):
             return {'message': 'missing token'}, 401
 
-        if token != TOKEN:
+        key = current_api_key()
+        if key is None:
             return {'message': 'incorrect token'}, 401
 
+        key_requests.labels(key['name']).inc()
+
         return f(*args, **kwargs)
 
     return decorated
 
 
+def scope_required(scope):
+    """
+    Reject the requests of keys without a scope, after token_required
+
+    :param scope: scope of the endpoint, see SCOPES
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = current_api_key()
+            if key is None or scope not in key['scopes']:
+                return {'message': 'insufficient scope'}, 403
+
+            return f(*args, **kwargs)
+
+        return decorated
+
+    return decorator
+
+
+def rate_limit_key():
+    """
+    Identify the client of the current request for rate limiting,
+    by its API key when it sent a valid one or by its IP address.
+    Invalid keys are ignored so they cannot be used to get fresh limits.
+
+    Returns:
+        String. Rate limit key
+    """
+
+    key = current_api_key()
+    if key:
+        return 'key:{}'.format(key['key_digest'])
+
+    return get_remote_address()
+
+
+def rate_limit():
+    """
+    Returns:
+        String. Rate limits of the client of the current request
+    """
+
+    key = current_api_key()
+    if key and key['rate_limit']:
+        return key['rate_limit']
+
+    return RATE_LIMIT
+
+
 def task_error(result):
     """
     Define a generic Celery task error
@@ -50,3 +118,106 @@ def task_error(result):
             'Unknown error occurred'
 
     return {'task_id': result.id, 'status': 'ERROR', 'desc': cause}, 500
+
+
+FIELDS_PARAM = {
+    'description': "Comma separated dotted paths of the results to "
+                   "return, e.g. 'rdap.entities,ping.packet_loss'. "
+                   "Lists are projected item by item",
+    'type': 'string'
+}
+
+
+def field_tree(paths):
+    """
+    Build the projection tree of dotted field paths
+
+    :param paths: list of dotted paths, e.g. ['rdap.entities.handle']
+
+    Returns:
+        Dictionary. Sub tree by key, None keeps the whole value
+    """
+
+    tree = {}
+    for path in paths:
+        node = tree
+        keys = [key for key in path.strip().split('.') if key]
+        for position, key in enumerate(keys):
+            if position == len(keys) - 1:
+                node[key] = None
+            elif key in node and node[key] is None:
+                # a shorter path already keeps the whole value
+                break
+            else:
+                node = node.setdefault(key, {})
+
+    return tree
+
+
+def fields_param():
+    """
+    Read the projection of the current request
+
+    Returns:
+        Dictionary. Projection tree of the 'fields' query parameter
+        OR None to return whole results
+    """
+
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+
+    return field_tree(fields.split(','))
+
+
+def project(data, tree):
+    """
+    Keep the parts of a result named by a projection tree
+
+    :param data: JSON result
+    :param tree: projection tree OR None for the whole result
+
+    Returns:
+        JSON - the projected result
+    """
+
+    if tree is None:
+        return data
+
+    if isinstance(data, list):
+        return [project(item, tree) for item in data]
+
+    if isinstance(data, dict):
+        return {key: project(data[key], subtree)
+                for key, subtree in tree.items() if key in data}
+
+    return data
+
+
+def project_lookup(entry, tree):
+    """
+    Project the results of a lookup on the paths of its service, the
+    first key of each path. Lookups of services without a path are
+    returned without results.
+
+    :param entry: lookup with 'service' and 'results'
+    :param tree: projection tree OR None for the whole lookup
+
+    Returns:
+        JSON - the projected lookup
+    """
+
+    if tree is None or 'results' not in entry:
+        return entry
+
+    service = str(entry.get('service', '')).lower()
+    paths = [subtree for key, subtree in tree.items()
+             if key.lower() == service]
+
+    projected = {key: value for key, value in entry.items()
+                 if key != 'results'}
+    if paths:
+        # error descriptions are strings and kept as they are
+        projected['results'] = project(entry['results'], paths[0])
+
+    return projected
@@ -0,0 +1,155 @@
+from datetime import datetime, timezone
+from flask import request
+from flask_restx import Namespace, Resource
+from history import lookup_history
+from routes.helpers import token_required, scope_required, FIELDS_PARAM, \
+    fields_param, project_lookup
+from routes.services import host_type_of
+from settings import HISTORY_PAGE_SIZE, HISTORY_PAGE_MAX, HISTORY_SCOPE
+
+# Set namespace
+ns = Namespace('history', description='Lookup history operations',
+               ordered=True)
+
+log = ns.logger
+
+TIME_PARAM = {
+    'description': 'ISO 8601 time, UTC unless it has an offset',
+    'type': 'string'
+}
+
+HISTORY_PARAMS = {
+    'host': {
+        'description': 'Specify an IP address or Domain name',
+        'default': '8.8.8.8'
+    },
+    'service': {
+        'description': 'Service of the lookups, repeat for more services',
+        'type': 'array',
+        'items': {'type': 'string'},
+        'collectionFormat': 'multi'
+    },
+    'since': dict(TIME_PARAM, description='Oldest lookup time, inclusive. '
+                                          + TIME_PARAM['description']),
+    'until': dict(TIME_PARAM, description='Newest lookup time, exclusive. '
+                                          + TIME_PARAM['description']),
+    'limit': {
+        'description': 'Lookups of a page, at most {}'
+                       .format(HISTORY_PAGE_MAX),
+        'type': 'integer',
+        'default': HISTORY_PAGE_SIZE
+    },
+    'cursor': {
+        'description': 'next_cursor of the previous page',
+        'type': 'string'
+    },
+    'fields': FIELDS_PARAM
+}
+
+
+def time_param(name):
+    """
+    Read a time of the current request
+
+    :param name: name of the query parameter
+
+    Returns:
+        Datetime. Naive UTC time OR None when the parameter is missing
+
+    Raises:
+        ValueError: the parameter is not an ISO 8601 time
+    """
+
+    value = request.args.get(name)
+    if not value:
+        return None
+
+    # fromisoformat does not read the Z suffix before Python 3.11
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def limit_param():
+    """
+    Returns:
+        Integer. Lookups of the page, at most HISTORY_PAGE_MAX
+
+    Raises:
+        ValueError: the 'limit' query parameter is not a positive integer
+    """
+
+    limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+    if limit <= 0:
+        raise ValueError(limit)
+    return min(limit, HISTORY_PAGE_MAX)
+
+
+# Define route resources
+@ns.route('/<host>', endpoint="/history/host")
+class LookupHistory(Resource):
+
+    @ns.doc(responses={
+            200: 'OK',
+            400: 'Invalid Argument'
+            },
+            security='apikey', params=HISTORY_PARAMS)
+    @token_required
+    @scope_required(HISTORY_SCOPE)
+    def get(self, host):
+        '''Returns the past lookups of a host, newest first
+        ***TOKEN AUTHORIZATION REQUIRED***'''
+
+        """
+        Read a page of the results of the completed lookups of a host
+
+        :param host: ip or domain name
+        :param service: services of the lookups, defaults to every service
+        :param since: oldest lookup time to return
+        :param until: newest lookup time to return, exclusive
+        :param limit: lookups of the page
+        :param cursor: next_cursor of the previous page
+        :param fields: paths of the results to return, e.g. rdap.entities
+
+        Returns:
+            JSON - the lookups of the page and the cursor of the next one,
+            None on the last page, OR error information
+        """
+
+        ns.logger.info("START {}".format(self.endpoint))
+
+        if host_type_of(host) is None:
+            ns.logger.info("END {}".format(self.endpoint))
+            return {'ERROR': 'invalid host: enter correct ip address or '
+                             'domain name'}, 400
+
+        try:
+            since, until = time_param('since'), time_param('until')
+        except ValueError:
+            ns.logger.info("END {}".format(self.endpoint))
+            return {'ERROR': 'since and until must be ISO 8601 times'}, 400
+
+        try:
+            limit = limit_param()
+        except ValueError:
+            ns.logger.info("END {}".format(self.endpoint))
+            return {'ERROR': 'limit must be a positive integer'}, 400
+
+        try:
+            entries, next_cursor = lookup_history.query(
+                host, request.args.getlist('service'), since, until, limit,
+                request.args.get('cursor') or None)
+        except ValueError:
+            ns.logger.info("END {}".format(self.endpoint))
+            return {'ERROR': 'invalid cursor'}, 400
+
+        ns.logger.info("END {}".format(self.endpoint))
+
+        fields = fields_param()
+        return {'host': host,
+                'history': [project_lookup(entry, fields)
+                            for entry in entries],
+                'next_cursor': next_cursor}, 200
@@ -1,9 +1,27 @@
-from backend import tasks_app
+from backend import tasks_app, task_priority
+from keystore import key_digest
+from cache import lookup_cache
+from inflight import inflight_lookups
+from celery import states
+from jobs import lookup_jobs
+from popularity import host_popularity
+from publisher import task_publisher
+from flask import request, stream_with_context, Response
+from hashlib import sha256
+from math import ceil
+from time import monotonic, time
 from flask_restx import Resource, fields, Namespace
-from routes.helpers import token_required
+from routes.helpers import token_required, scope_required, \
+    current_api_key, FIELDS_PARAM, fields_param, project_lookup
+from representation import dumps_json
 from validators import ipv4, domain
-from settings import SERVICES, PING, RDAP, IP, DOMAIN, \
-    SAMPLE_DOMAIN, SAMPLE_APIKEY
+from registry import service_registry
+from settings import VIRUSTOTAL, IP, DOMAIN, LOOKUP_DEADLINE, TIMEOUT, \
+    INTERACTIVE, BATCH, BACKGROUND, LOOKUP_SCOPE, ADMIN_SCOPE, \
+    VIRUSTOTAL_UNFINISHED_REUSE, VIRUSTOTAL_BUCKET_COLLECTION, \
+    BULK_MAX_HOSTS, BULK_MAX_IN_FLIGHT, SAMPLE_DOMAIN, SAMPLE_APIKEY
+from watcher import watcher
+from metrics import lookup_seconds, lookup_errors, lookup_timeouts
 
 
 # Set namespace
@@ -15,6 +33,36 @@ log = ns.logger
 service_json = fields.List(fields.String(required=False, example='ping'))
 service_model = ns.model('Service arguments', {'services': service_json})
 
+bulk_model = ns.model('Bulk arguments', {
+    'hosts': fields.List(fields.String(example='8.8.8.8'), required=True,
+                         description='IP addresses or Domain names'),
+    'services': service_json,
+    'max_in_flight': fields.Integer(required=False,
+                                    description='Maximum number of tasks '
+                                                'processed at once',
+                                    example=BULK_MAX_IN_FLIGHT)
+})
+
+CACHE_PARAM = {
+    'description': "Set to 'false' to bypass cached lookup results",
+    'type': 'boolean',
+    'default': True
+}
+
+DEADLINE_PARAM = {
+    'description': 'Seconds to wait for the whole lookup, unfinished '
+                   'services are returned with the status timeout',
+    'type': 'number',
+    'default': LOOKUP_DEADLINE
+}
+
+MODE_PARAM = {
+    'description': "Set to 'async' to return a job id at once, "
+                   "see /tasks/job/{job_id}",
+    'enum': ['sync', 'async'],
+    'default': 'sync'
+}
+
 virustotal_model = ns.model('Virustotal arguments', {
     'apikey': fields.String(required=True,
                             description='Your API key',
@@ -25,136 +73,537 @@ virustotal_model = ns.model('Virustotal arguments', {
 })
 
 
-def service_available(service):
+def host_type_of(host):
+    """
+    Validate an IP or Domain
+
+    :param host: ip or domain name
+
+    Returns:
+        'IP', 'DOMAIN' OR None for an invalid host
+    """
+
+    if ipv4(host):
+        return IP
+    elif domain(host):
+        return DOMAIN
+
+    return None
+
+
+def cache_enabled():
+    """
+    Check if the current request allows the lookup cache
+
+    Returns:
+        Boolean evaulation of the 'cache' query parameter
+    """
+
+    return request.args.get('cache', 'true').lower() != 'false'
+
+
+def deadline_param():
+    """
+    Read the deadline of the current request, at most LOOKUP_DEADLINE
+
+    Returns:
+        Float. Seconds to wait for the lookup OR None for an invalid value
+    """
+
+    try:
+        deadline = float(request.args.get('deadline', LOOKUP_DEADLINE))
+    except ValueError:
+        return None
+
+    if not 0 < deadline < float('inf'):
+        return None
+    return min(deadline, LOOKUP_DEADLINE)
+
+
+def request_priority(lane):
+    """
+    Priority of the tasks published by the current request
+
+    :param lane: priority lane of the endpoint
+
+    Returns:
+        Integer. Message priority for the lane and the API key
+    """
+
+    key = current_api_key()
+    return task_priority(lane, key['lane'] if key else None)
+
+
+def service_available(service, host_type=None):
     """
     Check if a user provided service is available to process
 
     :param service: name of the the service
+    :param host_type: 'IP' or 'DOMAIN' the service must apply to
 
     Returns:
         Boolean evaulation.
     """
 
-    for svc in SERVICES:
-        if service.lower() == svc.lower():
-            return True
+    found = service_registry.get(service)
+    return found is not None and \
+        (host_type is None or host_type in found.host_types)
+
 
-    return False
+def invalid_service(service, host_type):
+    """
+    Describe why a service cannot look up a host
 
+    :param service: name of the the service
+    :param host_type: 'IP' or 'DOMAIN'
 
-def do_service(host, list_of_services, host_type):
+    Returns:
+        String. Result of the rejected lookup
     """
-    Gathers information from multiple sources.
-    Process each service lookup on different Celery
-    task workers to perform the action.
 
+    if service_available(service):
+        return 'invalid service for {}'.format(host_type)
+    return 'invalid service'
+
+
+def lookup_failed(result_output):
+    """
+    Check if a lookup result is an error that must not be cached
+
+    :param result_output: result of a lookup task
+
+    Returns:
+        Boolean evaulation.
+    """
+
+    return isinstance(result_output, dict) and \
+        result_output.get('status') == 'ERROR'
+
+
+def task_output(service, host, meta, store=True):
+    """
+    Extract the lookup result of a finished task and cache it
+
+    :param service: name of the service
     :param host: ip or domain name
-    :param list_of_services: a list of sevices to lookup
-    :param host_type: 'IP' or 'DOMAIN'
+    :param meta: task meta data OR None if the task did not complete
+    :param store: write a successful result to the lookup cache
 
     Returns:
-        JSON - Combine the results and return a single payload
+        JSON - lookup result OR error description
     """
 
-    task_ids = []
-    response = []
+    if meta is None:
+        ns.logger.info("Celery task didn't complete: Celery may be down.")
+        return 'The operation timed out.'
 
-    # Process each service and add to a task queue
-    for service in list_of_services:
-        if service_available(service):
+    if meta['status'] == states.SUCCESS:
+        result_output = meta['result']
+        if store and not lookup_failed(result_output):
+            lookup_cache.set(service, host, result_output)
+        return result_output
 
-            ns.logger.info("START {}".format(service))
+    return str(meta['result'])
 
-            if service.upper() == PING:
 
-                """
-                Process ping service
-                """
+def timed_out(meta):
+    """
+    :param meta: task meta data OR None if the task did not complete
 
-                try:
-                    result = tasks_app.send_task('tasks.ping',
-                                                 kwargs={'host': host})
+    Returns:
+        Boolean. The task did not finish before its caller stopped
+        waiting, or its message expired on the worker
+    """
 
-                    ns.logger.info(result.backend)
-                    ns.logger.info("{} results: {}".format(
-                        service, result.state))
+    return meta is None or meta['status'] == states.REVOKED
 
-                    task_ids.append({'service': service, 'task_id': result.id})
 
-                except Exception:
-                    ns.logger.info("Error with {} on {}".format(service, host))
-                    response.append({
-                        'host': host,
-                        'service': service,
-                        'results': 'error'
-                    })
+def lookup_entry(task_id, host, service, meta, started):
+    """
+    Build the response entry of a published lookup
+
+    :param task_id: id of the lookup task
+    :param host: ip or domain name
+    :param service: name of the service
+    :param meta: task meta data OR None if the task did not complete
+    :param started: monotonic time the lookup was published
 
-            elif service.upper() == RDAP:
+    Returns:
+        JSON - result of the lookup, with the status TIMEOUT when it
+        did not finish in time
+    """
 
-                """
-                Process rdap service
-                """
+    record_lookup(service, meta, started)
 
-                try:
+    if timed_out(meta):
+        return {'task_id': task_id, 'host': host, 'service': service,
+                'status': TIMEOUT,
+                'results': task_output(service, host, None)}
 
-                    result = tasks_app.send_task('tasks.rdap',
-                                                 args=(host, host_type))
+    return {'task_id': task_id, 'host': host, 'service': service,
+            'results': task_output(service, host, meta)}
 
-                    ns.logger.info(result.backend)
-                    ns.logger.info("{} results: {}".format(
-                        service,
-                        result.state))
 
-                    task_ids.append({'service': service,
-                                     'task_id': result.id})
-                except Exception:
-                    ns.logger.info("Error with {} on {}".format(
-                        service,
-                        host))
-                    response.append({
-                        'host': host,
-                        'service': service,
-                        'results': 'error'
-                    })
+def record_lookup(service, meta, started):
+    """
+    Export the latency and outcome of a finished or timed out lookup
+
+    :param service: name of the service
+    :param meta: task meta data OR None if the task did not complete
+    :param started: monotonic time the lookup was published
+    """
+
+    service = service.upper()
+
+    if timed_out(meta):
+        lookup_timeouts.labels(service).inc()
+        return
+
+    lookup_seconds.labels(service).observe(monotonic() - started)
+    if meta['status'] != states.SUCCESS or lookup_failed(meta['result']):
+        lookup_errors.labels(service).inc()
+
+
+def virustotal_cache_host(apikey, domain_name):
+    """
+    Cache host of a VirusTotal report, so jobs are only reused
+    by callers of the same VirusTotal API key
+
+    :param apikey: VirusTotal API key
+    :param domain_name: domain name of the report
+
+    Returns:
+        String. Hash of the key followed by the domain name
+    """
+
+    return '{}:{}'.format(key_digest(apikey), domain_name)
+
+
+def virustotal_queues():
+    """
+    Read the VirusTotal token buckets shared by the task workers.
+    Tokens below zero are reserved by tasks waiting for their turn.
+
+    Returns:
+        Dictionary. Queue depth and tokens left by key digest
+    """
+
+    now = time()
+    queues = {}
+
+    collection = tasks_app.backend.database[VIRUSTOTAL_BUCKET_COLLECTION]
+    for bucket in collection.find():
+        elapsed = max(0.0, now - bucket['updated'])
+        tokens = min(bucket['capacity'],
+                     bucket['tokens'] + elapsed * bucket['rate'])
+        queues[bucket['_id']] = {'queue_depth': max(0, ceil(-tokens)),
+                                 'tokens': round(max(0.0, tokens), 3)}
+
+    return queues
+
+
+def cached_virustotal_job(apikey, domain_name):
+    """
+    Reuse a recent VirusTotal report job of the same domain and key
+
+    :param apikey: VirusTotal API key
+    :param domain_name: domain name of the report
+
+    Returns:
+        JSON - task id and status of the cached job OR None when
+        there is no usable job
+    """
+
+    cache_host = virustotal_cache_host(apikey, domain_name)
+    job = lookup_cache.get(VIRUSTOTAL, cache_host)
+    if job is None:
+        return None
+
+    result = tasks_app.AsyncResult(job['task_id'], app=tasks_app)
+    state = result.state
+
+    # failed reports and jobs that never finished are looked up again,
+    # jobs waiting for a token of their key (RETRY) are still queued
+    if state == states.FAILURE or \
+            (state == states.SUCCESS and lookup_failed(result.result)) or \
+            (state not in (states.SUCCESS, states.RETRY) and
+             time() - job['created'] > VIRUSTOTAL_UNFINISHED_REUSE):
+        lookup_cache.delete(VIRUSTOTAL, cache_host)
+        return None
+
+    ns.logger.info("Cache hit {} on {}".format(VIRUSTOTAL, domain_name))
+    return {'task_id': job['task_id'], 'status': state, 'cached': True}
+
+
+def publish_lookups(lookups, deadline=None, priority=None):
+    """
+    Publish the tasks of many service lookups as a single batch.
+    Lookups identical to one already in flight attach to its task
+    instead of publishing another one.
+
+    :param lookups: list of (host, host_type, service)
+    :param deadline: seconds the caller waits OR None for the timeout
+        of each service, the tasks expire after it
+    :param priority: message priority of the tasks OR None
+
+    Returns:
+        List - the task id of each lookup
+    """
+
+    claims = inflight_lookups.claim([(service, host) for host, host_type,
+                                     service in lookups])
+
+    owned = {}
+    for host, host_type, service in lookups:
+        task_id, owner = claims[(service, host)]
+        if owner:
+            owned.setdefault(task_id, (host, host_type, service))
+
+    if owned:
+        signatures = [service_registry.signature(service, host, host_type,
+                                                 deadline, priority)
+                      .set(task_id=task_id)
+                      for task_id, (host, host_type, service)
+                      in owned.items()]
+        try:
+            task_publisher.publish(signatures)
+        except Exception:
+            inflight_lookups.release([(service, host, task_id)
+                                      for task_id, (host, host_type, service)
+                                      in owned.items()])
+            raise
+
+    if len(owned) < len(lookups):
+        ns.logger.info("Attached {} lookups to tasks in flight"
+                       .format(len(lookups) - len(owned)))
+
+    return [claims[(service, host)][0] for host, host_type, service
+            in lookups]
+
+
+def publish_services(host, list_of_services, host_type, use_cache=True,
+                     deadline=None, priority=None):
+    """
+    Publish a Celery task job for each service not served from the cache
+
+    :param host: ip or domain name
+    :param list_of_services: a list of sevices to lookup
+    :param host_type: 'IP' or 'DOMAIN'
+    :param use_cache: serve results from the lookup cache
+    :param deadline: seconds the caller waits OR None for the timeout
+        of each service
+    :param priority: message priority of the tasks OR None
+
+    Returns:
+        Tuple - results known without a task (cached, invalid, error)
+        and the service name by published task id
+    """
+
+    services = []
+    response = []
+    task_services = {}
+
+    # Build a task signature for each service
+    for service in list_of_services:
+        if service_available(service, host_type):
+            ns.logger.info("START {}".format(service))
+            # popular hosts are refreshed ahead of their expiry
+            host_popularity.record(service, host, host_type)
+
+            cached = lookup_cache.get(service, host) if use_cache else None
+            if cached is not None:
+                ns.logger.info("Cache hit {} on {}".format(service, host))
+                response.append({
+                    'host': host,
+                    'service': service,
+                    'results': cached,
+                    'cached': True
+                })
+                continue
+
+            services.append(service)
 
         else:
             ns.logger.info("Error with {} on {}".format(service, host))
             response.append({
                 'host': host,
                 'service': service,
-                'results': 'invalid service'
+                'results': invalid_service(service, host_type)
             })
 
-    # Combine the resullt of each task in the task queue
-    # and generate a single payload
-    for task in task_ids:
-        id = task['task_id']
-        service = task['service']
-        result = tasks_app.AsyncResult(id, app=tasks_app)
+    if not services:
+        return response, task_services
 
-        ns.logger.info("Process task: {}".format(id))
-        try:
-            # Wait 60 seconds, before the operation times out
-            result_output = result.wait(timeout=60, interval=0.5)
-            response.append({
-                'task_id': id,
-                'host': host,
-                'service': service,
-                'results': result_output
-            })
+    # Publish every lookup at once as a single batch
+    try:
+        task_ids = publish_lookups([(host, host_type, service)
+                                    for service in services],
+                                   deadline, priority)
 
-        except Exception as e:
-            ns.logger.info("Celery task didn't complete: Celery may be down.")
+    except Exception:
+        for service in services:
+            ns.logger.info("Error with {} on {}".format(service, host))
             response.append({
-                'task_id': id,
                 'host': host,
                 'service': service,
-                'results': str(e)
+                'results': 'error'
             })
+        return response, task_services
+
+    for service, task_id in zip(services, task_ids):
+        task_services[task_id] = service
+
+    return response, task_services
+
+
+def do_service(host, list_of_services, host_type, use_cache=True,
+               deadline=LOOKUP_DEADLINE, priority=None):
+    """
+    Gathers information from multiple sources.
+    Process each service lookup on different Celery
+    task workers to perform the action.
+
+    :param host: ip or domain name
+    :param list_of_services: a list of sevices to lookup
+    :param host_type: 'IP' or 'DOMAIN'
+    :param use_cache: serve and store results in the lookup cache
+    :param deadline: seconds to wait for the whole lookup
+    :param priority: message priority of the tasks OR None
+
+    Returns:
+        JSON - Combine the results and return a single payload,
+        services unfinished at the deadline with the status TIMEOUT
+    """
+
+    started = monotonic()
+    response, task_services = publish_services(host, list_of_services,
+                                               host_type, use_cache,
+                                               deadline, priority)
+
+    # Combine the result of each task as soon as it completes
+    # and generate a single payload, waiting for the slowest service
+    # until the deadline of the whole lookup
+    budget = max([service_registry.budget(service, deadline)
+                  for service in task_services.values()], default=0)
+    timeout = max(0, started + budget - monotonic())
+    for id, meta in watcher.wait(list(task_services), timeout):
+        ns.logger.info("Process task: {}".format(id))
+        response.append(lookup_entry(id, host, task_services[id], meta,
+                                     started))
+
+    # Let the next identical lookup publish a task of its own
+    inflight_lookups.release([(service, host, id)
+                              for id, service in task_services.items()])
 
     return response
 
 
+def do_bulk(hosts, list_of_services, max_in_flight, use_cache=True,
+            priority=None):
+    """
+    Lookup many hosts at once, keeping at most max_in_flight
+    tasks published at any time.
+
+    :param hosts: list of ip or domain names
+    :param list_of_services: a list of sevices to lookup OR None for the
+        services applying to each host
+    :param max_in_flight: maximum number of unfinished tasks
+    :param use_cache: serve and store results in the lookup cache
+    :param priority: message priority of the tasks OR None
+
+    Returns:
+        Generator of JSON - one result per (host, service) in
+        completion order
+    """
+
+    candidates = []
+
+    for host in hosts:
+        host_type = host_type_of(host)
+
+        for service in list_of_services or \
+                service_registry.names(host_type):
+            if host_type is None:
+                yield {'host': host, 'service': service,
+                       'results': 'invalid host'}
+            elif not service_available(service, host_type):
+                yield {'host': host, 'service': service,
+                       'results': invalid_service(service, host_type)}
+            else:
+                candidates.append((host, host_type, service))
+
+    # a single cache read for every lookup before the first publish
+    cached = {}
+    if use_cache:
+        cached = lookup_cache.get_many([(service, host) for host, host_type,
+                                        service in candidates])
+
+    lookups = []
+    for host, host_type, service in candidates:
+        if (service, host) in cached:
+            yield {'host': host, 'service': service,
+                   'results': cached[(service, host)], 'cached': True}
+        else:
+            lookups.append((host, host_type, service))
+
+    lookups.reverse()
+    in_flight = {}
+    finished = []
+    subscription = watcher.subscribe()
+
+    try:
+        while lookups or in_flight:
+
+            # Refill the in flight window with a single batch publish
+            if lookups and len(in_flight) <= max_in_flight // 2:
+                inflight_lookups.release(finished)
+                finished = []
+
+                batch = []
+                while lookups and len(in_flight) + len(batch) < max_in_flight:
+                    batch.append(lookups.pop())
+
+                try:
+                    task_ids = publish_lookups(batch, priority=priority)
+                except Exception:
+                    for host, host_type, service in batch:
+                        yield {'host': host, 'service': service,
+                               'results': 'error'}
+                    continue
+
+                # identical lookups share a task and its deadline,
+                # the timeout of their service
+                started = monotonic()
+                for (host, host_type, service), id in zip(batch, task_ids):
+                    deadline = started + service_registry.timeout(service)
+                    in_flight.setdefault(id, ([], started, deadline))[0] \
+                        .append((host, service))
+                subscription.add(task_ids)
+
+            # Wait for the next completion or the earliest task timeout
+            timeout = min(deadline for task_lookups, started, deadline
+                          in in_flight.values()) - monotonic()
+            completion = subscription.get(timeout)
+
+            if completion is None:
+                expired = [id for id, (task_lookups, started, deadline)
+                           in in_flight.items() if deadline <= monotonic()]
+                subscription.discard(expired)
+                completions = [(id, None) for id in expired]
+            else:
+                completions = [completion]
+
+            for id, meta in completions:
+                task_lookups, started, deadline = in_flight.pop(id)
+                for host, service in task_lookups:
+                    finished.append((service, host, id))
+                    yield lookup_entry(id, host, service, meta, started)
+
+    finally:
+        subscription.close()
+        inflight_lookups.release(finished)
+
+
 # Define route resources
 @ns.route('/default/<host>', endpoint="host")
 class LookupService(Resource):
@@ -162,6 +611,7 @@ class LookupService(Resource):
     # specify one of the expected responses and parameters
     @ns.doc(responses={
             200: 'OK',
+            202: 'Async lookup job accepted',
             400: 'Invalid Argument',
             500: 'Mapping Key Error'
             },
@@ -173,8 +623,12 @@ class LookupService(Resource):
             })
     # Specify the expected input model
     @ns.expect(service_model, validate=False)
-    @ns.doc(security='apikey')
+    @ns.doc(security='apikey', params={'cache': CACHE_PARAM,
+                                       'mode': MODE_PARAM,
+                                       'deadline': DEADLINE_PARAM,
+                                       'fields': FIELDS_PARAM})
     @token_required
+    @scope_required(LOOKUP_SCOPE)
     def post(self, host):
         '''Returns information from selected services.
         Leave blank for all available services
@@ -186,40 +640,119 @@ class LookupService(Resource):
 
         :param host: ip or domain name
         :param services: list of services to query or use default list if none provided
+        :param cache: 'false' to bypass the lookup cache
+        :param mode: 'async' to return a job id instead of waiting
+        :param deadline: seconds to wait for the whole lookup
+        :param fields: paths of the results to return, e.g. rdap.entities
 
         Returns:
             JSON - Combine the results and return a single payload
+            OR the job id of an async lookup
         """
 
         ns.logger.info("START {}".format(self.endpoint))
         # Validate IP or Domain
-        host_type = ''
         response = {}
+        use_cache = cache_enabled()
+        host_type = host_type_of(host)
 
-        if ipv4(host):
-            host_type = IP
-        elif domain(host):
-            host_type = DOMAIN
-        else:
+        if host_type is None:
             return {'results':
                     'invalid host: enter correct ip address or domain name'}
 
-        if ns.payload:
-            if 'services' in ns.payload:
-                request_args = ns.payload
-                list_of_services = request_args['services']
+        deadline = deadline_param()
+        if deadline is None:
+            return {'ERROR': 'deadline must be a positive number of '
+                             'seconds'}, 400
 
-                if list_of_services:
-                    response = do_service(host, list_of_services, host_type)
-                else:
-                    response = do_service(host, SERVICES, host_type)
+        list_of_services = service_registry.names(host_type)
+        if ns.payload and ns.payload.get('services'):
+            list_of_services = ns.payload['services']
 
-            else:
-                response = do_service(host, SERVICES, host_type)
-        else:
-            response = do_service(host, SERVICES, host_type)
+        # Return a job id at once and aggregate the results server side
+        if request.args.get('mode') == 'async':
+            response, task_services = publish_services(
+                host, list_of_services, host_type, use_cache, deadline,
+                request_priority(BATCH))
+            job_id = lookup_jobs.create(host, response, task_services,
+                                        deadline)
+
+            ns.logger.info("END {}".format(self.endpoint))
+            return {'job_id': job_id, 'status': states.PENDING}, 202
 
-        return {'services': response}
+        response = do_service(host, list_of_services, host_type, use_cache,
+                              deadline, request_priority(INTERACTIVE))
+
+        # project before encoding, large results are never serialized
+        fields = fields_param()
+        return {'services': [project_lookup(entry, fields)
+                             for entry in response]}
+
+
+# Define route resources
+@ns.route('/bulk', endpoint="/bulk")
+class BulkLookupService(Resource):
+
+    # specify one of the expected responses and parameters
+    @ns.doc(responses={
+            200: 'OK',
+            400: 'Invalid Argument'
+            })
+    # Specify the expected input model
+    @ns.expect(bulk_model, validate=True)
+    @ns.doc(security='apikey', params={'cache': CACHE_PARAM,
+                                       'fields': FIELDS_PARAM})
+    @token_required
+    @scope_required(LOOKUP_SCOPE)
+    def post(self):
+        '''Streams information about many hosts as newline delimited JSON.
+        Leave services blank for all available services
+        ***TOKEN AUTHORIZATION REQUIRED***'''
+
+        """
+        Schedule a Celery task job for each host and service and
+        stream each result as soon as it completes.
+
+        :param hosts: list of ip or domain names
+        :param services: list of services to query or use default list if none provided
+        :param max_in_flight: maximum number of tasks processed at once
+        :param cache: 'false' to bypass the lookup cache
+        :param fields: paths of the results to return, e.g. rdap.entities
+
+        Returns:
+            NDJSON - one line per host and service
+        """
+
+        ns.logger.info("START {}".format(self.endpoint))
+
+        hosts = ns.payload['hosts']
+        list_of_services = ns.payload.get('services')
+        max_in_flight = ns.payload.get('max_in_flight')
+        if max_in_flight is None:
+            max_in_flight = BULK_MAX_IN_FLIGHT
+
+        if not hosts:
+            return {'ERROR': 'Empty values are not allowed'}, 400
+
+        if len(hosts) > BULK_MAX_HOSTS:
+            return {'ERROR': 'At most {} hosts are allowed'
+                    .format(BULK_MAX_HOSTS)}, 400
+
+        if not 1 <= max_in_flight <= BULK_MAX_IN_FLIGHT:
+            return {'ERROR': 'max_in_flight must be between 1 and {}'
+                    .format(BULK_MAX_IN_FLIGHT)}, 400
+
+        lines = do_bulk(hosts, list_of_services, max_in_flight,
+                        cache_enabled(), request_priority(BATCH))
+        fields = fields_param()
+
+        def generate():
+            for line in lines:
+                yield dumps_json(project_lookup(line, fields)) + '\n'
+            ns.logger.info("END {}".format(self.endpoint))
+
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
 
 
 # Define route resources
@@ -234,6 +767,7 @@ class AddVirusTotalJob(Resource):
             })
     # Specify the expected input model
     @ns.expect(virustotal_model, validate=True)
+    @ns.doc(params={'cache': CACHE_PARAM})
     def post(self):
         '''Schedules a VirusTotal Domain Report task job'''
 
@@ -256,13 +790,23 @@ class AddVirusTotalJob(Resource):
 
         if domain_name and apikey:
             if domain(domain_name):
-                ns.logger.info("EXECUTE {}".format(self.endpoint))
-                result = tasks_app.send_task('tasks.virustotal_domain_report',
-                                             args=(apikey, domain_name))
-
-                ns.logger.info(result.backend)
-
-                response = {'task_id': result.id, 'status': result.state}
+                response = cached_virustotal_job(apikey, domain_name) \
+                    if cache_enabled() else None
+
+                if response is None:
+                    ns.logger.info("EXECUTE {}".format(self.endpoint))
+                    task_id, = task_publisher.publish([tasks_app.signature(
+                        'tasks.virustotal_domain_report',
+                        args=(apikey, domain_name),
+                        priority=request_priority(BACKGROUND))])
+
+                    lookup_cache.set(VIRUSTOTAL,
+                                     virustotal_cache_host(apikey,
+                                                           domain_name),
+                                     {'task_id': task_id, 'created': time()})
+                    # a task just published is pending, its state is not
+                    # read back from the result backend
+                    response = {'task_id': task_id, 'status': states.PENDING}
             else:
                 response = {'ERROR': 'Not a valid Domain name'}
         else:
@@ -271,3 +815,55 @@ class AddVirusTotalJob(Resource):
         ns.logger.info("END {}".format(self.endpoint))
 
         return response
+
+
+# Define route resources
+@ns.route('/virustotal/queue', endpoint="/virustotal/queue")
+class VirusTotalQueues(Resource):
+
+    @ns.doc(responses={200: 'OK'}, security='apikey')
+    @token_required
+    @scope_required(ADMIN_SCOPE)
+    def get(self):
+        '''Returns the VirusTotal report tasks waiting for each API key'''
+
+        """
+        Fetch the queue depth of every VirusTotal API key, keys are
+        identified by the first 16 hex digits of their SHA-256
+
+        Returns:
+            JSON - queue depth and tokens left by key digest
+            OR error information
+        """
+
+        ns.logger.info("START {}".format(self.endpoint))
+
+        try:
+            response = virustotal_queues()
+        except Exception as e:
+            ns.logger.info("Token buckets unavailable: {}".format(e))
+            response = {'status': 'ERROR', 'desc': 'queues unavailable'}, 500
+
+        ns.logger.info("END {}".format(self.endpoint))
+
+        return response
+
+
+# Define route resources
+@ns.route('/cache', endpoint="/cache")
+class LookupCacheStats(Resource):
+
+    @ns.doc(responses={200: 'OK'}, security='apikey')
+    @token_required
+    @scope_required(ADMIN_SCOPE)
+    def get(self):
+        '''Returns the lookup cache counters of this API process'''
+
+        """
+        Fetch hit/miss counters of the lookup cache
+
+        Returns:
+            JSON - counters and size of the in-process cache tier
+        """
+
+        return lookup_cache.info()
@@ -1,13 +1,130 @@
-from flask_restx import Namespace, Resource
+from datetime import datetime, timedelta
+from flask import request, stream_with_context, Response
+from flask_restx import Namespace, Resource, fields
+from time import monotonic
 from celery import states
 from backend import tasks_app
-from routes.helpers import task_error
+from cache import lookup_cache
+from inflight import inflight_lookups
+from jobs import lookup_jobs
+from routes.helpers import task_error, FIELDS_PARAM, fields_param, \
+    project, project_lookup
+from representation import dumps_json
+from routes.services import task_output, lookup_failed, timed_out
+from settings import LOOKUP_TIMEOUT, TIMEOUT, TASKS_BATCH_MAX, \
+    TASK_RESULT_FIELDS, TASK_WAIT_MAX, TASK_STREAM_TIMEOUT, \
+    TASK_STREAM_KEEPALIVE
+from watcher import task_metas, watcher
 
 # Set namespace
 ns = Namespace('tasks', description='Task Queue Job operations', ordered=True)
 
 log = ns.logger
 
+# Register models
+task_ids_json = fields.List(fields.String(example='c9857b91-6b41-4a49'),
+                            required=True, description='Task Job IDs')
+
+status_batch_model = ns.model('Task status arguments',
+                              {'task_ids': task_ids_json})
+
+result_batch_model = ns.model('Task result arguments', {
+    'task_ids': task_ids_json,
+    'fields': fields.List(fields.String(enum=TASK_RESULT_FIELDS),
+                          required=False,
+                          description='Fields to return besides the '
+                                      'status, defaults to result',
+                          example=['result'])
+})
+
+
+WAIT_PARAM = {
+    'description': 'Seconds to wait for the task to finish before '
+                   'answering, at most {}'.format(TASK_WAIT_MAX),
+    'type': 'number',
+    'default': 0
+}
+
+
+def wait_seconds():
+    """
+    Read the long poll timeout of the current request
+
+    Returns:
+        Float. Seconds to wait, capped at TASK_WAIT_MAX
+
+    Raises:
+        ValueError: the 'wait' query parameter is not a positive number
+    """
+
+    wait = float(request.args.get('wait', 0))
+    if not 0 <= wait < float('inf'):
+        raise ValueError(wait)
+
+    return min(wait, TASK_WAIT_MAX)
+
+
+def sse_event(event, data):
+    """
+    Format a Server-Sent Event
+
+    :param event: name of the event
+    :param data: JSON serializable payload
+
+    Returns:
+        String. The event followed by a blank line
+    """
+
+    return 'event: {}\ndata: {}\n\n'.format(event, dumps_json(data))
+
+
+def batch_task_ids(payload):
+    """
+    Validate the task ids of a batch request
+
+    :param payload: JSON payload with a list of task ids
+
+    Returns:
+        Tuple - unique task ids in request order and error information
+        OR None
+    """
+
+    task_ids = list(dict.fromkeys(payload['task_ids']))
+
+    if not task_ids:
+        return task_ids, ({'ERROR': 'Empty values are not allowed'}, 400)
+
+    if len(task_ids) > TASKS_BATCH_MAX:
+        return task_ids, ({'ERROR': 'At most {} task ids are allowed'
+                           .format(TASKS_BATCH_MAX)}, 400)
+
+    return task_ids, None
+
+
+def batch_meta(meta, result_fields=None):
+    """
+    Make the meta data of a task returned by task_metas JSON serializable
+
+    :param meta: task meta data
+    :param result_fields: projection tree of the result OR None
+
+    Returns:
+        JSON - task id, status and the requested fields
+    """
+
+    meta = dict(meta)
+    if isinstance(meta.get('date_done'), datetime):
+        meta['date_done'] = meta['date_done'].isoformat()
+
+    # the result of a task that did not succeed is its error
+    if 'result' in meta and meta['status'] != states.SUCCESS and \
+            meta['result'] is not None:
+        meta['result'] = str(meta['result'])
+    elif 'result' in meta:
+        meta['result'] = project(meta['result'], result_fields)
+
+    return meta
+
 
 # Define route resources
 @ns.route('/status/<string:task_id>', endpoint="/status/task_id")
@@ -44,6 +161,10 @@ class GetTaskStatus(Resource):
         elif state == states.PENDING:
             response = {'task_id': result.id, 'status': state}, 200
 
+        # the task waits for a token of its upstream API key
+        elif state == states.RETRY:
+            response = {'task_id': result.id, 'status': state}, 200
+
         # the task executed successfully
         # the result attribute then contains the tasks return value
         elif state == states.SUCCESS:
@@ -64,7 +185,9 @@ class GetTaskStatus(Resource):
 class GetTaskResult(Resource):
 
     @ns.response(404, 'Result do not exists')
+    @ns.response(400, 'Invalid Argument')
     @ns.response(200, 'Return result')
+    @ns.doc(params={'wait': WAIT_PARAM, 'fields': FIELDS_PARAM})
     def get(self, task_id):
         '''Returns the result of a task job'''
 
@@ -72,6 +195,8 @@ class GetTaskResult(Resource):
         Fetch the result of the task job
 
         :param task_id: celery worker task id
+        :param wait: seconds to wait for an unfinished task (long poll)
+        :param fields: paths of the result to return, e.g. detected_urls
 
         Returns:
             JSON - Return task id along with the task job results
@@ -80,21 +205,35 @@ class GetTaskResult(Resource):
         response = {}
 
         ns.logger.info("START {}".format(self.endpoint))
+
+        try:
+            wait = wait_seconds()
+        except ValueError:
+            ns.logger.info("END {}".format(self.endpoint))
+            return {'ERROR': 'wait must be a positive number'}, 400
+
         result = tasks_app.AsyncResult(task_id, app=tasks_app)
 
         state = result.state
 
+        # long poll: answer as soon as the watcher sees the task finish
+        if wait and state not in states.READY_STATES:
+            for id, meta in watcher.wait([task_id], wait):
+                pass
+            state = result.state
+
         # tasks finished so result exists
         if state == states.SUCCESS:
             response = {'task_id': result.id, 'status': state,
-                        'result': result.get(timeout=1.0)}, 200
+                        'result': project(result.get(timeout=1.0),
+                                          fields_param())}, 200
 
         # task still pending or unknown - so result do not exists
         elif state == states.PENDING:
             response = {'task_id': result.id, 'status': state}, 404
 
-        # task started but result do not exists yet
-        elif state == states.STARTED:
+        # task started or rescheduled but result do not exists yet
+        elif state in (states.STARTED, states.RETRY):
             response = {'task_id': result.id, 'status': state}, 404
 
         else:
@@ -103,3 +242,245 @@ class GetTaskResult(Resource):
         ns.logger.info("END {}".format(self.endpoint))
 
         return response
+
+
+# Define route resources
+@ns.route('/events', endpoint="/events")
+class TaskEvents(Resource):
+
+    @ns.response(200, 'Stream of task events')
+    @ns.response(400, 'Invalid Argument')
+    @ns.doc(params={'task_id': {
+        'description': 'Task Job ID, repeat for more tasks',
+        'type': 'array',
+        'items': {'type': 'string'},
+        'collectionFormat': 'multi',
+        'required': True
+    }})
+    def get(self):
+        '''Streams the result of task jobs as Server-Sent Events'''
+
+        """
+        Send a 'result' event with the task id, status and result of each
+        task as soon as it finishes. Tasks still running after
+        TASK_STREAM_TIMEOUT seconds are sent in a final 'timeout' event.
+
+        :param task_id: celery worker task ids
+
+        Returns:
+            text/event-stream - one event per task OR error information
+        """
+
+        ns.logger.info("START {}".format(self.endpoint))
+
+        task_ids = list(dict.fromkeys(request.args.getlist('task_id')))
+
+        if not task_ids:
+            ns.logger.info("END {}".format(self.endpoint))
+            return {'ERROR': 'Empty values are not allowed'}, 400
+
+        if len(task_ids) > TASKS_BATCH_MAX:
+            ns.logger.info("END {}".format(self.endpoint))
+            return {'ERROR': 'At most {} task ids are allowed'
+                    .format(TASKS_BATCH_MAX)}, 400
+
+        def generate():
+            deadline = monotonic() + TASK_STREAM_TIMEOUT
+            subscription = watcher.subscribe(task_ids)
+
+            try:
+                while subscription.pending:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        yield sse_event('timeout', {
+                            'task_ids': sorted(subscription.pending)})
+                        break
+
+                    completion = subscription.get(
+                        min(remaining, TASK_STREAM_KEEPALIVE))
+                    if completion is None:
+                        # keep proxies from closing an idle stream
+                        if monotonic() < deadline:
+                            yield ': keepalive\n\n'
+                        continue
+
+                    task_id, meta = completion
+                    yield sse_event('result', batch_meta({
+                        'task_id': task_id, 'status': meta['status'],
+                        'result': meta['result']}))
+
+            finally:
+                subscription.close()
+                ns.logger.info("END {}".format(self.endpoint))
+
+        return Response(stream_with_context(generate()),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+
+
+# Define route resources
+@ns.route('/status', endpoint="/status")
+class GetTaskStatuses(Resource):
+
+    @ns.response(200, 'Return the status of each task')
+    @ns.response(400, 'Invalid Argument')
+    @ns.expect(status_batch_model, validate=True)
+    def post(self):
+        '''Returns the status of many task jobs'''
+
+        """
+        Fetch the status of many task jobs with a single query
+
+        :param task_ids: list of celery worker task ids
+
+        Returns:
+            JSON - task id and status of each task, unknown tasks are
+            PENDING, OR error information
+        """
+
+        ns.logger.info("START {}".format(self.endpoint))
+
+        task_ids, error = batch_task_ids(ns.payload)
+        if error:
+            ns.logger.info("END {}".format(self.endpoint))
+            return error
+
+        metas = task_metas(tasks_app.backend, task_ids, fields=[])
+
+        ns.logger.info("END {}".format(self.endpoint))
+
+        return {'tasks': [metas[task_id] for task_id in task_ids]}, 200
+
+
+# Define route resources
+@ns.route('/result', endpoint="/result")
+class GetTaskResults(Resource):
+
+    @ns.response(200, 'Return the result of each task')
+    @ns.response(400, 'Invalid Argument')
+    @ns.expect(result_batch_model, validate=True)
+    @ns.doc(params={'fields': FIELDS_PARAM})
+    def post(self):
+        '''Returns the results of many task jobs'''
+
+        """
+        Fetch the results of many task jobs with a single query
+
+        :param task_ids: list of celery worker task ids
+        :param fields: fields to return besides the status, defaults
+                       to the result. The fields query parameter holds
+                       the paths of each result to return
+
+        Returns:
+            JSON - task id, status and requested fields of each task,
+            the result of a failed task is its error, OR error information
+        """
+
+        ns.logger.info("START {}".format(self.endpoint))
+
+        task_ids, error = batch_task_ids(ns.payload)
+        if error:
+            ns.logger.info("END {}".format(self.endpoint))
+            return error
+
+        metas = task_metas(tasks_app.backend, task_ids,
+                           fields=ns.payload.get('fields') or ['result'])
+
+        ns.logger.info("END {}".format(self.endpoint))
+
+        result_fields = fields_param()
+        return {'tasks': [batch_meta(metas[task_id], result_fields)
+                          for task_id in task_ids]}, 200
+
+
+# Define route resources
+@ns.route('/job/<string:job_id>', endpoint="/job/job_id")
+@ns.param('job_id', 'Lookup Job ID')
+class GetLookupJob(Resource):
+
+    @ns.response(404, 'Job do not exists')
+    @ns.response(200, 'Return job status and results')
+    @ns.doc(params={'fields': FIELDS_PARAM})
+    def get(self, job_id):
+        '''Returns the merged results of an async lookup job'''
+
+        """
+        Fetch the status of every service of an async lookup job
+        and merge the results once all of its tasks finished
+
+        :param job_id: lookup job id
+        :param fields: paths of the results to return, e.g. rdap.entities
+
+        Returns:
+            JSON - Return job id, overall status and the status and
+            results of each service OR error information
+        """
+
+        ns.logger.info("START {}".format(self.endpoint))
+
+        job = lookup_jobs.get(job_id)
+        if job is None:
+            ns.logger.info("END {}".format(self.endpoint))
+            return {'job_id': job_id, 'status': 'ERROR',
+                    'desc': 'unknown job'}, 404
+
+        host = job['host']
+        services = []
+
+        for entry in job['services']:
+            entry.setdefault('status', states.SUCCESS if entry.get('cached')
+                             else states.FAILURE)
+            services.append(entry)
+
+        # a single query for the tasks that were still running
+        tasks = job['tasks']
+        metas = task_metas(tasks_app.backend,
+                           [task['task_id'] for task in tasks])
+
+        # tasks lost or still running after the deadline of the lookup
+        # are reported as timed out so the job always finishes
+        expired = datetime.utcnow() > job['created_at'] + \
+            timedelta(seconds=job.get('deadline', LOOKUP_TIMEOUT))
+
+        finished = True
+        completed = []
+        for task in tasks:
+            meta = metas[task['task_id']]
+            entry = {'task_id': task['task_id'], 'host': host,
+                     'service': task['service'], 'status': meta['status']}
+
+            if timed_out(meta):
+                # the task message expired on the worker
+                entry['status'] = TIMEOUT
+                entry['results'] = task_output(task['service'], host, None)
+            elif meta['status'] in states.READY_STATES:
+                entry['results'] = task_output(task['service'], host, meta,
+                                               store=False)
+                completed.append(entry)
+            elif expired:
+                entry['status'] = TIMEOUT
+                entry['results'] = task_output(task['service'], host, None)
+            else:
+                finished = False
+
+            services.append(entry)
+
+        # store the job and cache its results once, when it finishes
+        if finished and job['status'] == states.PENDING:
+            lookup_jobs.finish(job_id, services)
+            inflight_lookups.release([(task['service'], host, task['task_id'])
+                                      for task in tasks])
+            for entry in completed:
+                if entry['status'] == states.SUCCESS and \
+                        not lookup_failed(entry['results']):
+                    lookup_cache.set(entry['service'], host,
+                                     entry['results'])
+
+        ns.logger.info("END {}".format(self.endpoint))
+
+        projection = fields_param()
+        return {'job_id': job_id, 'host': host,
+                'status': states.SUCCESS if finished else states.PENDING,
+                'services': [project_lookup(entry, projection)
+                             for entry in services]}, 200
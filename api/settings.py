@@ -1,3 +1,4 @@
+from json import loads
 from os import environ
 
 # Flask settings
@@ -10,20 +11,156 @@ RESTPLUS_MASK_SWAGGER = False
 RESTX_ERROR_404_HELP = False
 
 RATE_LIMITS = ['200 per day', '50 per hour', '20 per minute']
+
+# Rate limits of each client, identified by its API key or IP address
+RATE_LIMIT = '200/day;50/hour;5/minute'
+# other limits by the first 16 hex digits of the SHA-256 of an API key,
+# e.g. {"1f2e...": "10000/day;100/minute"}
+RATE_LIMITS_BY_KEY = loads(environ.get('RATE_LIMITS_BY_KEY', '{}'))
+# memory:// counts in each gunicorn worker. mongodb://mongo:27017 shares
+# atomic moving window counters between workers and replicas,
+# batched+mongodb://mongo:27017 shares fixed window counters batched in
+# each worker (see ratelimit_storage.py)
+RATELIMIT_STORAGE_URI = environ.get('RATELIMIT_STORAGE_URI', 'memory://')
+RATELIMIT_STRATEGY = 'fixed-window' \
+    if RATELIMIT_STORAGE_URI.startswith('batched+') else 'moving-window'
+RATELIMIT_BATCH = 10  # hits counted locally before a flush
+RATELIMIT_FLUSH_INTERVAL = 1  # seconds between two flushes of a counter
 PING = 'PING'
 RDAP = 'RDAP'
-SERVICES = [PING, RDAP]
+DNS = 'DNS'
+VIRUSTOTAL = 'VIRUSTOTAL'
+
+# Host
+IP = 'IP'
+DOMAIN = 'DOMAIN'
+
+# Service registry: the lookup services validated and dispatched by the
+# API. Each service runs a task on a queue (served by a worker, see
+# docker-compose.yml) with the host and the arguments named in args,
+# is waited for timeout seconds, applies to host_types and is cached for
+# cache_ttl seconds, then served stale for cache_stale more seconds while
+# it is refreshed in the background. Services run by default in this
+# order.
+SERVICE_REGISTRY = {
+    PING: {'task': 'tasks.ping', 'queue': 'ping', 'timeout': 60,
+           'host_types': [IP, DOMAIN], 'args': ['host'], 'cache_ttl': 60,
+           'cache_stale': 60},
+    RDAP: {'task': 'tasks.rdap', 'queue': 'rdap', 'timeout': 60,
+           'host_types': [IP, DOMAIN], 'args': ['host', 'host_type'],
+           'cache_ttl': 86400, 'cache_stale': 86400},
+    DNS: {'task': 'tasks.dns', 'queue': 'dns', 'timeout': 15,
+          'host_types': [DOMAIN], 'args': ['host'], 'cache_ttl': 60,
+          'cache_stale': 60}
+}
+SERVICES = list(SERVICE_REGISTRY)
+
+# Lookup settings
+# seconds to wait for the slowest service of a lookup
+LOOKUP_TIMEOUT = max(spec['timeout'] for spec in SERVICE_REGISTRY.values())
+# seconds a whole lookup is waited for, unless the client sets a shorter
+# ?deadline=. Lookups unfinished by then are returned with the status
+# TIMEOUT, and their tasks expire on the workers
+LOOKUP_DEADLINE = float(environ.get('LOOKUP_DEADLINE', LOOKUP_TIMEOUT))
+TIMEOUT = 'timeout'  # status of a lookup task that did not finish in time
+BULK_MAX_HOSTS = 10000  # hosts accepted by a single bulk lookup
+BULK_MAX_IN_FLIGHT = 100  # unfinished tasks of a single bulk lookup
+INFLIGHT_COLLECTION = 'lookup_inflight'  # tasks shared by identical lookups
+WATCHER_POLL_INTERVAL = 0.5  # used when mongo change streams are unavailable
+WATCHER_START_TIMEOUT = 5  # seconds to wait for the change stream to open
+
+# Batch task endpoint settings
+TASKS_BATCH_MAX = 10000  # task ids resolved by a single request
+TASK_RESULT_FIELDS = ['result', 'date_done', 'traceback']
+TASK_WAIT_MAX = 60  # longest long poll of /tasks/result in seconds
+TASK_STREAM_TIMEOUT = 300  # longest /tasks/events stream in seconds
+TASK_STREAM_KEEPALIVE = 15  # seconds between two comments of a stream
+
+# Cache settings: seconds a lookup result is served from the cache
+CACHE_TTLS = {service: spec['cache_ttl']
+              for service, spec in SERVICE_REGISTRY.items()}
+CACHE_TTLS[VIRUSTOTAL] = 86400
+# seconds an expired result is still served while it is refreshed,
+# VirusTotal jobs are never served stale
+CACHE_STALE = {service: spec['cache_stale']
+               for service, spec in SERVICE_REGISTRY.items()}
+CACHE_MAXSIZE = 4096  # lookups kept in each gunicorn worker
+CACHE_COLLECTION = 'lookup_cache'
+# seconds a stale entry is left to the refresh of a single API process
+CACHE_REFRESH_CLAIM = LOOKUP_TIMEOUT
+VIRUSTOTAL_UNFINISHED_REUSE = 300  # seconds an unfinished job is reused
+
+# Host popularity settings: lookups are counted in a Count-Min sketch of
+# each API process, the most looked up (service, host) pairs are shared
+# for the hot host refresh of celery beat (see tasks/refresh.py)
+POPULARITY_WIDTH = 2048  # counters of a sketch row
+POPULARITY_DEPTH = 4  # sketch rows, each with its own hash
+POPULARITY_TOP_K = 256  # keys tracked by each process
+POPULARITY_FLUSH_INTERVAL = 30  # seconds between two shared score updates
+POPULARITY_DECAY_INTERVAL = 600  # seconds between two halvings
+POPULARITY_COLLECTION = 'host_popularity'
+VIRUSTOTAL_BUCKET_COLLECTION = 'virustotal_buckets'  # see tasks/throttle.py
+
+# Lookup history settings: results of every completed lookup, written
+# in batches by the task workers (see tasks/history.py)
+HISTORY_COLLECTION = 'lookup_history'
+HISTORY_PAGE_SIZE = 100  # entries of a page by default
+HISTORY_PAGE_MAX = 1000  # largest page of /history
+
+# Async lookup job settings
+JOB_COLLECTION = 'lookup_jobs'
+JOB_EXPIRES = 86400  # seconds a job record is kept
+
+# Priority lanes: RabbitMQ priority of the tasks published for each
+# kind of request. Workers take the highest priority message of a queue
+# first; background VirusTotal jobs have a worker of their own (see
+# docker-compose.yml) so they neither delay lookups nor starve behind them
+INTERACTIVE = 'interactive'  # lookups waited for by the client
+BATCH = 'batch'  # bulk and async lookups
+BACKGROUND = 'background'  # VirusTotal jobs
+PRIORITY_LANES = {INTERACTIVE: 9, BATCH: 5, BACKGROUND: 1}
+PRIORITY_MAX = 10  # x-max-priority of the task queues, same as the workers
+# highest lane of an API key by the first 16 hex digits of its SHA-256,
+# e.g. {"1f2e...": "batch"} keeps the lookups of a scanner behind those
+# of interactive clients
+PRIORITY_LANES_BY_KEY = loads(environ.get('PRIORITY_LANES_BY_KEY', '{}'))
 
 # Celery settings
 CELERY_BROKER_URL = environ.get('CELERY_BROKER_URL')
 CELERY_BACKEND = environ.get('CELERY_BACKEND')
+# queue of each task, shared with the workers through the .env file
+CELERY_TASK_ROUTES = {task: {'queue': queue} for task, queue in
+                      loads(environ.get('CELERY_TASK_ROUTES', '{}')).items()}
+RESULT_EXPIRES = 86400  # seconds a task result is kept by default
+# the tasks of a request are published as one batch, the broker
+# confirming every message of the batch at once (see publisher.py)
+PUBLISH_CONFIRM = environ.get('PUBLISH_CONFIRM', 'true').lower() == 'true'
+PUBLISH_CONFIRM_TIMEOUT = 5  # seconds to wait for the confirms of a batch
+# results larger than this many bytes are stored zlib compressed,
+# same as the task workers
+RESULT_COMPRESS_THRESHOLD = 4096
+RESULT_COMPRESS_LEVEL = 6
 
-# Auth
-TOKEN = environ.get('TOKEN')
+# Metrics settings, served at /api/metrics. Gunicorn workers share
+# their metrics through the files of PROMETHEUS_MULTIPROC_DIR when set
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60)  # latency histogram buckets in seconds
 
-# Host
-IP = 'IP'
-DOMAIN = 'DOMAIN'
+# Auth: API keys are stored hashed in KEY_COLLECTION with their scopes,
+# rate limit and priority lane (see keystore.py). TOKEN, when set, is a
+# key with every scope that is never stored
+TOKEN = environ.get('TOKEN')
+LOOKUP_SCOPE = 'lookup'  # /services/default and /services/bulk
+HISTORY_SCOPE = 'history'  # /history
+ADMIN_SCOPE = 'admin'  # /services/cache and /services/virustotal/queue
+SCOPES = [LOOKUP_SCOPE, HISTORY_SCOPE, ADMIN_SCOPE]
+KEY_COLLECTION = 'api_keys'
+KEY_CACHE_SIZE = 1024  # verified keys kept in each gunicorn worker
+KEY_CACHE_TTL = 60  # seconds a verified key is trusted without a read
+KEY_NEGATIVE_TTL = 5  # seconds an unknown key is rejected without a read
+# seconds between two reads of the keys revoked by any API process
+KEY_REVOCATION_INTERVAL = 5
+KEY_ROTATION_GRACE = 86400  # seconds a rotated key keeps working
 
 SAMPLE_APIKEY = \
     'enteryourvirustotalkeyhere'
@@ -1,7 +1,30 @@
 import pytest
 from flask import current_app
+from json import dumps, loads
+from queue import Queue
+from threading import Thread, Timer
 import time
+from pymongo.errors import BulkWriteError, OperationFailure
 from routes.services import service_available
+from backend import tasks_app
+from cache import LookupCache
+from history import LookupHistory
+from inflight import InFlightLookups
+from popularity import CountMinSketch, HostPopularity
+from publisher import TaskPublisher
+from ratelimit_storage import BatchedStorage
+from routes.helpers import rate_limit_key, field_tree, project, \
+    project_lookup
+from registry import ServiceRegistry
+from settings import SERVICE_REGISTRY, SCOPES
+from watcher import CompletionWatcher
+import routes.helpers as helpers
+import routes.history as history
+import routes.services as services
+import routes.tasks as tasks
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from bson import ObjectId
 
 from app import flask_app as app
 
@@ -25,6 +48,275 @@ def test_service_not_available():
         assert not service_available(service)
 
 
+def test_service_registry():
+    registry = ServiceRegistry(tasks_app)
+    assert registry.names('IP') == ['PING', 'RDAP']
+    assert registry.names('DOMAIN') == ['PING', 'RDAP', 'DNS']
+    assert service_available('dns', 'DOMAIN')
+    assert not service_available('dns', 'IP')
+
+    signature = registry.signature('rdap', '8.8.8.8', 'IP')
+    assert signature.task == 'tasks.rdap'
+    assert signature.args == ('8.8.8.8', 'IP')
+    assert signature.options['queue'] == 'rdap'
+    assert registry.signature('Dns', 'google.com', 'DOMAIN').args == \
+        ('google.com',)
+
+    # tasks expire and stop once their caller no longer waits
+    assert signature.options['expires'] == 60
+    assert signature.options['soft_time_limit'] == 60
+    signature = registry.signature('dns', 'google.com', 'DOMAIN', 30)
+    assert signature.options['expires'] == 15
+    assert registry.signature('rdap', '8.8.8.8', 'IP', 2.5) \
+        .options['soft_time_limit'] == 2.5
+
+
+def test_task_priority():
+    import backend
+
+    assert backend.task_priority('interactive') == 9
+    assert backend.task_priority('background', 'interactive') == 1
+    # the lookups of a key limited to the batch lane do not preempt
+    # interactive ones
+    assert backend.task_priority('interactive', 'batch') == 5
+    assert backend.task_priority('background', 'batch') == 1
+
+    registry = ServiceRegistry(tasks_app)
+    assert registry.signature('ping', '1.1.1.1', 'IP') \
+        .options['priority'] == 5
+    assert registry.signature('ping', '1.1.1.1', 'IP', priority=9) \
+        .options['priority'] == 9
+
+
+def test_lookup_cache():
+    cache = LookupCache(tasks_app, ttls={'PING': 60}, maxsize=1)
+    assert cache.get('ping', 'cache-test.example') is None
+    cache.set('PING', 'Cache-Test.Example.', {'success': True})
+    assert cache.get('ping', 'cache-test.example') == {'success': True}
+    # services without a ttl are never cached
+    cache.set('RDAP', 'cache-test.example', {})
+    assert cache.get('rdap', 'cache-test.example') is None
+    assert cache.info()['hits'] == 1
+
+
+class FakeCacheCollection(object):
+    """
+    In memory lookup cache and host popularity collection
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.scores = {}
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def replace_one(self, query, document, upsert=False):
+        self.documents[query['_id']] = dict(document)
+
+    def find_one(self, query):
+        document = self.documents.get(query['_id'])
+        if document and document['expires_at'] > query['expires_at']['$gt']:
+            return document
+        return None
+
+    def update_one(self, query, update):
+        document = self.documents.get(query['_id'])
+        now = query['fresh_until']['$lte']
+        claimed = document is not None and document['fresh_until'] <= now \
+            and not document.get('refresh_until', now) > now
+        if claimed:
+            document.update(update['$set'])
+        return SimpleNamespace(modified_count=int(claimed))
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            key = request._filter['_id']
+            self.scores[key] = self.scores.get(key, 0) + \
+                request._doc['$inc']['score']
+
+
+class FakeDatabaseApp(object):
+    def __init__(self, collection):
+        self.backend = self
+        self.database = {'lookup_cache': collection,
+                         'host_popularity': collection}
+
+
+def test_stale_while_revalidate():
+    collection = FakeCacheCollection()
+    refreshes = []
+    # no process tier, every read goes to the shared one
+    cache = LookupCache(FakeDatabaseApp(collection), ttls={'PING': 60},
+                        maxsize=0, stale={'PING': 60},
+                        refresh=lambda *args: refreshes.append(args))
+
+    cache.set('PING', 'Stale.Example', {'success': True})
+    assert cache.get('ping', 'stale.example') == {'success': True}
+    assert not refreshes
+
+    document = collection.documents['PING:stale.example']
+    document['fresh_until'] -= timedelta(seconds=61)
+
+    # served stale at once, refreshed by a single reader
+    assert cache.get('ping', 'stale.example') == {'success': True}
+    assert cache.get('ping', 'stale.example') == {'success': True}
+    assert refreshes == [('PING:stale.example', 'PING', 'stale.example',
+                          60, 60)]
+    assert cache.info()['stale_hits'] == 2
+
+    document['expires_at'] -= timedelta(seconds=121)
+    assert cache.get('ping', 'stale.example') is None
+
+
+def test_host_popularity():
+    sketch = CountMinSketch(width=64, depth=4)
+    for _ in range(4):
+        sketch.add('PING:a.example')
+    assert sketch.add('PING:b.example') >= 1
+    assert sketch.estimate('PING:a.example') >= 4
+    sketch.decay()
+    assert sketch.estimate('PING:a.example') >= 2
+
+    collection = FakeCacheCollection()
+    popularity = HostPopularity(FakeDatabaseApp(collection), top_k=2,
+                                flush_interval=0)
+    for host in ['a.example'] * 3 + ['b.example'] * 2 + ['c.example']:
+        popularity.record('ping', host, 'DOMAIN')
+
+    # the least looked up host does not make the top
+    assert collection.scores == {'PING:a.example': 3, 'PING:b.example': 2}
+
+
+class FakeStream(object):
+    def __init__(self, changes):
+        self.changes = changes
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __iter__(self):
+        while True:
+            change = self.changes.get()
+            self.resume_token = {'_data': change['fullDocument']['_id']}
+            yield change
+
+
+class FakeCollection(object):
+    """
+    In memory result collection, with or without change streams
+    """
+
+    def __init__(self, change_streams=True, on_watch=None):
+        self.change_streams = change_streams
+        self.on_watch = on_watch
+        self.documents = {}
+        self.changes = Queue()
+
+    def store(self, task_id, status, result):
+        document = {'_id': task_id, 'status': status, 'result': dumps(result)}
+        self.documents[task_id] = document
+        self.changes.put({'operationType': 'replace',
+                          'fullDocument': document})
+
+    def watch(self, pipeline, **kwargs):
+        if not self.change_streams:
+            raise OperationFailure('not a replica set')
+        if self.on_watch:
+            self.on_watch(self)
+        return FakeStream(self.changes)
+
+    def find(self, query, projection=None):
+        task_ids = query['_id']['$in']
+        ready = query.get('status', {}).get('$in')
+        documents = [document for id, document
+                     in list(self.documents.items()) if id in task_ids and
+                     (not ready or document['status'] in ready)]
+        if projection is not None:
+            documents = [{field: value for field, value in document.items()
+                          if field == '_id' or field in projection}
+                         for document in documents]
+        return documents
+
+
+class FakeBackend(object):
+    def __init__(self, collection):
+        self.collection = collection
+
+    def decode(self, data):
+        return loads(data)
+
+    def meta_from_decoded(self, meta):
+        return meta
+
+
+class FakeApp(object):
+    def __init__(self, collection):
+        self.backend = FakeBackend(collection)
+
+
+@pytest.mark.parametrize('change_streams', [True, False])
+def test_watcher_wait(change_streams):
+    collection = FakeCollection(change_streams)
+    watcher = CompletionWatcher(FakeApp(collection), interval=0.05)
+
+    # completed before anyone waited on it
+    collection.store('done', 'SUCCESS', 1)
+    Timer(0.1, collection.store, ('later', 'FAILURE', 'boom')).start()
+
+    completions = list(watcher.wait(['done', 'later', 'lost'], 0.5))
+
+    assert [id for id, meta in completions] == ['done', 'later', 'lost']
+    assert completions[0][1]['result'] == 1
+    assert completions[1][1]['status'] == 'FAILURE'
+    # still running after the timeout
+    assert completions[2][1] is None
+    assert watcher._waiters == {}
+
+
+def test_watcher_rechecks_when_stream_opens():
+    def finish_unnoticed(collection):
+        # completed after the waiter checked, before the stream opened
+        collection.documents['gap'] = {'_id': 'gap', 'status': 'SUCCESS',
+                                       'result': dumps('gap')}
+
+    collection = FakeCollection(on_watch=finish_unnoticed)
+    watcher = CompletionWatcher(FakeApp(collection), interval=0.05)
+
+    # registered while no stream is open, e.g. after a stream error
+    queue = Queue()
+    watcher._register(['gap'], queue)
+    Thread(target=watcher._watch, daemon=True).start()
+
+    task_id, meta = queue.get(timeout=1)
+    assert meta['result'] == 'gap'
+
+
+def test_watcher_subscription():
+    collection = FakeCollection()
+    watcher = CompletionWatcher(FakeApp(collection), interval=0.05)
+
+    subscription = watcher.subscribe(['a'])
+    assert subscription.get(0.05) is None
+
+    subscription.add(['b', 'c'])
+    collection.store('b', 'SUCCESS', 'b')
+    task_id, meta = subscription.get(1)
+    assert task_id == 'b' and meta['result'] == 'b'
+
+    subscription.discard(['c'])
+    assert subscription.pending == {'a'}
+    collection.store('c', 'SUCCESS', 'c')
+    assert subscription.get(0.1) is None
+
+    subscription.close()
+    assert watcher._waiters == {}
+
+
 def test_swagger_settings(client):
     url = '/api/swagger.json'  # The root url of the Swagger docs
     response = client.get(url)
@@ -88,6 +380,650 @@ def test_lookupservice_incorrect_token(client):
     assert key in response.data
 
 
+def test_bulk_lookup_empty_hosts(client):
+    url = '/api/services/bulk'
+    key = b'ERROR'
+    headers = {
+        'X-API-KEY': 'mytoken'
+    }
+    data = {
+        'hosts': [],
+        'services': ['ping']
+    }
+    response = client.post(url, json=data, headers=headers)
+    assert response.status_code == 400
+    assert key in response.data
+
+
+class FakeResult(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeChannel(object):
+    """
+    AMQP channel acknowledging every message published so far at once,
+    when the events of its connection are drained
+    """
+
+    def __init__(self):
+        self.events = {'basic_ack': set(), 'basic_nack': set()}
+        self.confirm_selects = 0
+        self.published = 0
+        self.drains = 0
+
+    def confirm_select(self):
+        self.confirm_selects += 1
+
+    def drain_events(self, timeout=None):
+        self.drains += 1
+        for callback in self.events['basic_ack']:
+            callback(self.published, True)
+
+
+class FakeProducer(object):
+    def __init__(self, channel):
+        self.channel = channel
+        self.connection = channel
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakePublishApp(object):
+    def __init__(self):
+        self.channel = FakeChannel()
+        self.sent = []
+
+    def producer_or_acquire(self):
+        return FakeProducer(self.channel)
+
+    def send_task(self, name, args=None, kwargs=None, producer=None,
+                  task_id=None, **options):
+        self.sent.append((name, args, options.get('queue')))
+        producer.channel.published += 1
+        return FakeResult(task_id)
+
+
+def test_publish_batch_confirms_once():
+    app = FakePublishApp()
+    publisher = TaskPublisher(app, confirm=True, timeout=1)
+    registry = ServiceRegistry(tasks_app)
+
+    for batch in range(2):
+        signatures = [registry.signature(service, 'example.com', 'DOMAIN')
+                      .set(task_id='{}-{}'.format(service, batch))
+                      for service in ['PING', 'RDAP', 'DNS']]
+        assert publisher.publish(signatures) == \
+            ['PING-{}'.format(batch), 'RDAP-{}'.format(batch),
+             'DNS-{}'.format(batch)]
+
+    # the channel is put in confirm mode once, each batch waits once
+    assert app.channel.confirm_selects == 1
+    assert app.channel.drains == 2
+    assert app.sent[:3] == [('tasks.ping', ('example.com',), 'ping'),
+                            ('tasks.rdap', ('example.com', 'DOMAIN'), 'rdap'),
+                            ('tasks.dns', ('example.com',), 'dns')]
+
+
+class FakeRegistryCollection(object):
+    """
+    In memory in-flight registry collection
+    """
+
+    def __init__(self):
+        self.documents = {}
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def bulk_write(self, requests, ordered=True):
+        errors = []
+        for index, request in enumerate(requests):
+            key = request._filter['_id']
+            expires = request._filter['expires_at']['$lte']
+            document = self.documents.get(key)
+            if document is not None and document['expires_at'] > expires:
+                errors.append({'index': index, 'code': 11000})
+            else:
+                self.documents[key] = dict(request._doc['$set'], _id=key)
+        if errors:
+            raise BulkWriteError({'writeErrors': errors})
+
+    def find(self, query):
+        return [self.documents[key] for key in query['_id']['$in']
+                if key in self.documents]
+
+    def delete_many(self, query):
+        for entry in query['$or']:
+            document = self.documents.get(entry['_id'])
+            if document and document['task_id'] == entry['task_id']:
+                del self.documents[entry['_id']]
+
+
+class FakeRegistryApp(object):
+    def __init__(self):
+        self.backend = self
+        self.database = {'lookup_inflight': FakeRegistryCollection()}
+
+
+@pytest.fixture
+def fake_tasks(monkeypatch):
+    """
+    Replace task publishing and the result backend: every published
+    task completes at once, except lookups of slow.example and DNS lookups
+    """
+    collection = FakeCollection()
+    published = []
+
+    class FakePublisher(object):
+        def publish(self, signatures):
+            task_ids = []
+            for signature in signatures:
+                task_id = signature.options.get('task_id') or \
+                    'task-{}'.format(len(published))
+                host = signature.kwargs.get('host') or signature.args[0]
+                published.append((task_id, host))
+                if host != 'slow.example' and signature.task != 'tasks.dns':
+                    collection.store(task_id, 'SUCCESS', {'host': host})
+                task_ids.append(task_id)
+            return task_ids
+
+    monkeypatch.setattr(services, 'task_publisher', FakePublisher())
+    monkeypatch.setattr(services, 'inflight_lookups',
+                        InFlightLookups(FakeRegistryApp()))
+    monkeypatch.setattr(services, 'watcher',
+                        CompletionWatcher(FakeApp(collection), interval=0.05))
+    monkeypatch.setattr(services, 'service_registry', ServiceRegistry(
+        tasks_app, {name: dict(spec, timeout=0.5)
+                    for name, spec in SERVICE_REGISTRY.items()}))
+    return published
+
+
+def test_do_bulk_in_flight_window(fake_tasks):
+    hosts = ['host{}.example'.format(i) for i in range(10)]
+    in_flight = []
+    lines = []
+
+    for line in services.do_bulk(hosts, ['ping', 'rdap'], 4, False):
+        lines.append(line)
+        in_flight.append(len(fake_tasks) - len(lines))
+
+    assert len(lines) == 20
+    assert len(fake_tasks) == 20
+    assert max(in_flight) < 4
+
+
+def test_identical_lookups_share_a_task(fake_tasks):
+    first, first_tasks = services.publish_services(
+        'slow.example', ['ping', 'rdap'], 'DOMAIN', False)
+    # another worker asks for the same lookups while they run
+    second, second_tasks = services.publish_services(
+        'SLOW.example', ['PING'], 'DOMAIN', False)
+
+    assert len(fake_tasks) == 2
+    assert list(second_tasks) == [id for id, service in first_tasks.items()
+                                  if service == 'ping']
+
+    # a lookup attached to the running task times out and releases it
+    lines = services.do_service('slow.example', ['ping'], 'DOMAIN', False)
+    assert lines[0]['results'] == 'The operation timed out.'
+    assert len(fake_tasks) == 2
+    services.publish_services('slow.example', ['ping'], 'DOMAIN', False)
+    assert len(fake_tasks) == 3
+
+
+def test_lookup_deadline(fake_tasks):
+    started = time.monotonic()
+    response = services.do_service('example.com', ['ping', 'dns'],
+                                   'DOMAIN', False, deadline=0.2)
+
+    # the finished service is returned, the other one times out
+    assert time.monotonic() - started < 0.45
+    results = {entry['service']: entry for entry in response}
+    assert results['ping']['results'] == {'host': 'example.com'}
+    assert 'status' not in results['ping']
+    assert results['dns']['status'] == 'timeout'
+
+
+def test_bulk_lookup_ndjson(client, fake_tasks):
+    url = '/api/services/bulk?cache=false'
+    headers = {
+        'X-API-KEY': 'mytoken'
+    }
+    data = {
+        'hosts': ['8.8.8.8', 'slow.example', 'not a host', 'slow.example'],
+        'services': ['ping', 'junk'],
+        'max_in_flight': 2
+    }
+    response = client.post(url, json=data, headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+
+    body = response.data.decode()
+    assert body.endswith('\n')
+    lines = [loads(line) for line in body.splitlines()]
+    results = {(line['host'], line['service']): line['results']
+               for line in lines}
+
+    assert len(lines) == 8
+    # the repeated slow host shares the task still in flight
+    assert len(fake_tasks) == 2
+    assert results[('8.8.8.8', 'ping')] == {'host': '8.8.8.8'}
+    assert results[('8.8.8.8', 'junk')] == 'invalid service'
+    assert results[('not a host', 'ping')] == 'invalid host'
+    assert results[('not a host', 'junk')] == 'invalid host'
+    assert results[('slow.example', 'ping')] == 'The operation timed out.'
+
+
+def test_bulk_lookup_max_in_flight(client):
+    url = '/api/services/bulk'
+    headers = {
+        'X-API-KEY': 'mytoken'
+    }
+    for max_in_flight in [0, 101]:
+        data = {
+            'hosts': ['8.8.8.8'],
+            'max_in_flight': max_in_flight
+        }
+        response = client.post(url, json=data, headers=headers)
+        assert response.status_code == 400
+
+
+def test_batch_task_status_and_result(client, monkeypatch):
+    collection = FakeCollection()
+    collection.store('done', 'SUCCESS', {'success': True})
+    collection.store('failed', 'FAILURE', 'boom')
+    monkeypatch.setattr(tasks, 'tasks_app', FakeApp(collection))
+
+    task_ids = ['done', 'failed', 'unknown', 'done']
+
+    response = client.post('/api/tasks/status', json={'task_ids': task_ids})
+    assert response.status_code == 200
+    assert response.json['tasks'] == [
+        {'task_id': 'done', 'status': 'SUCCESS'},
+        {'task_id': 'failed', 'status': 'FAILURE'},
+        {'task_id': 'unknown', 'status': 'PENDING'}]
+
+    response = client.post('/api/tasks/result', json={'task_ids': task_ids})
+    assert response.status_code == 200
+    results = {task['task_id']: task['result']
+               for task in response.json['tasks']}
+    assert results == {'done': {'success': True}, 'failed': 'boom',
+                       'unknown': None}
+
+    response = client.post('/api/tasks/result', json={'task_ids': []})
+    assert response.status_code == 400
+
+
+class FakeAsyncResult(object):
+    def __init__(self, collection, id):
+        self.collection = collection
+        self.id = id
+
+    @property
+    def state(self):
+        document = self.collection.documents.get(self.id)
+        return document['status'] if document else 'PENDING'
+
+    def get(self, timeout=None):
+        return loads(self.collection.documents[self.id]['result'])
+
+
+def test_task_result_long_poll(client, monkeypatch):
+    collection = FakeCollection()
+    app = FakeApp(collection)
+    app.AsyncResult = lambda id, app=None: FakeAsyncResult(collection, id)
+    monkeypatch.setattr(tasks, 'tasks_app', app)
+    monkeypatch.setattr(tasks, 'watcher',
+                        CompletionWatcher(app, interval=0.05))
+
+    Timer(0.2, collection.store, ('later', 'SUCCESS', 42)).start()
+    response = client.get('/api/tasks/result/later?wait=5')
+    assert response.status_code == 200
+    assert response.json['result'] == 42
+
+    response = client.get('/api/tasks/result/later?wait=-1')
+    assert response.status_code == 400
+
+
+def test_field_projection():
+    rdap = {'handle': 'NET-8-8-8-0-1', 'name': 'GOGL',
+            'entities': [{'handle': 'GOGL', 'roles': ['registrant']},
+                         {'handle': 'ABUSE5250-ARIN', 'roles': ['abuse']}]}
+    tree = field_tree(['rdap.entities.handle', 'rdap.name', 'ping'])
+    assert project(rdap, tree['rdap']) == {
+        'name': 'GOGL', 'entities': [{'handle': 'GOGL'},
+                                     {'handle': 'ABUSE5250-ARIN'}]}
+    # a shorter path keeps the whole value
+    assert field_tree(['rdap', 'rdap.name']) == {'rdap': None}
+    assert field_tree(['rdap.name', 'rdap']) == {'rdap': None}
+
+    entry = {'task_id': 'x', 'service': 'RDAP', 'results': rdap}
+    assert project_lookup(entry, tree)['results']['name'] == 'GOGL'
+    assert project_lookup(entry, field_tree(['ping'])) == {
+        'task_id': 'x', 'service': 'RDAP'}
+    assert project_lookup(entry, None) is entry
+
+
+def test_task_result_fields(client, monkeypatch):
+    collection = FakeCollection()
+    app = FakeApp(collection)
+    app.AsyncResult = lambda id, app=None: FakeAsyncResult(collection, id)
+    monkeypatch.setattr(tasks, 'tasks_app', app)
+
+    collection.store('report', 'SUCCESS', {
+        'detected_urls': [{'url': 'http://x.test/', 'positives': 1}],
+        'resolutions': [{'ip_address': '192.0.2.1'}] * 100})
+    response = client.get('/api/tasks/result/report'
+                          '?fields=detected_urls.url')
+    assert response.status_code == 200
+    assert response.json['result'] == {
+        'detected_urls': [{'url': 'http://x.test/'}]}
+
+
+def test_task_events(client, monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(tasks, 'watcher',
+                        CompletionWatcher(FakeApp(collection), interval=0.05))
+    monkeypatch.setattr(tasks, 'TASK_STREAM_TIMEOUT', 0.5)
+
+    collection.store('done', 'SUCCESS', 1)
+    Timer(0.1, collection.store, ('failed', 'FAILURE', 'boom')).start()
+
+    response = client.get('/api/tasks/events?task_id=done&task_id=failed'
+                          '&task_id=lost')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+
+    events = [event.split('\n') for event
+              in response.data.decode().strip().split('\n\n')]
+    assert [lines[0] for lines in events] == [
+        'event: result', 'event: result', 'event: timeout']
+    assert loads(events[0][1][len('data: '):]) == {
+        'task_id': 'done', 'status': 'SUCCESS', 'result': 1}
+    assert loads(events[1][1][len('data: '):])['result'] == 'boom'
+    assert loads(events[2][1][len('data: '):]) == {'task_ids': ['lost']}
+
+
+class FakeJobs(object):
+    def __init__(self, job):
+        self.job = job
+        self.finished = None
+
+    def get(self, job_id):
+        return dict(self.job, services=list(self.job['services']))
+
+    def finish(self, job_id, services):
+        self.finished = services
+        self.job = dict(self.job, status='SUCCESS', services=services,
+                        tasks=[])
+
+
+def test_lookup_job(client, monkeypatch):
+    jobs = FakeJobs({
+        '_id': 'job', 'host': '8.8.8.8', 'status': 'PENDING',
+        'services': [{'host': '8.8.8.8', 'service': 'junk',
+                      'results': 'invalid service'}],
+        'tasks': [{'task_id': 'ping', 'service': 'PING'},
+                  {'task_id': 'rdap', 'service': 'RDAP'}],
+        'created_at': datetime.utcnow()
+    })
+    metas = {
+        'ping': {'status': 'SUCCESS', 'result': {'success': True}},
+        'rdap': {'status': 'PENDING', 'result': None}
+    }
+    cached = []
+
+    monkeypatch.setattr(tasks, 'lookup_jobs', jobs)
+    monkeypatch.setattr(tasks, 'task_metas',
+                        lambda backend, task_ids: metas)
+    monkeypatch.setattr(tasks.lookup_cache, 'set',
+                        lambda *args: cached.append(args))
+
+    response = client.get('/api/tasks/job/job')
+    assert response.status_code == 200
+    assert response.json['status'] == 'PENDING'
+    statuses = {entry['service']: entry['status']
+                for entry in response.json['services']}
+    assert statuses == {'junk': 'FAILURE', 'PING': 'SUCCESS',
+                        'RDAP': 'PENDING'}
+    # nothing is cached before the job finished
+    assert cached == []
+
+    # the rdap task never finished within the lookup timeout
+    jobs.job['created_at'] = datetime.utcnow() - timedelta(hours=1)
+    response = client.get('/api/tasks/job/job')
+    assert response.json['status'] == 'SUCCESS'
+    statuses = {entry['service']: entry['status']
+                for entry in response.json['services']}
+    assert statuses['RDAP'] == 'timeout'
+    assert jobs.finished is not None
+    assert cached == [('PING', '8.8.8.8', {'success': True})]
+
+
+class FakeHistoryCollection(object):
+    """
+    In memory lookup history, matching the queries of LookupHistory
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    @staticmethod
+    def matches(document, query):
+        for field, condition in query.items():
+            if field == '$or':
+                if not any(FakeHistoryCollection.matches(document, option)
+                           for option in condition):
+                    return False
+                continue
+
+            value = document
+            for key in field.split('.'):
+                value = value[key]
+            if not isinstance(condition, dict):
+                condition = {'$eq': condition}
+            for operator, operand in condition.items():
+                if not {'$eq': lambda: value == operand,
+                        '$in': lambda: value in operand,
+                        '$gte': lambda: value >= operand,
+                        '$lt': lambda: value < operand}[operator]():
+                    return False
+        return True
+
+    def find(self, query):
+        self.cursor = SimpleNamespace(documents=[
+            document for document in self.documents
+            if self.matches(document, query)])
+        self.cursor.sort = self.sort
+        self.cursor.limit = self.limit
+        return self.cursor
+
+    def sort(self, keys):
+        self.cursor.documents.sort(key=lambda document: (
+            document['timestamp'], document['_id']), reverse=True)
+        return self.cursor
+
+    def limit(self, count):
+        return self.cursor.documents[:count]
+
+
+def test_lookup_history(client, monkeypatch):
+    start = datetime(2026, 1, 1)
+    documents = [{'_id': ObjectId(), 'timestamp': start +
+                  timedelta(minutes=minute // 2),
+                  'meta': {'host': '8.8.8.8', 'service': service},
+                  'result': dumps({'minute': minute})}
+                 for minute in range(10) for service in ('PING', 'RDAP')]
+    documents.append({'_id': ObjectId(), 'timestamp': start,
+                      'meta': {'host': '1.1.1.1', 'service': 'PING'},
+                      'result': dumps({})})
+    store = LookupHistory(FakeDatabaseApp(None), collection='history')
+    store.app.database['history'] = FakeHistoryCollection(documents)
+
+    # pages follow each other without gaps, even within the same minute
+    pages, cursor = [], None
+    while True:
+        entries, cursor = store.query('8.8.8.8', ['ping'], limit=3,
+                                      cursor=cursor)
+        pages.append(entries)
+        if cursor is None:
+            break
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+    assert [entry['results']['minute'] for page in pages
+            for entry in page] == list(range(9, -1, -1))
+
+    entries, cursor = store.query('8.8.8.8', since=start +
+                                  timedelta(minutes=1),
+                                  until=start + timedelta(minutes=2))
+    assert len(entries) == 4 and cursor is None
+    assert {entry['service'] for entry in entries} == {'PING', 'RDAP'}
+
+    monkeypatch.setattr(history, 'lookup_history', store)
+    headers = {'X-API-KEY': 'mytoken'}
+    response = client.get('/api/history/8.8.8.8?service=rdap&limit=4'
+                          '&until=2026-01-01T00:03:00Z&fields=rdap.minute',
+                          headers=headers)
+    assert response.status_code == 200
+    assert [entry['results'] for entry in response.json['history']] == \
+        [{'minute': 5}, {'minute': 4}, {'minute': 3}, {'minute': 2}]
+    assert response.json['history'][0]['timestamp'] == \
+        '2026-01-01T00:02:00'
+
+    response = client.get('/api/history/8.8.8.8?cursor=' +
+                          response.json['next_cursor'] + '&service=rdap'
+                          '&until=2026-01-01T00:03:00Z', headers=headers)
+    assert [entry['results']['minute']
+            for entry in response.json['history']] == [1, 0]
+    assert response.json['next_cursor'] is None
+
+    response = client.get('/api/history/8.8.8.8?cursor=junk',
+                          headers=headers)
+    assert response.status_code == 400
+
+
+class FakeKeyCollection(object):
+    """
+    In memory API key collection, counting its reads
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.reads = 0
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def insert_one(self, document):
+        self.documents[document['_id']] = dict(document)
+
+    def find_one(self, query):
+        self.reads += 1
+        document = self.documents.get(query['_id'])
+        if document and document['revoked_at'] is None:
+            return document
+        return None
+
+    def find(self, query, projection=None):
+        if 'revoked_at' in query and isinstance(query['revoked_at'], dict):
+            since = query['revoked_at']['$gte']
+            return [document for document in self.documents.values()
+                    if document['revoked_at'] and
+                    document['revoked_at'] >= since]
+        return [document for document in self.documents.values()
+                if query['$or'][0]['name'] == document['name'] and
+                document['revoked_at'] is None]
+
+    def update_many(self, query, update):
+        for key in query['_id']['$in']:
+            self.documents[key].update(update['$set'])
+        return SimpleNamespace(modified_count=len(query['_id']['$in']))
+
+
+def test_api_key_store(monkeypatch):
+    import keystore
+    monkeypatch.setattr(keystore, 'PRIORITY_LANES_BY_KEY',
+                        {keystore.key_digest('token'): 'batch'})
+    collection = FakeKeyCollection()
+    app = SimpleNamespace(backend=SimpleNamespace(
+        database={'keys': collection}))
+    store = keystore.ApiKeyStore(app, 'keys', revocation_interval=0,
+                                 token='token')
+
+    scanner = store.create('scanner', ['lookup'], '10/minute')
+    assert scanner not in str(collection.documents)
+    key = store.verify(scanner)
+    assert key['name'] == 'scanner' and key['scopes'] == {'lookup'}
+    assert key['rate_limit'] == '10/minute' and key['lane'] is None
+    # verified keys and unknown keys are cached
+    assert store.verify(scanner) == key
+    assert store.verify('unknown') is None
+    assert store.verify('unknown') is None
+    assert collection.reads == 2
+
+    # the key of TOKEN is never stored, PRIORITY_LANES_BY_KEY still apply
+    key = store.verify('token')
+    assert key['scopes'] == set(SCOPES) and key['lane'] == 'batch'
+    assert collection.reads == 2
+
+    # revoked by another process, dropped at the next poll
+    other = keystore.ApiKeyStore(app, 'keys', token=None)
+    assert other.revoke('scanner') == 1
+    assert store.verify(scanner) is None
+    assert collection.reads == 3
+
+    with pytest.raises(ValueError):
+        store.create('scanner', ['root'])
+
+
+def test_key_scopes(client, monkeypatch):
+    import keystore
+    collection = FakeKeyCollection()
+    store = keystore.ApiKeyStore(SimpleNamespace(backend=SimpleNamespace(
+        database={'keys': collection})), 'keys', token=None)
+    apikey = store.create('historian', ['history'])
+    monkeypatch.setattr(helpers, 'api_keys', store)
+
+    response = client.get('/api/services/cache',
+                          headers={'X-API-KEY': apikey})
+    assert response.status_code == 403
+    response = client.get('/api/history/8.8.8.8?until=x',
+                          headers={'X-API-KEY': apikey})
+    assert response.status_code == 400
+
+
+def test_batched_rate_limit_storage():
+    storage = BatchedStorage('batched+memory://', batch=3,
+                             flush_interval=60)
+
+    # the first hit is flushed, the next ones once a batch is full
+    assert [storage.incr('key', 60) for i in range(3)] == [1, 2, 3]
+    assert storage.shared.get('key') == 1
+    assert storage.incr('key', 60) == 4
+    assert storage.shared.get('key') == 4
+
+    # another process sees the flushed hits
+    other = BatchedStorage('batched+memory://', batch=3, flush_interval=60)
+    other.shared = storage.shared
+    assert other.incr('key', 60) == 5
+
+    storage.clear('key')
+    assert storage.get('key') == 0
+
+
+def test_rate_limit_key():
+    with app.test_request_context(headers={'X-API-KEY': 'mytoken'}):
+        assert rate_limit_key().startswith('key:')
+    # unknown keys cannot be used to get fresh limits
+    with app.test_request_context(headers={'X-API-KEY': 'random'},
+                                  environ_base={'REMOTE_ADDR': '10.1.2.3'}):
+        assert rate_limit_key() == '10.1.2.3'
+
+
 def test_rate_limit_endpoint(client):
     url = '/api/ratelimit/test'  # The test endpoint
     message = b'exceeded'
@@ -97,3 +1033,50 @@ def test_rate_limit_endpoint(client):
         response = client.get(url)
     assert response.status_code == 429  # HTTP 429 Too Many Requests
     assert message in response.data
+
+
+class FakeBuckets(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def find(self):
+        return self.buckets
+
+
+def test_virustotal_queues(client, monkeypatch):
+    now = time.time()
+    buckets = [
+        # two tasks reserved tokens one and two seconds ahead
+        {'_id': 'waiting', 'tokens': -2.0, 'updated': now,
+         'rate': 1.0, 'capacity': 4},
+        {'_id': 'idle', 'tokens': 0.0, 'updated': now - 3600,
+         'rate': 1.0, 'capacity': 4}
+    ]
+    app = FakeRegistryApp()
+    app.database['virustotal_buckets'] = FakeBuckets(buckets)
+    monkeypatch.setattr(services, 'tasks_app', app)
+
+    response = client.get('/api/services/virustotal/queue',
+                          headers={'X-API-KEY': 'mytoken'})
+    assert response.status_code == 200
+    assert response.json['waiting']['queue_depth'] == 2
+    assert response.json['idle'] == {'queue_depth': 0, 'tokens': 4}
+
+
+def test_metrics(client):
+    cache = LookupCache(tasks_app, ttls={'PING': 60})
+    cache.set('PING', 'metrics-test.example', {'success': True})
+    cache.get('ping', 'metrics-test.example')
+    client.get('/api/docs/')
+
+    # scraping is not rate limited
+    for i in range(6):
+        response = client.get('/api/metrics')
+        assert response.status_code == 200
+    assert response.content_type.startswith('text/plain')
+
+    text = response.data.decode()
+    assert 'api_request_duration_seconds_count{endpoint="/api/docs/",' \
+        'method="GET",status="200"}' in text
+    assert 'api_lookup_cache_total{result="local_hits",service="PING"}' \
+        in text
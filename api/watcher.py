@@ -0,0 +1,319 @@
+from logging import getLogger
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from os import getpid
+from celery import states
+from pymongo.errors import OperationFailure, PyMongoError
+from backend import tasks_app
+from settings import WATCHER_POLL_INTERVAL, WATCHER_START_TIMEOUT
+
+log = getLogger(__name__)
+
+
+def task_meta(backend, document):
+    """
+    Convert a raw document of the Celery Mongo result collection
+    into task meta data
+
+    :param backend: celery mongodb result backend
+    :param document: document of the result collection
+
+    Returns:
+        Dictionary. Task meta data with a decoded result
+    """
+
+    return backend.meta_from_decoded({
+        'task_id': document['_id'],
+        'status': document['status'],
+        'result': backend.decode(document['result']),
+        'date_done': document.get('date_done'),
+        'traceback': document.get('traceback'),
+        'children': document.get('children'),
+    })
+
+
+def task_metas(backend, task_ids, fields=None):
+    """
+    Fetch the meta data of many tasks with a single query
+
+    :param backend: celery mongodb result backend
+    :param task_ids: list of celery task ids
+    :param fields: fields of the result collection to read besides the
+                   status, e.g. ['result', 'date_done'], or None for the
+                   complete meta data
+
+    Returns:
+        Dictionary. Task meta data by task id, unknown tasks are PENDING
+    """
+
+    projection = None
+    if fields is not None:
+        projection = dict.fromkeys(['status'] + list(fields), 1)
+
+    metas = {}
+    cursor = backend.collection.find({'_id': {'$in': list(task_ids)}},
+                                     projection)
+    for document in cursor:
+        if fields is None:
+            metas[document['_id']] = task_meta(backend, document)
+            continue
+
+        meta = {'task_id': document['_id'], 'status': document['status']}
+        for field in fields:
+            value = document.get(field)
+            if field == 'result' and value is not None:
+                value = backend.decode(value)
+            meta[field] = value
+        metas[document['_id']] = meta
+
+    for task_id in task_ids:
+        if task_id not in metas:
+            metas[task_id] = {'task_id': task_id, 'status': states.PENDING}
+            for field in fields if fields is not None else ['result']:
+                metas[task_id][field] = None
+
+    return metas
+
+
+class CompletionWatcher(object):
+    """
+    Push task completions from the result backend to waiting requests.
+
+    A single background thread per API process watches the result
+    collection through a MongoDB change stream and hands every finished
+    task to the requests waiting on it. When change streams are not
+    available (standalone MongoDB) the thread falls back to one shared
+    `$in` query per interval covering the tasks of all waiting requests.
+    """
+
+    def __init__(self, app, interval=WATCHER_POLL_INTERVAL):
+        self.app = app
+        self.interval = interval
+        self._lock = Lock()
+        self._waiters = {}
+        self._thread = None
+        self._pid = None
+        self._ready = Event()
+        self._resume_token = None
+
+    @property
+    def collection(self):
+        return self.app.backend.collection
+
+    def _start(self):
+        """
+        Start the watcher thread once per process (gunicorn forks workers)
+        and wait until it listens for completions
+        """
+
+        with self._lock:
+            if self._thread is None or self._pid != getpid():
+                self._pid = getpid()
+                self._waiters = {}
+                self._ready = Event()
+                self._resume_token = None
+                self._thread = Thread(target=self._run,
+                                      name='completion-watcher',
+                                      daemon=True)
+                self._thread.start()
+
+        self._ready.wait(WATCHER_START_TIMEOUT)
+
+    def _run(self):
+        while True:
+            try:
+                self._watch()
+            except OperationFailure as e:
+                if self._resume_token is not None:
+                    # the resume point left the oplog, open a new stream
+                    log.info("Change stream not resumable: {}".format(e))
+                    self._resume_token = None
+                    continue
+                log.info("Change streams unavailable, polling: {}".format(e))
+                self._poll()
+            except PyMongoError as e:
+                log.info("Completion watcher error: {}".format(e))
+                sleep(self.interval)
+
+    def _watch(self):
+        pipeline = [{'$match': {
+            'operationType': {'$in': ['insert', 'replace', 'update']},
+            'fullDocument.status': {'$in': list(states.READY_STATES)}
+        }}]
+
+        with self.collection.watch(pipeline, full_document='updateLookup',
+                                   resume_after=self._resume_token) as stream:
+            # tasks that completed while no stream was open
+            with self._lock:
+                task_ids = list(self._waiters)
+            if task_ids:
+                self._check(task_ids)
+            self._ready.set()
+
+            for change in stream:
+                self._resume_token = stream.resume_token
+                self._dispatch(change['fullDocument'])
+
+    def _poll(self):
+        self._ready.set()
+
+        while True:
+            with self._lock:
+                task_ids = list(self._waiters)
+
+            if task_ids:
+                cursor = self.collection.find({
+                    '_id': {'$in': task_ids},
+                    'status': {'$in': list(states.READY_STATES)}
+                })
+                for document in cursor:
+                    self._dispatch(document)
+
+            sleep(self.interval)
+
+    def _dispatch(self, document):
+        with self._lock:
+            queues = self._waiters.pop(document['_id'], ())
+
+        if queues:
+            meta = task_meta(self.app.backend, document)
+            for queue in queues:
+                queue.put((document['_id'], meta))
+
+    def _register(self, task_ids, queue):
+        with self._lock:
+            for task_id in task_ids:
+                self._waiters.setdefault(task_id, []).append(queue)
+
+    def _unregister(self, task_ids, queue):
+        with self._lock:
+            for task_id in task_ids:
+                queues = self._waiters.get(task_id)
+                if queues and queue in queues:
+                    queues.remove(queue)
+                    if not queues:
+                        del self._waiters[task_id]
+
+    def _check(self, task_ids):
+        """
+        Dispatch tasks that completed before their waiters registered
+        """
+
+        cursor = self.collection.find({
+            '_id': {'$in': list(task_ids)},
+            'status': {'$in': list(states.READY_STATES)}
+        })
+        for document in cursor:
+            self._dispatch(document)
+
+    def subscribe(self, task_ids=()):
+        """
+        Open a subscription to task completions
+
+        :param task_ids: list of celery task ids to start with
+
+        Returns:
+            Subscription. More task ids can be added while it is open
+        """
+
+        self._start()
+
+        subscription = Subscription(self)
+        subscription.add(task_ids)
+        return subscription
+
+    def wait(self, task_ids, timeout):
+        """
+        Wait for a set of tasks and yield each one as soon as it completes
+
+        :param task_ids: list of celery task ids
+        :param timeout: seconds to wait for all of the tasks
+
+        Returns:
+            Generator of (task_id, meta) in completion order. Tasks still
+            running after the timeout are yielded last with a None meta
+        """
+
+        deadline = monotonic() + timeout
+        subscription = self.subscribe(task_ids)
+
+        try:
+            while subscription.pending:
+                completion = subscription.get(deadline - monotonic())
+                if completion is None:
+                    break
+                yield completion
+
+        finally:
+            subscription.close()
+
+        for task_id in subscription.pending:
+            yield task_id, None
+
+
+class Subscription(object):
+    """
+    Completions of a growing set of tasks delivered by a CompletionWatcher
+    """
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self.queue = Queue()
+        self.pending = set()
+
+    def add(self, task_ids):
+        """
+        Start waiting on more tasks
+
+        :param task_ids: list of celery task ids
+        """
+
+        task_ids = [id for id in task_ids if id not in self.pending]
+        if task_ids:
+            self.pending.update(task_ids)
+            self.watcher._register(task_ids, self.queue)
+            self.watcher._check(task_ids)
+
+    def get(self, timeout):
+        """
+        Wait for the next pending task to complete
+
+        :param timeout: seconds to wait
+
+        Returns:
+            Tuple (task_id, meta) OR None if nothing completed in time
+        """
+
+        deadline = monotonic() + timeout
+
+        while self.pending:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                task_id, meta = self.queue.get(timeout=remaining)
+            except Empty:
+                return None
+            if task_id in self.pending:
+                self.pending.discard(task_id)
+                return task_id, meta
+
+        return None
+
+    def discard(self, task_ids):
+        """
+        Stop waiting on tasks, e.g. once they timed out
+
+        :param task_ids: list of celery task ids
+        """
+
+        task_ids = [id for id in task_ids if id in self.pending]
+        self.pending.difference_update(task_ids)
+        self.watcher._unregister(task_ids, self.queue)
+
+    def close(self):
+        self.watcher._unregister(self.pending, self.queue)
+
+
+watcher = CompletionWatcher(tasks_app)
@@ -0,0 +1,269 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from json import dump, load
+from math import ceil
+from os import environ, makedirs
+from os.path import dirname, join
+from threading import local
+from time import perf_counter
+
+from requests import Session
+
+SCENARIOS = ['lookup', 'virustotal', 'status', 'result']
+
+# latencies compared with a baseline run
+COMPARED = ['p50', 'p95', 'p99']
+
+_sessions = local()
+
+
+def session():
+    """
+    Returns:
+        Session. Keep-alive session of the current thread
+    """
+    if not hasattr(_sessions, 'session'):
+        _sessions.session = Session()
+    return _sessions.session
+
+
+def percentile(values, percent):
+    """
+    Nearest rank percentile
+
+    Args:
+        values: sorted list of numbers
+        percent: 0 to 100
+
+    Returns:
+        Float. The percentile OR None for no values
+    """
+    if not values:
+        return None
+    rank = max(1, int(ceil(percent / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+def summary(latencies, errors, duration):
+    """
+    Args:
+        latencies: seconds of each successful request
+        errors: number of failed requests
+        duration: seconds of the whole run
+
+    Returns:
+        JSON: throughput and latency percentiles in milliseconds
+    """
+    values = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'requests': len(values) + errors,
+        'errors': errors,
+        'duration': round(duration, 3),
+        'throughput': round(len(values) / duration, 3) if duration else None,
+        'latency_ms': {
+            'p50': ms(percentile(values, 50)),
+            'p95': ms(percentile(values, 95)),
+            'p99': ms(percentile(values, 99)),
+            'max': ms(values[-1] if values else None),
+            'mean': ms(sum(values) / len(values) if values else None)
+        }
+    }
+
+
+class Benchmark(object):
+    """
+    Drive the API endpoints at a fixed concurrency
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.url = args.url.rstrip('/')
+        self.headers = {'X-API-KEY': args.token}
+        self.params = {} if args.cache else {'cache': 'false'}
+        self.task_ids = []
+
+    def host(self, index):
+        index %= self.args.hosts
+        if self.args.host_type == 'ip':
+            # benchmarking addresses (RFC 2544), sent to the fake RDAP server
+            return '198.18.{}.{}'.format(index // 250 % 250, index % 250 + 1)
+        return 'host{}.bench.test'.format(index)
+
+    def lookup(self, index):
+        response = session().post(
+            '{}/services/default/{}'.format(self.url, self.host(index)),
+            params=self.params, headers=self.headers,
+            json={'services': self.args.services}, timeout=120)
+        return response.status_code == 200 and \
+            'ERROR' not in response.json()
+
+    def virustotal(self, index):
+        response = session().post(
+            '{}/services/virustotal/domain/report'.format(self.url),
+            params=self.params, headers=self.headers,
+            json={'apikey': 'bench-key-{}'.format(index % self.args.keys),
+                  'domain_name': 'host{}.bench.test'.format(index)},
+            timeout=120)
+        task_id = response.json().get('task_id')
+        if response.status_code != 200 or not task_id:
+            return False
+        self.task_ids.append(task_id)
+        return True
+
+    def status(self, index):
+        task_id = self.task_ids[index % len(self.task_ids)]
+        response = session().get(
+            '{}/tasks/status/{}'.format(self.url, task_id),
+            headers=self.headers, timeout=120)
+        return response.status_code == 200
+
+    def result(self, index):
+        # long poll: measures the time until the task finished
+        task_id = self.task_ids[index % len(self.task_ids)]
+        response = session().get(
+            '{}/tasks/result/{}'.format(self.url, task_id),
+            params={'wait': self.args.wait}, headers=self.headers,
+            timeout=self.args.wait + 30)
+        return response.status_code == 200
+
+    def timed(self, operation, index):
+        started = perf_counter()
+        try:
+            ok = operation(index)
+        except Exception:
+            ok = False
+        return ok, perf_counter() - started
+
+    def run(self, scenario):
+        """
+        Send the requests of a scenario
+
+        Returns:
+            JSON: summary of the scenario
+        """
+        if scenario in ('status', 'result') and not self.task_ids:
+            # tasks to read, published outside of the measure
+            for index in range(self.args.requests):
+                self.virustotal(index)
+
+        operation = getattr(self, scenario)
+        latencies = []
+        errors = 0
+
+        started = perf_counter()
+        with ThreadPoolExecutor(self.args.concurrency) as executor:
+            for ok, elapsed in executor.map(
+                    lambda index: self.timed(operation, index),
+                    range(self.args.requests)):
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+
+        return summary(latencies, errors, perf_counter() - started)
+
+
+def compare(results, baseline, max_regression):
+    """
+    Compare the latencies of a run with a baseline run
+
+    Args:
+        results: results of this run
+        baseline: results of an earlier run
+        max_regression: allowed growth of a latency, 0.1 for 10%
+
+    Returns:
+        List. Description of each latency grown by more than allowed
+    """
+    regressions = []
+
+    for scenario, current in results['scenarios'].items():
+        previous = baseline['scenarios'].get(scenario)
+        if previous is None:
+            continue
+        for name in COMPARED:
+            now = current['latency_ms'][name]
+            before = previous['latency_ms'][name]
+            if now is None or not before:
+                continue
+            growth = now / before - 1
+            print('{:<12} {:<4} {:>10.1f} ms {:>10.1f} ms {:>+8.1%}'.format(
+                scenario, name, before, now, growth))
+            if growth > max_regression:
+                regressions.append('{} {} {:+.1%}'.format(
+                    scenario, name, growth))
+
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='Measure the throughput and '
+                                        'latency of the API endpoints')
+    parser.add_argument('--url', default='http://localhost:8000/api')
+    parser.add_argument('--token', default=environ.get('TOKEN', 'mytoken'))
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS,
+                        default=SCENARIOS)
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='requests sent at once')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests of each scenario')
+    parser.add_argument('--services', nargs='+', default=['rdap'],
+                        help='services of the lookup scenario')
+    parser.add_argument('--host-type', choices=['ip', 'domain'],
+                        default='domain')
+    parser.add_argument('--hosts', type=int, default=1000000,
+                        help='distinct hosts looked up, fewer hosts '
+                             'share in-flight lookups')
+    parser.add_argument('--keys', type=int, default=100,
+                        help='distinct VirusTotal API keys')
+    parser.add_argument('--cache', action='store_true',
+                        help='let the API answer from its lookup cache')
+    parser.add_argument('--wait', type=int, default=60,
+                        help='long poll seconds of the result scenario')
+    parser.add_argument('--output', default=join(
+        dirname(__file__), 'results',
+        datetime.utcnow().strftime('%Y%m%dT%H%M%SZ') + '.json'))
+    parser.add_argument('--compare', help='results of a baseline run')
+    parser.add_argument('--max-regression', type=float, default=0.1,
+                        help='allowed latency growth over the baseline')
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args)
+    results = {
+        'started': datetime.utcnow().isoformat() + 'Z',
+        'settings': {name: value for name, value in vars(args).items()
+                     if name not in ('token', 'output', 'compare')},
+        'scenarios': {}
+    }
+
+    for scenario in args.scenarios:
+        results['scenarios'][scenario] = report = benchmark.run(scenario)
+        latency = report['latency_ms']
+        print('{:<12} {:>6} requests {:>5} errors {:>9} req/s  '
+              'p50 {} ms  p95 {} ms  p99 {} ms'.format(
+                  scenario, report['requests'], report['errors'],
+                  report['throughput'], latency['p50'], latency['p95'],
+                  latency['p99']), flush=True)
+
+    makedirs(dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w') as f:
+        dump(results, f, indent=2)
+    print('Results saved to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, load(f), args.max_regression)
+        if regressions:
+            print('Latency regressions: {}'.format(', '.join(regressions)))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,163 @@
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from random import random, uniform
+from threading import Lock
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+
+# top level domains of the fake dns bootstrap registry
+TLDS = ['com', 'net', 'org', 'io', 'test']
+
+
+class Upstream(object):
+    """
+    Settings and counters of the fake upstream services
+    """
+
+    def __init__(self, base_url, latency, jitter, error_rate,
+                 throttle_rate):
+        self.base_url = base_url
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.lock = Lock()
+        self.counters = {}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def bootstrap(self, name):
+        """
+        Returns:
+            JSON: bootstrap registry sending every host to this server
+        """
+        entries = {
+            'ipv4': ['0.0.0.0/0'],
+            'ipv6': ['::/0'],
+            'asn': ['0-4294967295'],
+            'dns': TLDS
+        }[name]
+        return {'version': '1.0', 'publication': '2024-01-01T00:00:00Z',
+                'services': [[entries, [self.base_url + 'rdap/']]]}
+
+
+def rdap_payload(kind, handle):
+    return {'objectClassName': 'ip network' if kind == 'ip' else 'domain',
+            'handle': handle, 'ldhName': handle, 'port43': 'whois.test',
+            'status': ['active'], 'rdapConformance': ['rdap_level_0'],
+            'events': [{'eventAction': 'registration',
+                        'eventDate': '2000-01-01T00:00:00Z'}]}
+
+
+def virustotal_payload(domain):
+    return {'response_code': 1, 'verbose_msg': 'Domain found in dataset',
+            'domain': domain, 'categories': ['benchmark'],
+            'detected_urls': [], 'resolutions': [
+                {'ip_address': '192.0.2.1',
+                 'last_resolved': '2024-01-01 00:00:00'}]}
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    upstream = None
+
+    def send_json(self, status, data, headers=None):
+        body = dumps(data).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        upstream = self.upstream
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+
+        if url.path == '/stats':
+            with upstream.lock:
+                return self.send_json(200, dict(upstream.counters))
+
+        # the registries are served at once, they are not benchmarked
+        if parts[0] == 'rdap-bootstrap' and len(parts) == 2:
+            name = parts[1].replace('.json', '')
+            if name in ('ipv4', 'ipv6', 'asn', 'dns'):
+                upstream.count('bootstrap')
+                return self.send_json(200, upstream.bootstrap(name))
+
+        if parts[0] == 'rdap' and len(parts) == 3 and \
+                parts[1] in ('ip', 'domain', 'autnum'):
+            service = 'rdap'
+            payload = rdap_payload(parts[1], parts[2])
+        elif url.path == '/vtapi/v2/domain/report':
+            service = 'virustotal'
+            domain = parse_qs(url.query).get('domain', [''])[0]
+            payload = virustotal_payload(domain)
+        else:
+            upstream.count('not_found')
+            return self.send_json(404, {'error': 'not found'})
+
+        sleep(max(0.0, upstream.latency +
+                  uniform(-upstream.jitter, upstream.jitter)))
+
+        draw = random()
+        if draw < upstream.error_rate:
+            upstream.count(service + '_error')
+            return self.send_json(500, {'error': 'benchmark error'})
+        if draw < upstream.error_rate + upstream.throttle_rate:
+            upstream.count(service + '_throttled')
+            return self.send_json(429, {'error': 'benchmark throttle'},
+                                  {'Retry-After': '1'})
+
+        upstream.count(service)
+        self.send_json(200, payload)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(host, port, upstream):
+    """
+    Serve the fake RDAP, RDAP bootstrap and VirusTotal endpoints until
+    interrupted
+    """
+    UpstreamHandler.upstream = upstream
+    server = ThreadingHTTPServer((host, port), UpstreamHandler)
+    server.daemon_threads = True
+    print('Fake upstream on {}:{}, advertised as {}'.format(
+        host, server.server_port, upstream.base_url), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Local stand-ins of the RDAP and '
+                                        'VirusTotal services')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--base-url', default='http://upstream:8080/',
+                        help='URL of this server as seen by the workers')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='mean response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.05,
+                        help='response times vary by up to this many '
+                             'seconds around the mean')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='share of requests answered with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='share of requests answered with a 429')
+    args = parser.parse_args()
+
+    base_url = args.base_url if args.base_url.endswith('/') \
+        else args.base_url + '/'
+    serve(args.host, args.port, Upstream(base_url, args.latency, args.jitter,
+                                         args.error_rate, args.throttle_rate))
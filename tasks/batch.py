@@ -0,0 +1,82 @@
+from asyncio import Semaphore, TimeoutError, gather, run
+from threading import Lock
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from celery.utils.log import get_task_logger
+
+from settings import HTTP_CONNECT_TIMEOUT, RDAP_BATCH_CONCURRENCY, \
+    RDAP_BATCH_PER_SERVER, RDAP_BATCH_TIMEOUT
+
+logger = get_task_logger(__name__)  # Get logger by name
+
+# tasks of the gevent pool share an OS thread, where a single event loop
+# may run at once; their batches take turns
+_loop_lock = Lock()
+
+
+async def fetch(session, semaphore, url, timeout):
+    """
+    Return the JSON response of a GET request, once a slot of the
+    semaphore is free
+
+    Args:
+        session: aiohttp client session
+        semaphore: bounds the requests in flight
+        url: endpoint of the API
+        timeout: seconds to fetch the response, from the moment the
+            request is sent
+
+    Returns:
+        JSON: Result of request OR error information
+    """
+    async with semaphore:
+        try:
+            async with session.get(url, timeout=ClientTimeout(
+                    total=timeout, connect=HTTP_CONNECT_TIMEOUT)) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except TimeoutError:
+            logger.info('Timeout after {}s: {}'.format(timeout, url))
+            return {'status': 'ERROR',
+                    'desc': 'timed out after {}s'.format(timeout)}
+        except Exception as err:
+            logger.info('Error occurred: {}'.format(err))
+            return {'status': 'ERROR', 'desc': str(err) or repr(err)}
+
+
+async def gather_urls(urls, concurrency, per_server, timeout):
+    semaphore = Semaphore(concurrency)
+    connector = TCPConnector(limit=concurrency, limit_per_host=per_server)
+
+    async with ClientSession(connector=connector) as session:
+        responses = await gather(*[fetch(session, semaphore, url, timeout)
+                                   for url in urls.values()])
+
+    return dict(zip(urls, responses))
+
+
+def fetch_many(urls, concurrency=RDAP_BATCH_CONCURRENCY,
+               per_server=RDAP_BATCH_PER_SERVER, timeout=RDAP_BATCH_TIMEOUT):
+    """
+    Fetch many URLs concurrently on an event loop of its own
+
+    A failed or slow request only sets the error of its own key, the
+    others are returned as usual.
+
+    Args:
+        urls: URL by key
+        concurrency: requests in flight at once
+        per_server: requests in flight to the same server
+        timeout: seconds to fetch a single URL
+
+    Returns:
+        JSON: Result of request OR error information by key
+    """
+    if not urls:
+        return {}
+
+    logger.info('START FETCH {} urls'.format(len(urls)))
+    with _loop_lock:
+        results = run(gather_urls(urls, concurrency, per_server, timeout))
+    logger.info('END FETCH {} urls'.format(len(urls)))
+    return results
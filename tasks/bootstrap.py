@@ -0,0 +1,259 @@
+from bisect import bisect_right
+from ipaddress import ip_address, ip_network
+from json import dump, load
+from os import makedirs, replace, stat
+from os.path import join
+from tempfile import NamedTemporaryFile
+from time import monotonic
+
+from celery.utils.log import get_task_logger
+
+from helpers import api_request
+from settings import RDAP_BOOTSTRAP_DIR, RDAP_BOOTSTRAP_URLS, \
+    RDAP_BOOTSTRAP_CHECK_INTERVAL, RDAP_DOMAIN_URL, RDAP_IP_URL, IP, DOMAIN
+
+logger = get_task_logger(__name__)  # Get logger by name
+
+
+def base_url(urls):
+    """
+    Pick the RDAP base URL of a bootstrap service entry
+
+    Args:
+        urls: list of base URLs of the authoritative server
+
+    Returns:
+        String. The first https URL (or the first URL) ending with a slash
+    """
+    url = next((url for url in urls if url.startswith('https://')), urls[0])
+    return url if url.endswith('/') else url + '/'
+
+
+class PrefixIndex(object):
+    """
+    Longest prefix match of IP addresses on the networks of a bootstrap
+    registry. Networks are hashed by prefix length, so a lookup costs one
+    dictionary access per distinct prefix length of the registry.
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self._tables = {}
+        self._lengths = []
+
+    def add(self, network, url):
+        network = ip_network(network, strict=False)
+        key = int(network.network_address) >> (self.bits - network.prefixlen)
+        self._tables.setdefault(network.prefixlen, {})[key] = url
+        self._lengths = sorted(self._tables, reverse=True)
+
+    def lookup(self, address):
+        value = int(address)
+        for length in self._lengths:
+            url = self._tables[length].get(value >> (self.bits - length))
+            if url is not None:
+                return url
+        return None
+
+
+class RangeIndex(object):
+    """
+    Interval lookup of AS numbers on the ranges of a bootstrap registry
+    """
+
+    def __init__(self):
+        self._ranges = []
+        self._starts = []
+
+    def add(self, entry, url):
+        start, _, end = entry.partition('-')
+        self._ranges.append((int(start), int(end or start), url))
+        self._ranges.sort()
+        self._starts = [start for start, _, _ in self._ranges]
+
+    def lookup(self, number):
+        position = bisect_right(self._starts, number) - 1
+        if position >= 0:
+            start, end, url = self._ranges[position]
+            if number <= end:
+                return url
+        return None
+
+
+class BootstrapIndex(object):
+    """
+    In memory index of the IANA RDAP bootstrap registries (RFC 9224)
+    resolving a host to the base URL of its authoritative RDAP server.
+
+    The registries are read from local files, which the
+    refresh_rdap_bootstrap task keeps up to date. Every worker process
+    reloads them when their modification time changed.
+    """
+
+    def __init__(self, directory=RDAP_BOOTSTRAP_DIR,
+                 check_interval=RDAP_BOOTSTRAP_CHECK_INTERVAL):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._mtimes = None
+        self._checked = None
+        self._indexes = self._build({})
+
+    def _build(self, registries):
+        indexes = {'ipv4': PrefixIndex(32), 'ipv6': PrefixIndex(128),
+                   'asn': RangeIndex(), 'dns': {}}
+
+        for name, registry in registries.items():
+            for entries, urls in registry.get('services', []):
+                url = base_url(urls)
+                for entry in entries:
+                    if name == 'dns':
+                        indexes['dns'][entry.lower().strip('.')] = url
+                    else:
+                        indexes[name].add(entry, url)
+
+        return indexes
+
+    def _mtime(self, name):
+        try:
+            return stat(join(self.directory, name + '.json')).st_mtime
+        except OSError:
+            return None
+
+    def missing(self):
+        """
+        Returns:
+            List. Names of the registries without a local file
+        """
+        return [name for name in RDAP_BOOTSTRAP_URLS
+                if self._mtime(name) is None]
+
+    def reload(self):
+        """
+        Rebuild the index if a registry file changed since the last load
+        """
+        mtimes = {name: self._mtime(name) for name in RDAP_BOOTSTRAP_URLS}
+        if mtimes == self._mtimes:
+            return
+
+        registries = {}
+        for name, mtime in mtimes.items():
+            if mtime is None:
+                continue
+            try:
+                with open(join(self.directory, name + '.json')) as f:
+                    registries[name] = load(f)
+            except (OSError, ValueError) as err:
+                logger.info('RDAP bootstrap {} not loaded: {}'
+                            .format(name, err))
+
+        # swap the whole index at once for the threads reading it
+        self._indexes = self._build(registries)
+        self._mtimes = mtimes
+
+    def _current(self):
+        now = monotonic()
+        if self._checked is None or now - self._checked >= \
+                self.check_interval:
+            self._checked = now
+            self.reload()
+        return self._indexes
+
+    def lookup_ip(self, host):
+        """
+        Args:
+            host: an IPv4 or IPv6 address
+
+        Returns:
+            String. Base URL of the authoritative server OR None
+        """
+        try:
+            address = ip_address(host)
+        except ValueError:
+            return None
+
+        indexes = self._current()
+        return indexes['ipv{}'.format(address.version)].lookup(address)
+
+    def lookup_asn(self, number):
+        """
+        Args:
+            number: an autonomous system number
+
+        Returns:
+            String. Base URL of the authoritative server OR None
+        """
+        return self._current()['asn'].lookup(int(number))
+
+    def lookup_domain(self, host):
+        """
+        Args:
+            host: a domain name
+
+        Returns:
+            String. Base URL of the authoritative server of the longest
+            matching suffix OR None
+        """
+        dns = self._current()['dns']
+        labels = host.lower().rstrip('.').split('.')
+
+        for position in range(len(labels)):
+            url = dns.get('.'.join(labels[position:]))
+            if url is not None:
+                return url
+        return None
+
+
+def refresh(directory=RDAP_BOOTSTRAP_DIR):
+    """
+    Download the IANA bootstrap registries into a local directory
+
+    Each file is replaced atomically so workers never read a partial one;
+    a registry that fails to download keeps its previous file.
+
+    Args:
+        directory: where the registry files are stored
+
+    Returns:
+        JSON: 'updated' OR error description by registry
+    """
+    makedirs(directory, exist_ok=True)
+    status = {}
+
+    for name, url in RDAP_BOOTSTRAP_URLS.items():
+        registry = api_request(url)
+        if 'services' not in registry:
+            status[name] = registry.get('desc', 'invalid registry')
+            continue
+
+        with NamedTemporaryFile('w', dir=directory, suffix='.tmp',
+                                delete=False) as f:
+            dump(registry, f)
+        replace(f.name, join(directory, name + '.json'))
+        status[name] = 'updated'
+
+    return status
+
+
+rdap_bootstrap = BootstrapIndex()
+
+
+def rdap_url(host, host_type):
+    """
+    Return the RDAP URL of a host on its authoritative server, so the
+    query does not follow the redirect of a bootstrap service
+
+    Args:
+        host: in the form of either an IP address or Domain name
+        host_type: IP, DOMAIN
+
+    Returns:
+        String. The URL OR None for an invalid host type
+    """
+    if host_type == IP:
+        server = rdap_bootstrap.lookup_ip(host)
+        return server + 'ip/' + host if server else RDAP_IP_URL + host
+    elif host_type == DOMAIN:
+        server = rdap_bootstrap.lookup_domain(host)
+        return server + 'domain/' + host if server else RDAP_DOMAIN_URL + host
+
+    return None
@@ -1,4 +1,19 @@
+from json import loads
 from os import environ
+from resultstore import backend_url
+from settings import RESULT_EXPIRES_DEFAULT, TASK_QUEUE_MAX_PRIORITY, \
+    TASK_DEFAULT_PRIORITY, WORKER_PREFETCH_MULTIPLIER
 
 broker_url = environ.get('CELERY_BROKER_URL')
-result_backend = environ.get('CELERY_BACKEND')
+# mongodb results are stored compressed above a size threshold
+result_backend = backend_url(environ.get('CELERY_BACKEND'))
+# results without an expiry are removed by the daily backend_cleanup
+# task of celery beat
+result_expires = RESULT_EXPIRES_DEFAULT
+# queue of each task, shared with the api through the .env file
+task_routes = {task: {'queue': queue} for task, queue in
+               loads(environ.get('CELERY_TASK_ROUTES', '{}')).items()}
+# priority queues, interactive lookups are delivered before bulk lookups
+task_queue_max_priority = TASK_QUEUE_MAX_PRIORITY
+task_default_priority = TASK_DEFAULT_PRIORITY
+worker_prefetch_multiplier = WORKER_PREFETCH_MULTIPLIER
@@ -1,24 +1,181 @@
-from requests import get
+from os import getpid
+from threading import local
+from time import perf_counter
+from requests import Session
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
 
 from celery.utils.log import get_task_logger
 
+from settings import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRIES, \
+    HTTP_BACKOFF_FACTOR, HTTP_BACKOFF_MAX, HTTP_RETRY_AFTER_MAX, \
+    HTTP_RETRY_STATUSES, HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE
+
 logger = get_task_logger(__name__)  # Get logger by name
 
+# timing of the upstream requests made by the current task
+_timing = local()
+
+
+def reset_request_timing():
+    """
+    Start collecting the upstream request timing of a new task
+    """
+    _timing.connect = 0.0
+    _timing.total = 0.0
+    _timing.requests = 0
+    _timing.retries = 0
+
+
+def request_timing():
+    """
+    Return the upstream request timing collected since the last reset
+
+    Returns:
+        JSON: handshake and transfer seconds, requests and retries OR
+        None if no request was made
+    """
+    if not getattr(_timing, 'requests', 0):
+        return None
+
+    return {
+        'handshake': round(_timing.connect, 6),
+        'transfer': round(_timing.total - _timing.connect, 6),
+        'total': round(_timing.total, 6),
+        'requests': _timing.requests,
+        'retries': _timing.retries
+    }
+
+
+class CappedRetry(Retry):
+    """
+    Retry policy that gives up instead of sleeping on a Retry-After
+    longer than HTTP_RETRY_AFTER_MAX, so a throttled upstream cannot
+    hold a worker slot for minutes
+    """
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        if response is not None:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None and \
+                    retry_after > HTTP_RETRY_AFTER_MAX:
+                raise MaxRetryError(_pool, url, 'Retry-After {}s'
+                                    .format(retry_after))
+
+        retry = super().increment(method, url, response, error, _pool,
+                                  _stacktrace)
+        _timing.retries = getattr(_timing, 'retries', 0) + 1
+        return retry
+
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = perf_counter()
+        try:
+            super().connect()
+        finally:
+            _timing.connect = getattr(_timing, 'connect', 0.0) + \
+                perf_counter() - started
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = perf_counter()
+        try:
+            super().connect()
+        finally:
+            _timing.connect = getattr(_timing, 'connect', 0.0) + \
+                perf_counter() - started
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    Keep-alive connection pools, one per upstream host, that record
+    the time spent on TCP and TLS handshakes
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool
+        }
+
+
+_session = None
+_session_pid = None
+
+
+def http_session():
+    """
+    Return the HTTP session of the current worker process
+
+    The session is created on first use in each process so connections
+    are never shared across the fork of the prefork pool.
+
+    Returns:
+        Session. Pooled session retrying idempotent requests
+    """
+    global _session, _session_pid
+
+    if _session is None or _session_pid != getpid():
+        retries = CappedRetry(total=HTTP_RETRIES,
+                              backoff_factor=HTTP_BACKOFF_FACTOR,
+                              backoff_max=HTTP_BACKOFF_MAX,
+                              status_forcelist=HTTP_RETRY_STATUSES,
+                              allowed_methods=frozenset(['GET', 'HEAD']),
+                              respect_retry_after_header=True,
+                              raise_on_status=False)
+        adapter = TimedHTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                   pool_maxsize=HTTP_POOL_MAXSIZE,
+                                   max_retries=retries)
+
+        session = Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        _session, _session_pid = session, getpid()
+
+    return _session
+
 
 def api_request(url, params=None):
     """
-    Return status of a ping command
+    Return the JSON response of a GET request to an upstream API
+
+    The handshake and transfer time of the request is added to the
+    request_timing of the current task.
 
     Args:
-        host: in the form of either an IP address or Domain name
+        url: endpoint of the API
+        params: query string parameters
 
     Returns:
-        Boolean. Evaulation of exit code
+        JSON: Result of request OR error information
     """
     logger.info('START API REQUEST')
+
+    if not hasattr(_timing, 'requests'):
+        reset_request_timing()
+    started = perf_counter()
+
     try:
-        response = get(url, params=params, timeout=60)
+        response = http_session().get(
+            url, params=params,
+            timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
         # If successful, no Exception will be raised
         response.raise_for_status()
         logger.info('END API REQUEST')
@@ -29,3 +186,6 @@ def api_request(url, params=None):
     except Exception as err:
         logger.info('Other error occurred: {}'.format(err))
         return {'status': 'ERROR', 'desc': str(err)}
+    finally:
+        _timing.total += perf_counter() - started
+        _timing.requests += 1
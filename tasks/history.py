@@ -0,0 +1,173 @@
+from datetime import datetime
+from json import dumps
+from os import getpid
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from celery.utils.log import get_task_logger
+from pymongo.errors import CollectionInvalid, OperationFailure
+
+from settings import HISTORY_COLLECTION, HISTORY_EXPIRES, HISTORY_BATCH, \
+    HISTORY_FLUSH_INTERVAL, HISTORY_TASKS, HISTORY_BATCH_TASKS
+
+logger = get_task_logger(__name__)  # Get logger by name
+
+
+def normalize_host(host):
+    """
+    Returns:
+        String. Lower case host without surrounding blanks or trailing
+        dot, like the lookup cache of the API
+    """
+    return host.strip().lower().rstrip('.')
+
+
+def lookup_failed(result):
+    return isinstance(result, dict) and result.get('status') == 'ERROR'
+
+
+def history_entries(task_name, args, result, timestamp):
+    """
+    Return the history documents of a finished lookup task
+
+    Batch tasks (ping_many, rdap_batch) give one document per host.
+    Failed lookups are left out.
+
+    Args:
+        task_name: name of the celery task
+        args: positional arguments of the task, the host first
+        result: return value of the task
+        timestamp: time the task finished
+
+    Returns:
+        List. Documents of the history collection
+    """
+    if task_name in HISTORY_TASKS:
+        results = {args[0]: result}
+        service = HISTORY_TASKS[task_name]
+    elif task_name in HISTORY_BATCH_TASKS and isinstance(result, dict) \
+            and not lookup_failed(result):
+        results = result
+        service = HISTORY_BATCH_TASKS[task_name]
+    else:
+        return []
+
+    return [{'timestamp': timestamp,
+             'meta': {'host': normalize_host(host), 'service': service},
+             'result': dumps(value)}
+            for host, value in results.items() if not lookup_failed(value)]
+
+
+class LookupHistory(object):
+    """
+    Results of every completed lookup, kept HISTORY_EXPIRES seconds in a
+    MongoDB time-series collection read by /api/history.
+
+    Each worker process buffers its documents and inserts them together
+    once HISTORY_BATCH of them accumulated, or HISTORY_FLUSH_INTERVAL
+    seconds after the first one.
+    """
+
+    def __init__(self, app, collection=HISTORY_COLLECTION,
+                 batch=HISTORY_BATCH, interval=HISTORY_FLUSH_INTERVAL):
+        """
+        Args:
+            app: celery app of the mongodb result backend
+            collection: name of the history collection
+            batch: documents inserted at once
+            interval: longest time a document is buffered, in seconds
+        """
+        self.app = app
+        self.collection_name = collection
+        self.batch = batch
+        self.interval = interval
+        self._lock = Lock()
+        self._pending = []
+        self._first = None
+        self._pid = None
+
+    @property
+    def collection(self):
+        return self.app.backend.database[self.collection_name]
+
+    def ensure_collection(self):
+        """
+        Create the time-series collection and its index on host, service
+        and time; a regular collection with a TTL index on servers
+        older than MongoDB 5.0
+        """
+        database = self.app.backend.database
+        try:
+            database.create_collection(
+                self.collection_name,
+                timeseries={'timeField': 'timestamp', 'metaField': 'meta',
+                            'granularity': 'minutes'},
+                expireAfterSeconds=HISTORY_EXPIRES)
+        except CollectionInvalid:
+            pass  # already created
+        except OperationFailure as err:
+            logger.info('Time-series collections unavailable: {}'
+                        .format(err))
+            self.collection.create_index('timestamp',
+                                         expireAfterSeconds=HISTORY_EXPIRES)
+
+        self.collection.create_index([('meta.host', 1), ('meta.service', 1),
+                                      ('timestamp', -1)])
+
+    def _start(self):
+        # a flusher thread in each pool process, forked workers included
+        if self._pid != getpid():
+            self._pid = getpid()
+            Thread(target=self._run, name='history-flusher',
+                   daemon=True).start()
+
+    def _run(self):
+        while True:
+            sleep(self.interval)
+            self.flush(force=False)
+
+    def record(self, task_name, args, result):
+        """
+        Buffer the history of a finished task, inserting the buffer once
+        it is full
+
+        Args:
+            task_name: name of the celery task
+            args: positional arguments of the task
+            result: return value of the task
+        """
+        entries = history_entries(task_name, args, result,
+                                  datetime.utcnow())
+        if not entries:
+            return
+
+        with self._lock:
+            self._start()
+            if not self._pending:
+                self._first = monotonic()
+            self._pending.extend(entries)
+            full = len(self._pending) >= self.batch
+
+        if full:
+            self.flush()
+
+    def flush(self, force=True):
+        """
+        Insert the buffered documents with a single write
+
+        Args:
+            force: insert them even if the oldest one was buffered for
+                less than the flush interval
+        """
+        with self._lock:
+            if not self._pending or (not force and
+                                     monotonic() - self._first <
+                                     self.interval):
+                return
+            pending, self._pending = self._pending, []
+
+        try:
+            self.collection.insert_many(pending, ordered=False)
+        except Exception as err:
+            logger.info('{} history documents not stored: {}'
+                        .format(len(pending), err))
@@ -0,0 +1,129 @@
+from os import environ
+from time import time
+
+from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
+from celery.utils.log import get_task_logger
+from celery.utils.time import maybe_iso8601
+from prometheus_client import CollectorRegistry, Counter, Histogram, \
+    REGISTRY, start_http_server
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from settings import METRICS_BUCKETS
+
+logger = get_task_logger(__name__)  # Get logger by name
+
+queue_wait_seconds = Histogram(
+    'celery_task_queue_wait_seconds',
+    'Time a task message waited in the broker queue',
+    ['task', 'queue'], buckets=METRICS_BUCKETS)
+
+execution_seconds = Histogram(
+    'celery_task_execution_seconds',
+    'Time a worker spent running a task, by final state',
+    ['task', 'state'], buckets=METRICS_BUCKETS)
+
+upstream_seconds = Histogram(
+    'celery_task_upstream_seconds',
+    'Time a task spent on upstream HTTP requests',
+    ['task'], buckets=METRICS_BUCKETS)
+
+task_errors = Counter(
+    'celery_task_errors_total',
+    'Tasks raising an exception or returning an upstream error',
+    ['task', 'kind'])
+
+task_timeouts = Counter(
+    'celery_task_timeouts_total',
+    'Tasks stopped by their time limit', ['task'])
+
+task_retries = Counter(
+    'celery_task_retries_total',
+    'Tasks rescheduled, e.g. waiting for a VirusTotal token', ['task'])
+
+
+def queue_wait(request, now=None):
+    """
+    Return the time a task message waited in the broker queue
+
+    Messages are stamped with sent_at when published; a countdown or eta
+    is not counted as waiting.
+
+    Args:
+        request: celery request of the task
+        now: unix time the task started, defaults to the current time
+
+    Returns:
+        Float. Seconds OR None for a message without send time
+    """
+    sent = request.get('sent_at')
+    if sent is None:
+        return None
+
+    now = time() if now is None else now
+    eta = request.get('eta')
+    if eta:
+        sent = max(sent, maybe_iso8601(eta).timestamp())
+
+    return max(0.0, now - sent)
+
+
+def observe_start(task, now=None):
+    wait = queue_wait(task.request, now)
+    if wait is not None:
+        queue = (task.request.delivery_info or {}).get('routing_key')
+        queue_wait_seconds.labels(task.name, queue or 'unknown') \
+            .observe(wait)
+
+
+def observe_end(task, state, seconds, retval, timing):
+    """
+    Export the execution and upstream time of a finished task
+
+    Args:
+        task: the celery task
+        state: final state of the task
+        seconds: time the task ran
+        retval: return value of the task
+        timing: request_timing of the task OR None
+    """
+    execution_seconds.labels(task.name, state or 'unknown').observe(seconds)
+
+    if timing is not None:
+        upstream_seconds.labels(task.name).observe(timing['total'])
+
+    if isinstance(retval, dict) and retval.get('status') == 'ERROR':
+        task_errors.labels(task.name, 'upstream').inc()
+
+
+def observe_failure(task, exception):
+    if isinstance(exception, (SoftTimeLimitExceeded, TimeLimitExceeded)):
+        task_timeouts.labels(task.name).inc()
+    else:
+        task_errors.labels(task.name, 'exception').inc()
+
+
+def observe_retry(task):
+    task_retries.labels(task.name).inc()
+
+
+def start_exporter(port):
+    """
+    Serve the metrics of the worker over HTTP, collecting those of every
+    pool process from PROMETHEUS_MULTIPROC_DIR when set
+
+    Args:
+        port: port of the exporter, 0 disables it
+    """
+    if not port:
+        return
+
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in environ:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+
+    try:
+        start_http_server(port, registry=registry)
+        logger.info('Metrics exporter on port {}'.format(port))
+    except OSError as err:
+        logger.info('Metrics exporter not started: {}'.format(err))
@@ -0,0 +1,252 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count as counter
+from os import getpid
+from select import select
+from socket import socket, gethostbyname, error as socket_error, \
+    AF_INET, SOCK_DGRAM, SOCK_RAW, IPPROTO_ICMP
+from struct import pack, unpack
+from time import monotonic
+
+from celery.utils.log import get_task_logger
+
+from settings import PING_COUNT, PING_INTERVAL, PING_TIMEOUT
+
+logger = get_task_logger(__name__)  # Get logger by name
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+RESOLVER_THREADS = 32
+
+# sequence numbers are shared by every probe of the process so replies
+# of a previous sweep can never be mistaken for the current one
+_sequence = counter()
+
+
+def checksum(data):
+    """
+    Return the internet checksum (RFC 1071) of an ICMP packet
+
+    Args:
+        data: bytes of the packet
+
+    Returns:
+        Integer. 16 bit checksum
+    """
+    if len(data) % 2:
+        data += b'\0'
+
+    total = sum(unpack('!{}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+
+    return ~total & 0xffff
+
+
+def echo_request(identifier, sequence):
+    """
+    Build an ICMP echo request packet
+
+    Args:
+        identifier: 16 bit identifier (replaced by the kernel on
+                    datagram sockets)
+        sequence: 16 bit sequence number
+
+    Returns:
+        Bytes. The packet
+    """
+    payload = b'dev-api-app-probe'
+    header = pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    header = pack('!BBHHH', ICMP_ECHO_REQUEST, 0,
+                  checksum(header + payload), identifier, sequence)
+
+    return header + payload
+
+
+def open_socket():
+    """
+    Open an ICMP socket, preferring unprivileged datagram sockets
+
+    Returns:
+        Tuple. The socket and whether it delivers raw IP packets
+    """
+    try:
+        return socket(AF_INET, SOCK_DGRAM, IPPROTO_ICMP), False
+    except OSError:
+        # not in net.ipv4.ping_group_range, raw sockets need CAP_NET_RAW
+        return socket(AF_INET, SOCK_RAW, IPPROTO_ICMP), True
+
+
+def resolve(hosts):
+    """
+    Resolve host names to IPv4 addresses concurrently
+
+    Args:
+        hosts: list of IP addresses or Domain names
+
+    Returns:
+        Dictionary. Address by host, None for unknown hosts
+    """
+    def lookup(host):
+        try:
+            return gethostbyname(host)
+        except socket_error:
+            return None
+
+    with ThreadPoolExecutor(min(RESOLVER_THREADS, len(hosts) or 1)) as pool:
+        return dict(zip(hosts, pool.map(lookup, hosts)))
+
+
+def summary(sent, rtts):
+    """
+    Summarize the round trip times of a host
+
+    Args:
+        sent: number of echo requests sent
+        rtts: list of round trip times in milliseconds
+
+    Returns:
+        JSON: success, packet counts, loss and RTT min/avg/max
+    """
+    received = len(rtts)
+
+    return {
+        'success': received > 0,
+        'sent': sent,
+        'received': received,
+        'packet_loss': round(100.0 * (sent - received) / sent, 1)
+        if sent else 100.0,
+        'rtt_min': round(min(rtts), 3) if rtts else None,
+        'rtt_avg': round(sum(rtts) / received, 3) if rtts else None,
+        'rtt_max': round(max(rtts), 3) if rtts else None
+    }
+
+
+def sweep(addresses, count, interval, timeout):
+    """
+    Exchange ICMP echo requests and replies with many addresses
+
+    Args:
+        addresses: list of IPv4 addresses
+        count: echo requests sent to each address
+        interval: seconds between two rounds of requests
+        timeout: seconds to wait for replies after the last round
+
+    Returns:
+        Tuple. Requests sent and list of RTTs in milliseconds by address
+    """
+    sent = dict.fromkeys(addresses, 0)
+    rtts = {address: [] for address in addresses}
+    in_flight = {}
+
+    sock, raw = open_socket()
+    identifier = getpid() & 0xffff
+
+    try:
+        sock.setblocking(False)
+        next_round = monotonic()
+        rounds = 0
+        deadline = None
+
+        while True:
+            now = monotonic()
+
+            # send the next round of echo requests
+            if rounds < count and now >= next_round:
+                for address in addresses:
+                    sequence = next(_sequence) & 0xffff
+                    try:
+                        sock.sendto(echo_request(identifier, sequence),
+                                    (address, 0))
+                    except socket_error as err:
+                        logger.info('Probe {} failed: {}'.format(address,
+                                                                 err))
+                        continue
+                    sent[address] += 1
+                    in_flight[(address, sequence)] = monotonic()
+
+                rounds += 1
+                next_round = now + interval
+                if rounds == count:
+                    deadline = now + timeout
+
+            if deadline is not None and (now >= deadline or not in_flight):
+                break
+
+            wake = deadline if deadline is not None else next_round
+            readable, _, _ = select([sock], [], [], max(0, wake - now))
+            if not readable:
+                continue
+
+            # drain every reply that already arrived
+            while True:
+                try:
+                    packet, (address, _) = sock.recvfrom(1024)
+                except (BlockingIOError, InterruptedError):
+                    break
+
+                received = monotonic()
+                if raw:
+                    packet = packet[(packet[0] & 0x0f) * 4:]
+                if len(packet) < 8:
+                    continue
+
+                kind, _, _, reply_id, sequence = \
+                    unpack('!BBHHH', packet[:8])
+                if kind != ICMP_ECHO_REPLY or \
+                        (raw and reply_id != identifier):
+                    continue
+
+                started = in_flight.pop((address, sequence), None)
+                if started is not None:
+                    rtts[address].append((received - started) * 1000.0)
+
+    finally:
+        sock.close()
+
+    return sent, rtts
+
+
+def probe(hosts, count=PING_COUNT, interval=PING_INTERVAL,
+          timeout=PING_TIMEOUT):
+    """
+    Send ICMP echo requests to many hosts concurrently from one socket
+
+    Args:
+        hosts: list of IP addresses or Domain names
+        count: echo requests sent to each host
+        interval: seconds between two rounds of requests
+        timeout: seconds to wait for replies after the last round
+
+    Returns:
+        JSON: summary of each host (see summary) by host
+    """
+    logger.info('START PROBE {} hosts'.format(len(hosts)))
+
+    addresses = resolve(list(hosts))
+    targets = sorted(set(address for address in addresses.values()
+                         if address is not None))
+
+    sent, rtts = {}, {}
+    error = None
+    if targets and count > 0:
+        try:
+            sent, rtts = sweep(targets, count, interval, timeout)
+        except OSError as err:
+            # no ICMP socket (ping_group_range and CAP_NET_RAW missing)
+            logger.info('Probe failed: {}'.format(err))
+            error = str(err)
+
+    results = {}
+    for host, address in addresses.items():
+        if address is None:
+            results[host] = dict(summary(0, []), error='unknown host')
+        elif error is not None:
+            results[host] = dict(summary(0, []), address=address,
+                                 error=error)
+        else:
+            results[host] = dict(summary(sent.get(address, 0),
+                                         rtts.get(address, [])),
+                                 address=address)
+
+    logger.info('END PROBE {} hosts'.format(len(hosts)))
+    return results
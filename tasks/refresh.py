@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+from json import dumps
+
+from celery.utils.log import get_task_logger
+
+from settings import HOT_HOSTS_COLLECTION, LOOKUP_CACHE_COLLECTION, \
+    HOT_HOSTS_TOP_N, HOT_HOSTS_REFRESH_INTERVAL, HOT_HOSTS_DECAY, \
+    HOT_HOSTS_MIN_SCORE
+
+logger = get_task_logger(__name__)  # Get logger by name
+
+
+class HotHosts(object):
+    """
+    Lookups of the most popular hosts, refreshed before they go stale.
+
+    The API scores the (service, host) pairs it looks up most often in a
+    shared collection (api/popularity.py), with the task, arguments and
+    cache times of each. Every run of refresh_hot_hosts claims the top
+    scored lookups whose cached result goes stale within two refresh
+    intervals, and the lookup cache of the API is written by
+    store_lookup once they finish.
+    """
+
+    def __init__(self, app, collection=HOT_HOSTS_COLLECTION,
+                 cache_collection=LOOKUP_CACHE_COLLECTION,
+                 top_n=HOT_HOSTS_TOP_N, interval=HOT_HOSTS_REFRESH_INTERVAL):
+        """
+        Args:
+            app: celery app of the mongodb result backend
+            collection: name of the popularity collection of the API
+            cache_collection: name of the lookup cache collection of the API
+            top_n: lookups refreshed ahead of time
+            interval: seconds between two runs of refresh_hot_hosts
+        """
+        self.app = app
+        self.collection_name = collection
+        self.cache_collection_name = cache_collection
+        self.top_n = top_n
+        self.interval = interval
+
+    @property
+    def collection(self):
+        return self.app.backend.database[self.collection_name]
+
+    @property
+    def cache(self):
+        return self.app.backend.database[self.cache_collection_name]
+
+    def due(self, now=None):
+        """
+        Claim the top lookups to refresh, skipping those refreshed by
+        another run or by a stale read of the API
+
+        Args:
+            now: current UTC time, defaults to utcnow
+
+        Returns:
+            List. Popularity documents of the lookups to refresh, by
+            decreasing score
+        """
+        now = now or datetime.utcnow()
+        ahead = timedelta(seconds=2 * self.interval)
+
+        top = list(self.collection.find({'ttl': {'$gt': 0}})
+                   .sort('score', -1).limit(self.top_n))
+        cached = {entry['_id']: entry for entry in self.cache.find(
+            {'_id': {'$in': [lookup['_id'] for lookup in top]}},
+            {'fresh_until': 1})}
+
+        due = []
+        for lookup in top:
+            entry = cached.get(lookup['_id'])
+            if entry is None:
+                due.append(lookup)
+                continue
+
+            fresh_until = entry.get('fresh_until')
+            if fresh_until is not None and fresh_until - now > ahead:
+                continue
+
+            claimed = self.cache.update_one({
+                '_id': lookup['_id'],
+                'refresh_until': {'$not': {'$gt': now}}
+            }, {'$set': {'refresh_until': now + ahead}}).modified_count
+            if claimed:
+                due.append(lookup)
+
+        return due
+
+    def decay(self):
+        """
+        Age the scores, so hosts no longer looked up leave the top
+        """
+        self.collection.update_many({}, [{'$set': {
+            'score': {'$multiply': ['$score', HOT_HOSTS_DECAY]}}}])
+        self.collection.delete_many({'score': {'$lt': HOT_HOSTS_MIN_SCORE}})
+
+    def store(self, key, service, host, value, ttl, stale):
+        """
+        Write a lookup result to the cache of the API, in its format
+        (see LookupCache.set of api/cache.py)
+
+        Args:
+            key: cache key of the lookup
+            service: name of the service
+            host: normalized ip or domain name
+            value: result of the lookup
+            ttl: seconds the result is fresh
+            stale: seconds it is served stale after that
+        """
+        fresh_until = datetime.utcnow() + timedelta(seconds=ttl)
+        self.cache.replace_one({'_id': key}, {
+            '_id': key,
+            'service': service,
+            'host': host,
+            'value': dumps(value),
+            'fresh_until': fresh_until,
+            'expires_at': fresh_until + timedelta(seconds=stale)
+        }, upsert=True)
@@ -0,0 +1,183 @@
+from asyncio import gather, run
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from celery.utils.log import get_task_logger
+from dns.asyncresolver import Resolver
+from dns.exception import DNSException
+from dns.rdatatype import SOA
+from dns.resolver import NXDOMAIN, NoAnswer
+
+from settings import DNS_RECORD_TYPES, DNS_TIMEOUT, DNS_NAMESERVERS, \
+    DNS_CACHE_MAXSIZE, DNS_CACHE_MAX_TTL, DNS_NEGATIVE_TTL, \
+    DNS_NEGATIVE_TTL_MAX
+
+logger = get_task_logger(__name__)  # Get logger by name
+
+
+def negative_ttl(response):
+    """
+    Return the time a missing name or record may be cached (RFC 2308):
+    the smaller of the TTL and the minimum field of the SOA record in
+    the authority section
+
+    Args:
+        response: DNS message of the negative answer OR None
+
+    Returns:
+        Integer. Seconds, DNS_NEGATIVE_TTL without an SOA record
+    """
+    for rrset in getattr(response, 'authority', None) or []:
+        if rrset.rdtype == SOA:
+            return min(rrset.ttl, rrset[0].minimum, DNS_NEGATIVE_TTL_MAX)
+    return DNS_NEGATIVE_TTL
+
+
+def record_text(rdata):
+    """
+    Returns:
+        String. A record in presentation format, TXT strings joined
+    """
+    strings = getattr(rdata, 'strings', None)
+    if strings is not None:
+        return b''.join(strings).decode('utf-8', 'replace')
+    return rdata.to_text()
+
+
+class RecordCache(object):
+    """
+    Bounded LRU of DNS answers by (name, record type), shared by the
+    tasks of a worker process.
+
+    Answers are kept for the TTL of their records; missing names and
+    records are cached as well, for their negative TTL.
+    """
+
+    def __init__(self, maxsize=DNS_CACHE_MAXSIZE):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    def get(self, name, rdtype):
+        """
+        Returns:
+            JSON: cached answer OR None on a miss
+        """
+        key = (name, rdtype)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, name, rdtype, answer, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[(name, rdtype)] = (monotonic() + ttl, answer)
+            self._entries.move_to_end((name, rdtype))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class DnsResolver(object):
+    """
+    Resolve the records of a host with concurrent asynchronous queries,
+    answering from a process wide cache honouring the record TTLs
+    """
+
+    def __init__(self, cache=None, nameservers=DNS_NAMESERVERS,
+                 timeout=DNS_TIMEOUT):
+        self.cache = cache or RecordCache()
+        self.nameservers = nameservers
+        self.timeout = timeout
+        self._resolver = None
+
+    @property
+    def resolver(self):
+        if self._resolver is None:
+            resolver = Resolver()
+            if self.nameservers:
+                resolver.nameservers = self.nameservers
+            resolver.lifetime = self.timeout
+            self._resolver = resolver
+        return self._resolver
+
+    async def query(self, name, rdtype):
+        """
+        Return the answer to a single query, cached when it is final
+
+        Args:
+            name: absolute domain name
+            rdtype: record type, e.g. 'MX'
+
+        Returns:
+            JSON: records and nxdomain flag OR error information
+        """
+        answer = self.cache.get(name, rdtype)
+        if answer is not None:
+            return answer
+
+        try:
+            result = await self.resolver.resolve(name, rdtype, search=False)
+            answer = {'records': [record_text(rdata) for rdata in result]}
+            ttl = min(result.rrset.ttl, DNS_CACHE_MAX_TTL)
+        except NXDOMAIN as err:
+            responses = list(err.kwargs.get('responses', {}).values())
+            answer = {'records': [], 'nxdomain': True}
+            ttl = negative_ttl(responses[0] if responses else None)
+        except NoAnswer as err:
+            answer = {'records': []}
+            ttl = negative_ttl(err.kwargs.get('response'))
+        except DNSException as err:
+            # timeouts and server failures are not cached
+            logger.info('DNS {} {} failed: {}'.format(name, rdtype, err))
+            return {'status': 'ERROR', 'desc': str(err)}
+
+        self.cache.set(name, rdtype, answer, ttl)
+        return answer
+
+    async def query_all(self, host, rdtypes):
+        name = host.strip().lower().rstrip('.') + '.'
+        answers = await gather(*[self.query(name, rdtype)
+                                 for rdtype in rdtypes])
+        return dict(zip(rdtypes, answers))
+
+    def resolve(self, host, rdtypes=DNS_RECORD_TYPES):
+        """
+        Resolve the records of a host, every record type at once
+
+        Args:
+            host: a domain name
+            rdtypes: record types to query
+
+        Returns:
+            JSON: records by type, whether the name exists and the error
+            of each failed type OR error information if every type failed
+        """
+        answers = run(self.query_all(host, rdtypes))
+
+        errors = {rdtype: answer['desc'] for rdtype, answer in answers.items()
+                  if answer.get('status') == 'ERROR'}
+        if len(errors) == len(answers):
+            return {'status': 'ERROR', 'desc': next(iter(errors.values()))}
+
+        result = {
+            'host': host,
+            'nxdomain': any(answer.get('nxdomain')
+                            for answer in answers.values()),
+            'records': {rdtype: answer['records']
+                        for rdtype, answer in answers.items()
+                        if rdtype not in errors}
+        }
+        if errors:
+            result['errors'] = errors
+        return result
+
+
+dns_resolver = DnsResolver()
@@ -0,0 +1,152 @@
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from zlib import compress, decompress
+
+from bson.binary import Binary
+from celery.backends.mongodb import MongoBackend, BINARY_CODECS
+from pymongo import UpdateOne
+
+from settings import RESULT_COMPRESS_THRESHOLD, RESULT_COMPRESS_LEVEL, \
+    RESULT_EXPIRES, RESULT_EXPIRES_DEFAULT
+
+# BSON binary subtype of compressed results (128-255 are user defined)
+COMPRESSED_SUBTYPE = 0x80
+
+
+class CompressedMongoBackend(MongoBackend):
+    """
+    MongoDB result backend storing results larger than
+    RESULT_COMPRESS_THRESHOLD bytes zlib compressed.
+
+    Compressed results are BSON binaries of subtype COMPRESSED_SUBTYPE,
+    smaller results are stored as before, so both formats can be read.
+    The API uses the same backend (api/resultstore.py).
+    """
+
+    def encode(self, data):
+        payload = super().encode(data)
+
+        raw = payload.encode('utf-8') if isinstance(payload, str) \
+            else payload
+        if isinstance(raw, bytes) and len(raw) > RESULT_COMPRESS_THRESHOLD:
+            return Binary(compress(raw, RESULT_COMPRESS_LEVEL),
+                          COMPRESSED_SUBTYPE)
+
+        return payload
+
+    def decode(self, data):
+        if isinstance(data, Binary) and data.subtype == COMPRESSED_SUBTYPE:
+            data = decompress(data)
+            if self.serializer not in BINARY_CODECS:
+                data = data.decode('utf-8')
+
+        return super().decode(data)
+
+
+def backend_url(url):
+    """
+    Select the compressed backend for a mongodb result backend URL
+
+    Args:
+        url: result backend URL
+
+    Returns:
+        String. Backend URL understood by Celery
+    """
+    if url and url.startswith('mongodb'):
+        return 'resultstore:CompressedMongoBackend+' + url
+    return url
+
+
+def result_expires_at(task_name, now=None):
+    """
+    Args:
+        task_name: name of a celery task
+        now: time the result was stored, defaults to the current time
+
+    Returns:
+        Datetime. Time the result of the task may be removed
+    """
+    seconds = RESULT_EXPIRES.get(task_name, RESULT_EXPIRES_DEFAULT)
+    return (now or datetime.utcnow()) + timedelta(seconds=seconds)
+
+
+def ensure_indexes(collection):
+    """
+    Create the indexes of the result collection
+
+    Results are removed by a TTL index on expires_at, set per task type
+    when a task finishes. Status lookups read results by _id, which is
+    always indexed; date_done serves the cleanup of celery beat.
+
+    Args:
+        collection: the celery result collection
+    """
+    collection.create_index('expires_at', expireAfterSeconds=0)
+    collection.create_index('date_done')
+
+
+def migrate(collection, batch=500):
+    """
+    Bring results stored before the lifecycle management in line:
+    create the indexes, give every result an expiry and compress large
+    results
+
+    Args:
+        collection: the celery result collection
+        batch: documents rewritten per bulk write
+
+    Returns:
+        JSON: number of results expired and compressed
+    """
+    ensure_indexes(collection)
+    default = RESULT_EXPIRES_DEFAULT * 1000
+
+    # finished tasks expire after the default time from date_done,
+    # unfinished ones from now
+    expired = collection.update_many(
+        {'expires_at': None, 'date_done': {'$type': 'date'}},
+        [{'$set': {'expires_at': {'$add': ['$date_done', default]}}}]
+    ).modified_count
+    expired += collection.update_many(
+        {'expires_at': None},
+        {'$set': {'expires_at': datetime.utcnow() +
+                  timedelta(seconds=RESULT_EXPIRES_DEFAULT)}}
+    ).modified_count
+
+    compressed = 0
+    requests = []
+    cursor = collection.find({
+        'result': {'$type': 'string'},
+        '$expr': {'$gt': [{'$strLenBytes': '$result'},
+                          RESULT_COMPRESS_THRESHOLD]}
+    }, {'result': 1})
+
+    for document in cursor:
+        requests.append(UpdateOne(
+            {'_id': document['_id'], 'result': document['result']},
+            {'$set': {'result': Binary(
+                compress(document['result'].encode('utf-8'),
+                         RESULT_COMPRESS_LEVEL), COMPRESSED_SUBTYPE)}}))
+        if len(requests) == batch:
+            compressed += collection.bulk_write(
+                requests, ordered=False).modified_count
+            requests = []
+
+    if requests:
+        compressed += collection.bulk_write(
+            requests, ordered=False).modified_count
+
+    return {'expired': expired, 'compressed': compressed}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Migrate the celery result '
+                                        'collection to expiring, '
+                                        'compressed results')
+    parser.add_argument('--batch', type=int, default=500,
+                        help='documents rewritten per bulk write')
+    args = parser.parse_args()
+
+    from tasks import tasks_app
+    print(migrate(tasks_app.backend.collection, args.batch))
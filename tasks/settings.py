@@ -1,9 +1,124 @@
+from json import loads
 from os import environ
 
-VIRUSTOTAL_DOMAIN_REPORT_URL = \
-    'https://www.virustotal.com/vtapi/v2/domain/report'
-RDAP_DOMAIN_URL = 'https: //rdap.arin.net/registry/domain/'
-RDAP_IP_URL = 'https://rdap-bootstrap.arin.net/bootstrap/ip/'
+# upstream URLs can be set in the environment to run the workers against
+# the local stand-ins of benchmark/upstream.py
+VIRUSTOTAL_DOMAIN_REPORT_URL = environ.get(
+    'VIRUSTOTAL_DOMAIN_REPORT_URL',
+    'https://www.virustotal.com/vtapi/v2/domain/report')
+# fallbacks for hosts missing from the local bootstrap registries
+RDAP_DOMAIN_URL = environ.get('RDAP_DOMAIN_URL',
+                              'https://rdap.arin.net/registry/domain/')
+RDAP_IP_URL = environ.get('RDAP_IP_URL',
+                          'https://rdap-bootstrap.arin.net/bootstrap/ip/')
+
+# IANA RDAP bootstrap registries (RFC 9224)
+RDAP_BOOTSTRAP_BASE_URL = environ.get('RDAP_BOOTSTRAP_BASE_URL',
+                                      'https://data.iana.org/rdap/')
+RDAP_BOOTSTRAP_URLS = {
+    name: RDAP_BOOTSTRAP_BASE_URL + name + '.json'
+    for name in ('ipv4', 'ipv6', 'asn', 'dns')
+}
+RDAP_BOOTSTRAP_DIR = environ.get('RDAP_BOOTSTRAP_DIR', '/tmp/rdap-bootstrap')
+RDAP_BOOTSTRAP_REFRESH = 86400  # seconds between two downloads
+RDAP_BOOTSTRAP_CHECK_INTERVAL = 60  # seconds between two file checks
+
+# rdap_batch settings
+RDAP_BATCH_MAX_HOSTS = 1000  # hosts resolved by a single rdap_batch task
+RDAP_BATCH_CONCURRENCY = 50  # requests in flight at once in a task
+RDAP_BATCH_PER_SERVER = 10  # requests in flight to the same RDAP server
+RDAP_BATCH_TIMEOUT = 20  # seconds to fetch a single host
+
+# DNS service settings
+DNS_RECORD_TYPES = ['A', 'AAAA', 'MX', 'NS', 'TXT']
+DNS_TIMEOUT = 5  # seconds to resolve a single record type
+# name servers to query, defaults to those of /etc/resolv.conf
+DNS_NAMESERVERS = [server for server in
+                   environ.get('DNS_NAMESERVERS', '').split(',') if server]
+DNS_CACHE_MAXSIZE = 10000  # answers kept in each worker process
+DNS_CACHE_MAX_TTL = 86400  # longest time an answer is cached
+DNS_NEGATIVE_TTL = 300  # missing names without an SOA record
+DNS_NEGATIVE_TTL_MAX = 3600  # longest time a missing name is cached
+
+# HTTP client settings
+HTTP_CONNECT_TIMEOUT = 3.05  # seconds to establish a connection
+HTTP_READ_TIMEOUT = 30  # seconds to wait for the upstream between bytes
+HTTP_RETRIES = 3  # retries of idempotent requests
+HTTP_BACKOFF_FACTOR = 0.5  # sleep 0.5s, 1s, 2s... between retries
+HTTP_BACKOFF_MAX = 5  # longest backoff sleep in seconds
+HTTP_RETRY_AFTER_MAX = 10  # give up on a longer Retry-After header
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_POOL_CONNECTIONS = 10  # upstream hosts with a connection pool
+# connections kept per upstream in each worker process, match the
+# number of tasks a worker process runs at once
+HTTP_POOL_MAXSIZE = int(environ.get('HTTP_POOL_MAXSIZE', 1))
+
+# Metrics exporter of each worker, 0 disables it. Pool processes share
+# their metrics through the files of PROMETHEUS_MULTIPROC_DIR when set
+METRICS_PORT = int(environ.get('METRICS_PORT', 9808))
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60)  # latency histogram buckets in seconds
+
+# VirusTotal quotas shared by every worker: requests per minute and
+# burst of an API key. Public keys allow 4 requests per minute, other
+# keys are set in VIRUSTOTAL_QUOTAS by the first 16 hex digits of the
+# SHA-256 of the key, e.g. {"1f2e...": [1000, 50]}
+VIRUSTOTAL_RATE = int(environ.get('VIRUSTOTAL_RATE', 4))
+VIRUSTOTAL_BURST = int(environ.get('VIRUSTOTAL_BURST', 4))
+VIRUSTOTAL_QUOTAS = {digest: tuple(quota) for digest, quota in
+                     loads(environ.get('VIRUSTOTAL_QUOTAS', '{}')).items()}
+VIRUSTOTAL_BUCKET_COLLECTION = 'virustotal_buckets'
+
+# Priority queues: x-max-priority of the task queues, same as the api,
+# and priority of the tasks published by the workers (batch lane). Each
+# worker reserves a single message per process or green thread at a
+# time, the others wait in the broker where the highest priority is
+# delivered first
+TASK_QUEUE_MAX_PRIORITY = 10
+TASK_DEFAULT_PRIORITY = 5
+WORKER_PREFETCH_MULTIPLIER = 1
+
+# Hot host refresh: celery beat refreshes the lookups of the hosts most
+# looked up through the API (api/popularity.py) before they go stale,
+# spread over the refresh interval, at the priority of the background lane
+HOT_HOSTS_COLLECTION = 'host_popularity'
+LOOKUP_CACHE_COLLECTION = 'lookup_cache'
+HOT_HOSTS_TOP_N = 200  # lookups refreshed ahead of time
+HOT_HOSTS_REFRESH_INTERVAL = 60  # seconds between two runs
+HOT_HOSTS_DECAY = 0.9  # scores are multiplied by it on every run
+HOT_HOSTS_MIN_SCORE = 1  # lookups scored below it are forgotten
+HOT_HOSTS_PRIORITY = 1
+
+# Lookup history: results of the lookup tasks by host, service and time,
+# kept HISTORY_EXPIRES seconds for /api/history/<host>. Each worker
+# process inserts them by batches of HISTORY_BATCH documents, at most
+# HISTORY_FLUSH_INTERVAL seconds after they were buffered
+HISTORY_COLLECTION = 'lookup_history'
+HISTORY_EXPIRES = int(environ.get('HISTORY_EXPIRES', 90 * 86400))
+HISTORY_BATCH = 100
+HISTORY_FLUSH_INTERVAL = 5
+HISTORY_TASKS = {'tasks.ping': 'PING', 'tasks.rdap': 'RDAP',
+                 'tasks.dns': 'DNS'}
+# tasks looking up many hosts, returning the result of each host
+HISTORY_BATCH_TASKS = {'tasks.ping_many': 'PING', 'tasks.rdap_batch': 'RDAP'}
+
+# Result backend settings: seconds a task result is kept by task type
+RESULT_EXPIRES_DEFAULT = 86400
+RESULT_EXPIRES = {
+    'tasks.ping': 3600,
+    'tasks.ping_many': 3600,
+    'tasks.dns': 3600,
+    'tasks.refresh_rdap_bootstrap': 3600
+}
+# results larger than this many bytes are stored zlib compressed
+RESULT_COMPRESS_THRESHOLD = 4096
+RESULT_COMPRESS_LEVEL = 6
+
+# Ping settings
+PING_COUNT = 3  # echo requests sent to each host
+PING_INTERVAL = 0.2  # seconds between two rounds of echo requests
+PING_TIMEOUT = 1.0  # seconds to wait for replies after the last round
+PING_MAX_HOSTS = 1024  # hosts probed by a single ping_many task
 
 # Host
 IP = 'IP'
@@ -1,9 +1,25 @@
-from celery import Celery
+from celery import Celery, states
+from celery.signals import before_task_publish, task_prerun, \
+    task_postrun, task_failure, task_retry, worker_init, worker_ready, \
+    worker_process_shutdown, worker_shutdown
 from celery.utils.log import get_task_logger
-from os import environ, system
-from time import sleep
-from helpers import api_request
-from settings import RDAP_DOMAIN_URL, RDAP_IP_URL, IP, DOMAIN, VIRUSTOTAL_DOMAIN_REPORT_URL
+from os import environ
+from time import perf_counter, sleep, time
+from helpers import api_request, reset_request_timing, request_timing
+from prober import probe
+from throttle import TokenBuckets
+import metrics
+from resultstore import ensure_indexes, result_expires_at
+import bootstrap
+from bootstrap import rdap_bootstrap, rdap_url
+from batch import fetch_many
+from resolver import dns_resolver
+from refresh import HotHosts
+from history import LookupHistory
+from settings import VIRUSTOTAL_DOMAIN_REPORT_URL, \
+    PING_MAX_HOSTS, RDAP_BATCH_MAX_HOSTS, RDAP_BOOTSTRAP_REFRESH, VIRUSTOTAL_RATE, VIRUSTOTAL_BURST, \
+    VIRUSTOTAL_QUOTAS, VIRUSTOTAL_BUCKET_COLLECTION, METRICS_PORT, \
+    HOT_HOSTS_REFRESH_INTERVAL, HOT_HOSTS_PRIORITY
 
 logger = get_task_logger(__name__)  # Get logger by name
 
@@ -15,28 +31,210 @@ tasks_app = Celery('tasks')
 
 tasks_app.config_from_envvar('CELERY_CONFIG_MODULE')
 
+# requests per API key allowed by VirusTotal, shared by every worker
+virustotal_buckets = TokenBuckets(tasks_app, VIRUSTOTAL_BUCKET_COLLECTION,
+                                  VIRUSTOTAL_RATE, VIRUSTOTAL_BURST,
+                                  VIRUSTOTAL_QUOTAS)
+
+# lookups of the most popular hosts, refreshed ahead of time
+hot_hosts = HotHosts(tasks_app)
+
+# results of every completed lookup, read by /api/history
+lookup_history = LookupHistory(tasks_app)
+
+tasks_app.conf.beat_schedule = {
+    'refresh-rdap-bootstrap': {
+        'task': 'tasks.refresh_rdap_bootstrap',
+        'schedule': RDAP_BOOTSTRAP_REFRESH
+    },
+    'refresh-hot-hosts': {
+        'task': 'tasks.refresh_hot_hosts',
+        'schedule': HOT_HOSTS_REFRESH_INTERVAL
+    }
+}
+
+
+# start time of the tasks running in this process, by task id
+_started = {}
+
+
+@before_task_publish.connect
+def mark_sent(headers=None, **kwargs):
+    """
+    Stamp the messages published by a worker (retries, refreshes) with
+    their send time, like the API does
+    """
+    if headers is not None:
+        headers['sent_at'] = time()
+
+
+@task_prerun.connect
+def start_request_timing(task_id=None, task=None, **kwargs):
+    reset_request_timing()
+    _started[task_id] = perf_counter()
+    metrics.observe_start(task)
+
+
+@task_postrun.connect
+def export_task_metrics(task_id=None, task=None, retval=None, state=None,
+                        **kwargs):
+    started = _started.pop(task_id, None)
+    if started is not None:
+        metrics.observe_end(task, state, perf_counter() - started, retval,
+                            request_timing())
+
+
+@task_failure.connect
+def export_task_failure(sender=None, exception=None, **kwargs):
+    metrics.observe_failure(sender, exception)
+
+
+@task_retry.connect
+def export_task_retry(sender=None, **kwargs):
+    metrics.observe_retry(sender)
+
+
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    """
+    Serve the metrics of the worker and its pool processes
+    """
+    metrics.start_exporter(METRICS_PORT)
+
+
+@task_postrun.connect
+def store_result_metadata(task_id=None, task=None, **kwargs):
+    """
+    Store the task type, expiry and upstream request timing of a task
+    next to its result, outside of the payload returned to API clients
+    """
+    if task is None or not hasattr(task.backend, 'collection'):
+        return
+
+    metadata = {'task': task.name, 'expires_at': result_expires_at(task.name)}
+    timing = request_timing()
+    if timing is not None:
+        metadata['request_timing'] = timing
+
+    try:
+        task.backend.collection.update_one({'_id': task_id},
+                                           {'$set': metadata})
+    except Exception as err:
+        logger.info('Result metadata not stored: {}'.format(err))
+
+
+@worker_ready.connect
+def create_result_indexes(sender=None, **kwargs):
+    """
+    Create the expiry and lookup indexes of the result collection
+    """
+    try:
+        ensure_indexes(tasks_app.backend.collection)
+    except Exception as err:
+        logger.info('Result indexes not created: {}'.format(err))
+
+
+@task_postrun.connect
+def record_history(task=None, args=None, retval=None, state=None,
+                   **kwargs):
+    """
+    Buffer the result of a completed lookup for the history collection
+    """
+    if task is not None and state == states.SUCCESS:
+        lookup_history.record(task.name, args or [], retval)
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_history(**kwargs):
+    lookup_history.flush()
+
+
+@worker_ready.connect
+def create_history_collection(sender=None, **kwargs):
+    """
+    Create the time-series collection of the lookup history
+    """
+    try:
+        lookup_history.ensure_collection()
+    except Exception as err:
+        logger.info('History collection not created: {}'.format(err))
+
+
+@worker_ready.connect
+def load_rdap_bootstrap(sender=None, **kwargs):
+    """
+    Download the RDAP bootstrap registries when a worker starts without
+    them instead of waiting for the first scheduled refresh
+    """
+    if rdap_bootstrap.missing():
+        refresh_rdap_bootstrap.delay()
+
 
 # Defined a Celery task to ping a host
 @tasks_app.task()
 def ping(host):
     """
-    Return status of a ping command
+    Return status of ICMP echo requests sent to a host
 
     Args:
         host: in the form of either an IP address or Domain name
 
     Returns:
-        Boolean. Evaulation of exit code
+        JSON: success, packet loss and RTT min/avg/max in milliseconds
     """
     logger.info('START PING')
 
-    parameter = "-c"
-
-    exit_code = system("ping {} 3 {} > /dev/null 2>&1"
-                          .format(parameter, host))
+    result = probe([host])[host]
 
     logger.info('END PING')
-    return {'success': exit_code == 0}
+    return result
+
+
+# Defined a Celery task to ping many hosts concurrently
+@tasks_app.task()
+def ping_many(hosts):
+    """
+    Return status of ICMP echo requests sent to many hosts at once
+
+    Args:
+        hosts: list of IP addresses or Domain names
+
+    Returns:
+        JSON: result of ping for each host
+    """
+    logger.info('START PING MANY')
+
+    if len(hosts) > PING_MAX_HOSTS:
+        logger.info('END PING MANY')
+        return {'status': 'ERROR',
+                'desc': 'at most {} hosts are allowed'.format(PING_MAX_HOSTS)}
+
+    result = probe(hosts)
+
+    logger.info('END PING MANY')
+    return result
+
+
+# Defined a Celery task to resolve the DNS records of a domain
+@tasks_app.task()
+def dns(host):
+    """
+    Return the A, AAAA, MX, NS and TXT records of a domain, queried
+    concurrently and cached for the TTL of the records
+
+    Args:
+        host: a Domain name
+
+    Returns:
+        JSON: records by type OR error information
+    """
+    logger.info('START DNS')
+
+    result = dns_resolver.resolve(host)
+
+    logger.info('END DNS')
+    return result
 
 
 # Defined a Celery task to return rdap information for a given host (ip/domain)
@@ -54,14 +252,8 @@ def rdap(host, host_type):
     """
     logger.info('START RDAP')
 
-    domain_endpoint = RDAP_DOMAIN_URL
-    ip_endpoint = RDAP_IP_URL
-
-    if host_type == IP:
-        url = ip_endpoint + host
-    elif host_type == DOMAIN:
-        url = domain_endpoint + host
-    else:
+    url = rdap_url(host, host_type)
+    if url is None:
         logger.info('END RDAP')
         return {'status': 'ERROR', 'desc': 'invalid host type'}
 
@@ -70,22 +262,141 @@ def rdap(host, host_type):
     return response
 
 
+# Defined a Celery task to return rdap information for many hosts at once
+@tasks_app.task()
+def rdap_batch(hosts):
+    """
+    Return responses from rdap service endpoints for many hosts, fetched
+    concurrently by a single task
+
+    Args:
+        hosts: list of [host, host_type] pairs, host_type IP or DOMAIN
+
+    Returns:
+        JSON: Result of request by host, errors are reported per host
+    """
+    logger.info('START RDAP BATCH {} hosts'.format(len(hosts)))
+
+    if len(hosts) > RDAP_BATCH_MAX_HOSTS:
+        logger.info('END RDAP BATCH')
+        return {'status': 'ERROR', 'desc': 'at most {} hosts are allowed'
+                .format(RDAP_BATCH_MAX_HOSTS)}
+
+    results = {}
+    urls = {}
+    for host, host_type in hosts:
+        url = rdap_url(host, host_type)
+        if url is None:
+            results[host] = {'status': 'ERROR', 'desc': 'invalid host type'}
+        else:
+            urls[host] = url
+
+    results.update(fetch_many(urls))
+
+    logger.info('END RDAP BATCH {} hosts'.format(len(hosts)))
+    return results
+
+
+# Defined a Celery task to refresh the local RDAP bootstrap registries
+@tasks_app.task()
+def refresh_rdap_bootstrap():
+    """
+    Download the IANA RDAP bootstrap registries used to route rdap tasks
+
+    Returns:
+        JSON: 'updated' OR error description by registry
+    """
+    logger.info('START REFRESH RDAP BOOTSTRAP')
+
+    result = bootstrap.refresh()
+
+    logger.info('END REFRESH RDAP BOOTSTRAP')
+    return result
+
+
+# Defined a Celery task to refresh the lookups of the most popular hosts
+@tasks_app.task(ignore_result=True)
+def refresh_hot_hosts():
+    """
+    Publish the lookups of the most popular hosts about to go stale,
+    spread over the refresh interval, each storing its result in the
+    lookup cache of the API
+
+    Returns:
+        Integer. Number of lookups published
+    """
+    logger.info('START REFRESH HOT HOSTS')
+
+    due = hot_hosts.due()
+    for index, lookup in enumerate(due):
+        countdown = index * HOT_HOSTS_REFRESH_INTERVAL / len(due)
+        tasks_app.send_task(
+            lookup['task'], args=lookup['args'], queue=lookup['queue'],
+            priority=HOT_HOSTS_PRIORITY, countdown=countdown,
+            expires=countdown + HOT_HOSTS_REFRESH_INTERVAL,
+            link=store_lookup.s(lookup['_id'], lookup['service'],
+                                lookup['host'], lookup['ttl'],
+                                lookup['stale']))
+    hot_hosts.decay()
+
+    logger.info('END REFRESH HOT HOSTS {} lookups'.format(len(due)))
+    return len(due)
+
+
+# Defined a Celery task to store the result of a background lookup
+@tasks_app.task(ignore_result=True)
+def store_lookup(result, key, service, host, ttl, stale):
+    """
+    Store the result of a refreshed lookup in the lookup cache of the
+    API, linked to the lookup task. Failed lookups are not stored, the
+    cache keeps serving the previous result.
+
+    Args:
+        result: result of the lookup task
+        key: cache key of the lookup
+        service: name of the service
+        host: normalized ip or domain name
+        ttl: seconds the result is fresh
+        stale: seconds it is served stale after that
+    """
+    if isinstance(result, dict) and result.get('status') == 'ERROR':
+        logger.info('Refresh of {} failed: {}'.format(key, result.get('desc')))
+        return
+
+    hot_hosts.store(key, service, host, result, ttl, stale)
+
+
 # Defined a Celery task to return Virustotal information
 # for the domain/report endpont
-@tasks_app.task()
-def virustotal_domain_report(apikey, domain):
+@tasks_app.task(bind=True, max_retries=None)
+def virustotal_domain_report(self, apikey, domain, reserved=False):
     """
     Return response from VirusTotal domain report endpoint
 
+    The request waits for a token of the API key: when none is left the
+    task is rescheduled to the time of its reserved token instead of
+    being sent and rejected with a 429.
+
     Args:
         apikey: API Key to access VirusTotal
         domain: A domain name
+        reserved: a token was already taken for this task
 
     Returns:
         JSON: Result of request
     """
     logger.info('START VIRUSTOTAL DOMAIN REPORT')
 
+    if not reserved:
+        delay = virustotal_buckets.acquire(apikey)
+        if delay is None:
+            raise self.retry(countdown=1)
+        if delay > 0:
+            logger.info('VIRUSTOTAL DOMAIN REPORT DELAYED {:.1f}s'
+                        .format(delay))
+            raise self.retry(args=(apikey, domain),
+                             kwargs={'reserved': True}, countdown=delay)
+
     url = VIRUSTOTAL_DOMAIN_REPORT_URL
     params = {'apikey': apikey, 'domain': domain}
 
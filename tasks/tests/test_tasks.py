@@ -1,6 +1,25 @@
 import pytest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
 from os import environ
+from threading import Lock, Thread
+from time import sleep
+from datetime import datetime, timedelta
 from tasks import add_numbers, ping
+import prober
+from prober import probe, checksum
+import helpers
+from batch import fetch_many
+from bootstrap import BootstrapIndex
+from resultstore import CompressedMongoBackend, COMPRESSED_SUBTYPE, \
+    backend_url
+import throttle
+from metrics import queue_wait
+from resolver import DnsResolver
+from refresh import HotHosts
+from history import LookupHistory, history_entries
+from throttle import TokenBuckets, key_digest
+from helpers import api_request, reset_request_timing, request_timing
 
 broker_url = environ.get('CELERY_BROKER_URL')
 result_backend = environ.get('CELERY_BACKEND')
@@ -22,3 +41,396 @@ def test_ping():
     key = 'success'
     result = ping.delay('8.8.8.8').get(timeout=30)
     assert key in result
+
+
+def test_checksum():
+    # echo request with id 1 and sequence 1
+    assert checksum(b'\x08\x00\x00\x00\x00\x01\x00\x01') == 0xf7fd
+
+
+def test_probe_localhost():
+    result = probe(['127.0.0.1', 'nonexistent.invalid'], count=2,
+                   interval=0.1, timeout=1.0)
+    assert result['127.0.0.1']['success']
+    assert result['127.0.0.1']['received'] == 2
+    assert result['127.0.0.1']['rtt_min'] <= result['127.0.0.1']['rtt_max']
+    assert not result['nonexistent.invalid']['success']
+
+
+def test_probe_without_icmp_socket(monkeypatch):
+    def open_socket():
+        raise PermissionError(1, 'Operation not permitted')
+
+    monkeypatch.setattr(prober, 'open_socket', open_socket)
+    result = probe(['127.0.0.1'], count=1)
+    assert not result['127.0.0.1']['success']
+    assert result['127.0.0.1']['address'] == '127.0.0.1'
+    assert 'not permitted' in result['127.0.0.1']['error']
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = 0
+
+    def do_GET(self):
+        UpstreamHandler.requests += 1
+        # the first request is throttled
+        status = 429 if UpstreamHandler.requests == 1 else 200
+        body = dumps({'requests': UpstreamHandler.requests}).encode()
+        self.send_response(status)
+        self.send_header('Retry-After', '0')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), UpstreamHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:{}/'.format(server.server_port)
+    # drop the pooled keep-alive connections before stopping the server
+    if helpers._session is not None:
+        helpers._session.close()
+        helpers._session = None
+    server.shutdown()
+    server.server_close()
+
+
+def test_api_request_retries_and_reuses_connection(upstream):
+    reset_request_timing()
+    result = api_request(upstream)
+    assert result == {'requests': 2}
+    assert request_timing()['retries'] == 1
+
+    reset_request_timing()
+    result = api_request(upstream)
+    assert result == {'requests': 3}
+    # the keep-alive connection is reused, no new handshake
+    assert request_timing()['handshake'] == 0.0
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    lock = Lock()
+    active = 0
+    peak = 0
+
+    def do_GET(self):
+        with SlowHandler.lock:
+            SlowHandler.active += 1
+            SlowHandler.peak = max(SlowHandler.peak, SlowHandler.active)
+        sleep(2 if self.path == '/hang' else 0.2)
+        with SlowHandler.lock:
+            SlowHandler.active -= 1
+
+        status = 500 if self.path == '/fail' else 200
+        body = dumps({'path': self.path}).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def test_fetch_many_isolates_errors():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    urls = {'host{}'.format(i): url + str(i) for i in range(6)}
+    urls.update({'fail': url + 'fail', 'hang': url + 'hang'})
+    try:
+        results = fetch_many(urls, concurrency=3, per_server=3, timeout=1)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert all(results['host{}'.format(i)] == {'path': '/{}'.format(i)}
+               for i in range(6))
+    assert results['fail']['status'] == 'ERROR'
+    assert '500' in results['fail']['desc']
+    assert results['hang'] == {'status': 'ERROR',
+                               'desc': 'timed out after 1s'}
+    assert SlowHandler.peak <= 3
+
+
+def test_rdap_bootstrap_index(tmp_path):
+    registries = {
+        'ipv4': [[['8.0.0.0/8'], ['https://rdap.arin.net/registry/']],
+                 [['8.8.0.0/16'], ['http://nested.example/',
+                                   'https://nested.example']]],
+        'ipv6': [[['2001:200::/23'], ['https://rdap.apnic.net/']]],
+        'asn': [[['1-1876', '3000'], ['https://rdap.arin.net/registry/']]],
+        'dns': [[['com', 'net'], ['https://rdap.verisign.com/com/v1/']],
+                [['co.uk'], ['https://rdap.nominet.example/']]]
+    }
+    for name, services in registries.items():
+        (tmp_path / (name + '.json')).write_text(
+            dumps({'services': services}))
+
+    index = BootstrapIndex(str(tmp_path), check_interval=0)
+    assert index.missing() == []
+    assert index.lookup_ip('8.8.8.8') == 'https://nested.example/'
+    assert index.lookup_ip('8.1.1.1') == 'https://rdap.arin.net/registry/'
+    assert index.lookup_ip('9.9.9.9') is None
+    assert index.lookup_ip('2001:200::1') == 'https://rdap.apnic.net/'
+    assert index.lookup_asn(1876) == 'https://rdap.arin.net/registry/'
+    assert index.lookup_asn(3000) == 'https://rdap.arin.net/registry/'
+    assert index.lookup_asn(1877) is None
+    assert index.lookup_domain('WWW.Example.COM.') == \
+        'https://rdap.verisign.com/com/v1/'
+    assert index.lookup_domain('bbc.co.uk') == 'https://rdap.nominet.example/'
+    assert index.lookup_domain('example.invalid') is None
+
+    # a refreshed registry is picked up without a restart
+    (tmp_path / 'dns.json').unlink()
+    assert index.lookup_domain('example.com') is None
+    assert index.missing() == ['dns']
+
+
+class FakeBucketCollection(object):
+    def __init__(self):
+        self.documents = {}
+
+    def find_one(self, query):
+        document = self.documents.get(query['_id'])
+        return dict(document) if document else None
+
+    def insert_one(self, document):
+        self.documents[document['_id']] = dict(document)
+
+    def update_one(self, query, update):
+        document = self.documents.get(query['_id'])
+        matched = document is not None and all(
+            document[field] == value for field, value in query.items())
+        if matched:
+            document.update(update['$set'])
+        return type('UpdateResult', (), {'modified_count': int(matched)})
+
+
+def test_token_bucket_reserves_tokens_in_order(monkeypatch):
+    buckets = TokenBuckets(None, 'buckets', rate=60, capacity=2,
+                           quotas={key_digest('paid'): (600, 1)})
+    buckets._collection = FakeBucketCollection()
+    monkeypatch.setattr(throttle, 'time', lambda: 1000.0)
+
+    # the burst is served at once, then one token per second is reserved
+    delays = [buckets.acquire('free') for i in range(4)]
+    assert delays == [0.0, 0.0, 1.0, 2.0]
+    assert buckets.acquire('paid') == 0.0
+    assert buckets.acquire('paid') == pytest.approx(0.1)
+
+    # tokens refill with time
+    monkeypatch.setattr(throttle, 'time', lambda: 1003.0)
+    assert buckets.acquire('free') == 0.0
+    # the raw key is never stored
+    assert 'free' not in buckets._collection.documents
+
+
+class FakeCursor(list):
+    def sort(self, field, direction):
+        return FakeCursor(sorted(self, key=lambda document: document[field],
+                                 reverse=direction < 0))
+
+    def limit(self, count):
+        return FakeCursor(self[:count])
+
+
+class FakeHotHostsCollection(object):
+    """
+    In memory host popularity and lookup cache collection
+    """
+
+    def __init__(self, documents):
+        self.documents = {document['_id']: document for document in documents}
+
+    def find(self, query, projection=None):
+        if '_id' in query:
+            return [self.documents[key] for key in query['_id']['$in']
+                    if key in self.documents]
+        return FakeCursor(self.documents.values())
+
+    def update_one(self, query, update):
+        document = self.documents[query['_id']]
+        now = query['refresh_until']['$not']['$gt']
+        claimed = not document.get('refresh_until', now) > now
+        if claimed:
+            document.update(update['$set'])
+        return type('UpdateResult', (), {'modified_count': int(claimed)})
+
+
+def test_hot_hosts_due():
+    now = datetime.utcnow()
+    popularity = FakeHotHostsCollection([
+        {'_id': 'PING:{}.example'.format(name), 'score': score, 'ttl': 60}
+        for name, score in [('fresh', 9), ('stale', 8), ('missing', 7),
+                            ('cold', 1)]])
+    cache = FakeHotHostsCollection([
+        {'_id': 'PING:fresh.example', 'fresh_until': now + timedelta(hours=1)},
+        {'_id': 'PING:stale.example',
+         'fresh_until': now + timedelta(seconds=5)},
+        {'_id': 'PING:cold.example', 'fresh_until': now}])
+    app = type('App', (), {})()
+    app.backend = type('Backend', (), {})()
+    app.backend.database = {'popularity': popularity, 'cache': cache}
+    hot_hosts = HotHosts(app, 'popularity', 'cache', top_n=3, interval=60)
+
+    # the top lookups going stale soon or not cached at all, once
+    assert [lookup['_id'] for lookup in hot_hosts.due(now)] == \
+        ['PING:stale.example', 'PING:missing.example']
+    assert [lookup['_id'] for lookup in hot_hosts.due(now)] == \
+        ['PING:missing.example']
+
+
+class FakeHistoryCollection(object):
+    def __init__(self):
+        self.inserts = []
+
+    def insert_many(self, documents, ordered=True):
+        self.inserts.append(documents)
+
+
+def test_history_batches_lookups():
+    now = datetime.utcnow()
+    entries = history_entries('tasks.ping_many', [['a.example', 'B.example.']],
+                              {'a.example': {'success': True},
+                               'B.example.': {'status': 'ERROR'}}, now)
+    assert entries == [{'timestamp': now,
+                        'meta': {'host': 'a.example', 'service': 'PING'},
+                        'result': dumps({'success': True})}]
+    assert history_entries('tasks.add_numbers', [1, 2], 3, now) == []
+
+    collection = FakeHistoryCollection()
+    app = type('App', (), {})()
+    app.backend = type('Backend', (), {})()
+    app.backend.database = {'history': collection}
+    history = LookupHistory(app, 'history', batch=3, interval=3600)
+
+    for host in ['1.1.1.1', '8.8.8.8', '9.9.9.9', '8.8.4.4']:
+        history.record('tasks.ping', [host], {'success': True})
+    history.record('tasks.rdap', ['1.1.1.1'], {'status': 'ERROR'})
+
+    # a single insert once the batch is full, the rest on shutdown
+    assert [len(documents) for documents in collection.inserts] == [3]
+    history.flush(force=False)
+    assert len(collection.inserts) == 1
+    history.flush()
+    assert [len(documents) for documents in collection.inserts] == [3, 1]
+    assert collection.inserts[1][0]['meta']['host'] == '8.8.4.4'
+
+
+def test_compressed_result_backend():
+    from celery import Celery
+    app = Celery('test', backend=backend_url('mongodb://localhost/test'))
+    backend = app.backend
+    assert isinstance(backend, CompressedMongoBackend)
+
+    small = {'status': 'ok'}
+    large = {'entities': ['x' * 100] * 100}
+    assert backend.encode(small) == dumps(small)
+    assert backend.encode(large).subtype == COMPRESSED_SUBTYPE
+    assert backend.decode(backend.encode(small)) == small
+    assert backend.decode(backend.encode(large)) == large
+
+
+def test_queue_wait():
+    from celery.app.task import Context
+    assert queue_wait(Context(), now=100.0) is None
+    assert queue_wait(Context(sent_at=90.0), now=100.0) == 10.0
+    # the countdown of a retry is not waiting
+    eta = '1970-01-01T00:01:35+00:00'
+    assert queue_wait(Context(sent_at=90.0, eta=eta), now=100.0) == 5.0
+
+
+class FakeRdata(object):
+    def __init__(self, text, minimum=None):
+        self.text = text
+        self.minimum = minimum
+
+    def to_text(self):
+        return self.text
+
+
+class FakeRRset(list):
+    def __init__(self, records, ttl, rdtype=None):
+        super().__init__(records)
+        self.ttl = ttl
+        self.rdtype = rdtype
+
+
+class FakeAnswer(list):
+    def __init__(self, records, ttl):
+        super().__init__(records)
+        self.rrset = FakeRRset(records, ttl)
+
+
+class FakeResponse(object):
+    def __init__(self, soa_ttl, minimum):
+        from dns.rdatatype import SOA
+        self.authority = [FakeRRset([FakeRdata('soa', minimum)], soa_ttl,
+                                    SOA)]
+        self.question = []
+
+
+class FakeResolver(object):
+    """
+    Answers A and MX queries, every other type is missing
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.active = 0
+        self.peak = 0
+
+    async def resolve(self, name, rdtype, search=True):
+        import asyncio
+        from dns.resolver import NXDOMAIN, NoAnswer
+        self.queries.append((name, rdtype))
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+
+        if name == 'missing.example.':
+            raise NXDOMAIN(qnames=[name], responses={
+                name: FakeResponse(600, 60)})
+        if rdtype == 'A':
+            return FakeAnswer([FakeRdata('192.0.2.1')], 300)
+        if rdtype == 'MX':
+            return FakeAnswer([FakeRdata('10 mx.example.')], 0)
+        raise NoAnswer(response=FakeResponse(600, 120))
+
+
+def test_dns_resolver_caches_answers():
+    resolver = DnsResolver()
+    resolver._resolver = fake = FakeResolver()
+
+    result = resolver.resolve('Example.com.', ['A', 'MX', 'TXT'])
+    assert result == {'host': 'Example.com.', 'nxdomain': False,
+                      'records': {'A': ['192.0.2.1'],
+                                  'MX': ['10 mx.example.'], 'TXT': []}}
+    # every record type is queried at once
+    assert fake.peak == 3
+
+    # cached for the TTL of the records, missing records for the SOA
+    # minimum, records with a zero TTL are queried again
+    resolver.resolve('example.com', ['A', 'MX', 'TXT'])
+    assert fake.queries[3:] == [('example.com.', 'MX')]
+
+    result = resolver.resolve('missing.example', ['A', 'AAAA'])
+    assert result['nxdomain'] and result['records'] == {'A': [], 'AAAA': []}
+    resolver.resolve('missing.example', ['A', 'AAAA'])
+    assert len(fake.queries) == 6
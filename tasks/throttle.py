@@ -0,0 +1,128 @@
+from hashlib import sha256
+from time import time
+
+from celery.utils.log import get_task_logger
+from pymongo.errors import DuplicateKeyError
+
+logger = get_task_logger(__name__)  # Get logger by name
+
+# compare and swap attempts before a caller is told to come back later
+ACQUIRE_ATTEMPTS = 10
+
+
+def key_digest(apikey):
+    """
+    Identify an API key without storing it
+
+    Args:
+        apikey: API key of an upstream service
+
+    Returns:
+        String. First 16 hex digits of the SHA-256 of the key
+    """
+    return sha256(apikey.encode('utf-8')).hexdigest()[:16]
+
+
+def refill(bucket, now):
+    """
+    Return the tokens of a bucket at a given time
+
+    Tokens below zero are reservations of callers waiting for their turn.
+
+    Args:
+        bucket: document with tokens, updated, rate and capacity
+        now: unix time
+
+    Returns:
+        Float. Number of tokens
+    """
+    elapsed = max(0.0, now - bucket['updated'])
+    return min(bucket['capacity'], bucket['tokens'] + elapsed * bucket['rate'])
+
+
+class TokenBuckets(object):
+    """
+    Token buckets of upstream API keys shared by every worker process
+    through a MongoDB collection.
+
+    A caller always takes a token: when the bucket is empty the token is
+    reserved ahead of time and the caller is told how long to wait for
+    it, so waiting callers are served in order at the rate of the key.
+    """
+
+    def __init__(self, app, collection, rate, capacity, quotas=None):
+        """
+        Args:
+            app: celery app of the mongodb result backend
+            collection: name of the bucket collection
+            rate: requests per minute of a key without a quota
+            capacity: requests a key without a quota may burst
+            quotas: (rate, capacity) by key digest
+        """
+        self.app = app
+        self.collection_name = collection
+        self.rate = rate
+        self.capacity = capacity
+        self.quotas = quotas or {}
+        self._collection = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            self._collection = self.app.backend.database[self.collection_name]
+        return self._collection
+
+    def quota(self, digest):
+        """
+        Returns:
+            Tuple. Tokens per second and capacity of a key
+        """
+        rate, capacity = self.quotas.get(digest, (self.rate, self.capacity))
+        return rate / 60.0, capacity
+
+    def acquire(self, apikey):
+        """
+        Take a token from the bucket of a key
+
+        Args:
+            apikey: API key of an upstream service
+
+        Returns:
+            Float. Seconds to wait before the request may be sent,
+            0 to send it at once OR None if no token could be taken
+        """
+        digest = key_digest(apikey)
+        rate, capacity = self.quota(digest)
+
+        try:
+            for attempt in range(ACQUIRE_ATTEMPTS):
+                now = time()
+                bucket = self.collection.find_one({'_id': digest})
+
+                if bucket is None:
+                    tokens = capacity - 1
+                    try:
+                        self.collection.insert_one({
+                            '_id': digest, 'tokens': tokens, 'updated': now,
+                            'rate': rate, 'capacity': capacity})
+                    except DuplicateKeyError:
+                        continue
+                else:
+                    tokens = refill(bucket, now) - 1
+                    # only applies if no other worker took a token since
+                    swapped = self.collection.update_one(
+                        {'_id': digest, 'tokens': bucket['tokens'],
+                         'updated': bucket['updated']},
+                        {'$set': {'tokens': tokens, 'updated': now,
+                                  'rate': rate, 'capacity': capacity}})
+                    if not swapped.modified_count:
+                        continue
+
+                return max(0.0, -tokens / rate)
+
+        except Exception as err:
+            logger.info('Token bucket unavailable: {}'.format(err))
+            return 0.0
+
+        # too much contention on the bucket
+        return None